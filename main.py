@@ -3,6 +3,10 @@ main.py
 
 Main script for starting the app
 """
+import asyncio
+import time
+from typing import Sequence
+
 import uvicorn
 from decouple import config
 from fastapi import Depends
@@ -11,8 +15,22 @@ from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from webapi.backend.authentication import Authorization
+from webapi.data.cache import Cache
+from webapi.data.cache import NamespaceBackend
+from webapi.data.compression import CompressionMiddleware
 from webapi.data.dataflow import DataFlow
+from webapi.data.generation import CacheGeneration
+from webapi.data.generation import CacheGenerationMiddleware
+from webapi.data.http_session import http_sessions
+from webapi.data.negative_cache import negative_cache
+from webapi.data.query_cache import QueryCache
+from webapi.data.reader import DataReader
+from webapi.data.reader import ReadMode
+from webapi.data.shared_cache import SharedCache
+from webapi.data.single_flight import SingleFlight
+from webapi.data.snapshot import CacheSnapshot
 from webapi.logs.logger import app_logger
+from webapi.logs.logger import log_duration
 from webapi.routers.clients import router as clients_router
 from webapi.routers.policies import router as policies_router
 from webapi.routers.users import router as users_router
@@ -27,6 +45,31 @@ DB_CLIENTS = config("DB_CLIENTS", cast=str)
 DB_POLICIES = config("DB_POLICIES", cast=str)
 SECRET_KEY = config("SECRET_KEY", cast=str)
 ACCESS_TOKEN_EXPIRE_SECONDS = config("ACCESS_TOKEN_EXPIRE_SECONDS", cast=int)
+CACHE_READ_MODE = config("CACHE_READ_MODE", default="mongo", cast=ReadMode)
+CACHE_MAX_AGE_SECONDS = config("CACHE_MAX_AGE_SECONDS", default=0, cast=float)
+CACHE_REFRESH_INTERVAL = config("CACHE_REFRESH_INTERVAL", default=60, cast=float)
+CACHE_REFRESH_WATERMARK = config("CACHE_REFRESH_WATERMARK", default="_id", cast=str)
+WRITE_BEHIND_INTERVAL = config("WRITE_BEHIND_INTERVAL", default=5, cast=float)
+WRITE_BEHIND_BATCH_SIZE = config("WRITE_BEHIND_BATCH_SIZE", default=500, cast=int)
+WRITE_BEHIND_MAX_PENDING = config("WRITE_BEHIND_MAX_PENDING", default=1000, cast=int)
+QUERY_CACHE_MAX_SIZE = config("QUERY_CACHE_MAX_SIZE", default=1024, cast=int)
+CACHE_LOAD_SOURCE = config("CACHE_LOAD_SOURCE", default="upstream", cast=str)
+CACHE_LOAD_BATCH_SIZE = config("CACHE_LOAD_BATCH_SIZE", default=1000, cast=int)
+CACHE_LOAD_STREAMING = config("CACHE_LOAD_STREAMING", default=False, cast=bool)
+UPSTREAM_SYNC_DATABASE = config("UPSTREAM_SYNC_DATABASE", default=False, cast=bool)
+CACHE_SNAPSHOT_PATH = config("CACHE_SNAPSHOT_PATH", default="", cast=str)
+CACHE_SNAPSHOT_MAX_AGE = config("CACHE_SNAPSHOT_MAX_AGE", default=3600, cast=float)
+CACHE_EVICTION_POLICY = config("CACHE_EVICTION_POLICY", default="lru", cast=str)
+CACHE_BUDGET_CLIENTS_MB = config("CACHE_BUDGET_CLIENTS_MB", default=0, cast=float)
+CACHE_BUDGET_POLICIES_MB = config("CACHE_BUDGET_POLICIES_MB", default=0, cast=float)
+CACHE_BUDGET_QUERIES_MB = config("CACHE_BUDGET_QUERIES_MB", default=64, cast=float)
+CACHE_SHARED_MEMORY = config("CACHE_SHARED_MEMORY", default="", cast=str)
+CACHE_SHARED_INTERVAL = config("CACHE_SHARED_INTERVAL", default=5, cast=float)
+CACHE_SHARED_WAIT = config("CACHE_SHARED_WAIT", default=120, cast=float)
+RESPONSE_COMPRESSION_MIN_SIZE = config(
+    "RESPONSE_COMPRESSION_MIN_SIZE", default=1024, cast=int
+)
+RESPONSE_COMPRESSION_LEVEL = config("RESPONSE_COMPRESSION_LEVEL", default=6, cast=int)
 
 # Define allowed origins for CORS
 origins = [
@@ -47,6 +90,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Pin each request to one cache generation and tag its response with it
+app.add_middleware(
+    CacheGenerationMiddleware,
+    get_generation=lambda: getattr(app, "cache_generation", None),
+)
+
+# Compress the large responses for the clients accepting it
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=RESPONSE_COMPRESSION_MIN_SIZE,
+    level=RESPONSE_COMPRESSION_LEVEL,
+)
+
+# Memory budgets of the cached tables and query results
+app.cache_memory = Cache(default_policy=CACHE_EVICTION_POLICY)
+app.cache_memory.namespace("clients", max_bytes=int(CACHE_BUDGET_CLIENTS_MB * 2**20))
+app.cache_memory.namespace(
+    "policies", max_bytes=int(CACHE_BUDGET_POLICIES_MB * 2**20)
+)
+app.cache_memory.namespace("queries", max_bytes=int(CACHE_BUDGET_QUERIES_MB * 2**20))
+
+# Read path used by the routers (MongoDB and/or cache)
+app.query_cache = QueryCache(
+    max_size=QUERY_CACHE_MAX_SIZE,
+    backend=NamespaceBackend(app.cache_memory["queries"]),
+)
+app.single_flight = SingleFlight()
+app.reader = DataReader(
+    app,
+    mode=CACHE_READ_MODE,
+    max_age=CACHE_MAX_AGE_SECONDS,
+    query_cache=app.query_cache,
+    single_flight=app.single_flight,
+    negative_cache=negative_cache,
+)
+
 # Authentication
 authorization = Authorization(secret=SECRET_KEY)
 
@@ -72,42 +151,209 @@ app.include_router(
 )
 
 
+def use_generation(generation: CacheGeneration):
+    """
+    Serve the requests from a newly published cache generation.
+    """
+    app.cache = generation.tables
+    app.cache_generation = generation
+
+
+async def load_cache_from_upstream(
+    dataflow: DataFlow,
+    snapshot=None,
+    fill: Sequence[str] = (),
+    if_modified: bool = False,
+):
+    """
+    Fetch each upstream payload once, build the cache from it, fill the
+    MongoDB collections listed in `fill` with it and save a snapshot of the
+    cache. Both collections are processed concurrently. With `if_modified`,
+    the collections whose payload did not change since it was last stored
+    keep their current table. With UPSTREAM_SYNC_DATABASE, every collection
+    is synced to MongoDB, writing only its changed documents.
+    """
+
+    def sync_collection(url, db_name):
+        options = {
+            "url": url,
+            "db_name": db_name,
+            "fill": UPSTREAM_SYNC_DATABASE or db_name in fill,
+            "idempotent": UPSTREAM_SYNC_DATABASE,
+        }
+        if CACHE_LOAD_STREAMING:
+            # Parses the payload as it arrives instead of buffering it
+            return dataflow.stream_collection(**options)
+        return dataflow.sync_collection(
+            if_modified=if_modified and db_name not in fill, **options
+        )
+
+    try:
+        with log_duration("Loading cache from upstream"):
+            clients, policies = await asyncio.gather(
+                sync_collection(DB_CLIENTS, DB_COLLECTION_CLIENTS),
+                sync_collection(DB_POLICIES, DB_COLLECTION_POLICIES),
+            )
+        tables = {
+            name: table
+            for name, table in (("clients", clients), ("policies", policies))
+            if table is not None
+        }
+        if not tables:
+            app_logger.info("Upstream data not modified, keeping the cache")
+            return
+        await dataflow.publish_generation(tables)
+    except Exception as e:
+        app_logger.error(f"Error loading cache from upstream: {e}")
+        raise
+
+    if snapshot is not None:
+        with log_duration("Saving cache snapshot"):
+            await asyncio.to_thread(dataflow.save_snapshot, snapshot)
+
+
+async def load_cache_from_database(dataflow: DataFlow, snapshot=None):
+    """
+    Build the cache from the MongoDB collections and save a snapshot of it.
+    """
+    try:
+        with log_duration("Loading cache from MongoDB"):
+            clients, policies = await asyncio.gather(
+                dataflow.load_cache_from_database(
+                    DB_COLLECTION_CLIENTS,
+                    batch_size=CACHE_LOAD_BATCH_SIZE,
+                    watermark_field=CACHE_REFRESH_WATERMARK,
+                ),
+                dataflow.load_cache_from_database(
+                    DB_COLLECTION_POLICIES,
+                    batch_size=CACHE_LOAD_BATCH_SIZE,
+                    watermark_field=CACHE_REFRESH_WATERMARK,
+                ),
+            )
+        await dataflow.publish_generation({"clients": clients, "policies": policies})
+    except Exception as e:
+        app_logger.error(f"Error loading cache from MongoDB: {e}")
+        raise
+
+    if snapshot is not None:
+        with log_duration("Saving cache snapshot"):
+            await asyncio.to_thread(dataflow.save_snapshot, snapshot)
+
+
+async def start_loader(dataflow: DataFlow):
+    """
+    Load the cache, publish it to the other workers when it is shared, and
+    start the background tasks keeping it up to date.
+    """
+    snapshot = (
+        CacheSnapshot(CACHE_SNAPSHOT_PATH, max_age=CACHE_SNAPSHOT_MAX_AGE)
+        if CACHE_SNAPSHOT_PATH
+        else None
+    )
+
+    async def load_snapshot():
+        if snapshot is None:
+            return False
+        with log_duration("Loading cache snapshot"):
+            return await asyncio.to_thread(dataflow.load_snapshot, snapshot)
+
+    async def list_collections():
+        with log_duration("Listing collections"):
+            return await app.mongodb.list_collection_names()
+
+    collections_in_remote_db, snapshot_loaded = await asyncio.gather(
+        list_collections(), load_snapshot()
+    )
+    app_logger.info(
+        f"The Database has {len(collections_in_remote_db)} "
+        f"collections: {collections_in_remote_db}"
+    )
+    missing = [
+        db_name
+        for db_name in (DB_COLLECTION_CLIENTS, DB_COLLECTION_POLICIES)
+        if db_name not in collections_in_remote_db
+    ]
+
+    if missing or CACHE_LOAD_SOURCE != "mongo":
+        # A snapshot is as recent as the last stored upstream payloads
+        load_cache = load_cache_from_upstream(
+            dataflow, snapshot, fill=missing, if_modified=snapshot_loaded
+        )
+    else:
+        load_cache = load_cache_from_database(dataflow, snapshot)
+    if snapshot_loaded and not missing:
+        # Serve from the snapshot and refresh the cache in the background
+        app.cache_warmup = asyncio.create_task(load_cache)
+    else:
+        await load_cache
+    if CACHE_REFRESH_INTERVAL:
+        app.cache_refreshers = dataflow.start_cache_refresher(
+            interval=CACHE_REFRESH_INTERVAL,
+            watermark_field=CACHE_REFRESH_WATERMARK,
+        )
+    app.write_behind_task = dataflow.start_write_behind(
+        interval=WRITE_BEHIND_INTERVAL,
+        batch_size=WRITE_BEHIND_BATCH_SIZE,
+        max_pending=WRITE_BEHIND_MAX_PENDING,
+    )
+    if hasattr(app, "shared_cache"):
+        await asyncio.to_thread(app.shared_cache.publish, dataflow.cache)
+        app.shared_cache_publisher = asyncio.create_task(
+            app.shared_cache.publish_changes(
+                lambda: dataflow.cache, interval=CACHE_SHARED_INTERVAL
+            )
+        )
+
+
 @app.on_event("startup")
 async def startup_db_client():
     """
     Initialize the database and cache on startup.
     """
+    startup = time.perf_counter()
     try:
         app.mongodb_client = AsyncIOMotorClient(DB_URL)
         app.mongodb = app.mongodb_client[DB_NAME]
-        dataflow = DataFlow(
+        app.dataflow = dataflow = DataFlow(
             client=app.mongodb_client,
             db_names=["clients", "policies"],
             database=app.mongodb,
+            query_cache=app.query_cache,
+            single_flight=app.single_flight,
+            memory=app.cache_memory,
         )
+        app.cache = dataflow.start_cache()
+        dataflow.subscribe(use_generation)
 
-        collections_in_remote_db = await app.mongodb.list_collection_names()
-        app_logger.info(
-            f"The Database has {len(collections_in_remote_db)} "
-            f"collections: {collections_in_remote_db}"
-        )
-
-        if f"{DB_COLLECTION_CLIENTS}" not in collections_in_remote_db:
-            await dataflow.fill_database(url=DB_CLIENTS, db_name=DB_COLLECTION_CLIENTS)
+        if CACHE_SHARED_MEMORY:
+            app.shared_cache = SharedCache(CACHE_SHARED_MEMORY)
+            if not app.shared_cache.acquire_loader():
+                # Another worker loads the cache, serve its shared generations
+                # and take over if that worker exits. Their derived structures
+                # come from the shared columns and indexes, so the shared
+                # documents are not all decoded by every worker.
+                def publish_shared(tables):
+                    return dataflow.publish_generation(tables)
 
-        if f"{DB_COLLECTION_POLICIES}" not in collections_in_remote_db:
-            await dataflow.fill_database(
-                url=DB_POLICIES, db_name=DB_COLLECTION_POLICIES
-            )
+                await publish_shared(
+                    await app.shared_cache.wait_for_generation(CACHE_SHARED_WAIT)
+                )
+                app.shared_cache_follower = asyncio.create_task(
+                    app.shared_cache.follow(
+                        publish_shared,
+                        interval=CACHE_SHARED_INTERVAL,
+                        on_elected=lambda: start_loader(dataflow),
+                    )
+                )
+                app_logger.info("Attached to the shared cache.")
+                return
 
-        app.cache = dataflow.start_cache()
-        app.cache["clients"] = await dataflow.load_cache(
-            url=DB_CLIENTS, db_name=DB_COLLECTION_CLIENTS
-        )
-        app.cache["policies"] = await dataflow.load_cache(
-            url=DB_POLICIES, db_name=DB_COLLECTION_POLICIES
+        await start_loader(dataflow)
+        app.cache_memory.log_report()
+        app_logger.info(
+            "Database and cache initialized successfully in "
+            f"{time.perf_counter() - startup:.3f}s."
         )
-        app_logger.info("Database and cache initialized successfully.")
     except Exception as e:
         app_logger.error(f"Error initializing database and cache: {e}")
 
@@ -117,6 +363,32 @@ async def shutdown_db_client():
     """
     Close the database connection on shutdown.
     """
+    for task in getattr(app, "cache_refreshers", []):
+        task.cancel()
+    for name in ("shared_cache_follower", "shared_cache_publisher"):
+        if hasattr(app, name):
+            getattr(app, name).cancel()
+
+    try:
+        if hasattr(app, "write_behind_task"):
+            # Stopped rather than cancelled, so no flush is cut halfway
+            app.dataflow.write_behind.stop()
+            await app.write_behind_task
+            await app.dataflow.write_behind.drain()
+    except Exception as e:
+        app_logger.error(f"Error flushing cache into database: {e}")
+
+    if hasattr(app, "shared_cache"):
+        app.shared_cache.close()
+    await http_sessions.close()
+
+    app.cache_memory.log_report()
+    app_logger.info(
+        f"Query cache: {app.query_cache.stats()}, "
+        f"coalesced queries: {app.single_flight.stats()}, "
+        f"negative cache: {negative_cache.stats()}"
+    )
+
     try:
         app.mongodb_client = AsyncIOMotorClient(DB_URL)
         app.mongodb = app.mongodb_client[DB_NAME]
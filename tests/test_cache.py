@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+from webapi.data.cache import Cache
+from webapi.data.cache import estimate_size
+from webapi.data.cache import Namespace
+from webapi.data.cache_index import IndexedCache
+
+
+def document(number):
+    return {"id": f"c{number}", "name": "Britney", "role": "admin" * 10}
+
+
+def test_estimate_size_counts_nested_values():
+    small = {"id": "c1"}
+    nested = {"id": "c1", "tags": ["a" * 1000]}
+    assert estimate_size(nested) > estimate_size(small) + 1000
+
+
+def test_lru_keeps_recently_used_entries_within_budget():
+    size = estimate_size(document(1))
+    namespace = Namespace("clients", max_bytes=size * 2, policy="lru")
+    namespace["c1"] = document(1)
+    namespace["c2"] = document(2)
+    assert namespace.get("c1") is not None
+    namespace["c3"] = document(3)
+
+    assert sorted(namespace) == ["c1", "c3"]
+    assert namespace.size_bytes <= namespace.max_bytes
+    assert namespace.report()["evictions"] == 1
+
+
+def test_lfu_evicts_least_frequently_used():
+    size = estimate_size(document(1))
+    namespace = Namespace("clients", max_bytes=size * 2, policy="lfu")
+    namespace["c1"] = document(1)
+    namespace["c2"] = document(2)
+    namespace.get("c2")
+    namespace.get("c2")
+    namespace.get("c1")
+    namespace["c3"] = document(3)
+    assert sorted(namespace) == ["c2", "c3"]
+
+
+def test_ttl_evicts_closest_to_expiring(monkeypatch):
+    size = estimate_size(document(1))
+    namespace = Namespace("queries", max_bytes=size * 2, policy="ttl")
+    namespace.set("long", document(1), ttl=60)
+    namespace.set("short", document(2), ttl=5)
+    namespace.set("new", document(3), ttl=30)
+    assert sorted(namespace) == ["long", "new"]
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 31)
+    assert namespace.get("new") is None
+    assert namespace.get("long") is not None
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Namespace("clients", policy="random")
+
+
+def test_cache_reports_namespaces_and_renews_them():
+    cache = Cache()
+    cache.namespace("clients", max_bytes=10_000)["c1"] = document(1)
+    assert cache.size_bytes == estimate_size(document(1))
+    assert cache.report()["clients"]["entries"] == 1
+
+    renewed = cache.renew("clients")
+    assert len(renewed) == 0
+    assert renewed.max_bytes == 10_000
+    assert cache["clients"] is renewed
+
+
+def test_bound_table_unindexes_evicted_documents():
+    size = estimate_size(document(1))
+    table = IndexedCache.for_collection("clients", [document(n) for n in range(3)])
+    table.bind(Namespace("clients", max_bytes=size * 2))
+
+    assert not table.complete
+    assert table.evicted == 1
+    assert list(table) == ["c1", "c2"]
+    assert table.ids_for("name", "Britney") == ["c1", "c2"]
+
+
+def test_reads_leave_a_bound_table_unchanged(monkeypatch):
+    table = IndexedCache.for_collection("clients", [document(n) for n in range(3)])
+    table.bind(Namespace("clients", ttl=10))
+    version = table.version
+    assert table["c0"] is not None
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert table._documents.get("c1") is None
+    assert table._documents.report()["entries"] == 3
+    assert table.version == version
+    assert table.complete
+
+    draft = table.copy()
+    assert list(draft) == []
+    assert draft.evicted == 3
+    assert draft.lookup("name", "Britney") == []
+
+
+def test_copy_orders_documents_by_use():
+    table = IndexedCache.for_collection("clients", [document(n) for n in range(3)])
+    table.bind(Namespace("clients"))
+    table["c0"], table["c1"]
+
+    assert list(table) == ["c0", "c1", "c2"]
+    assert list(table.copy()) == ["c2", "c0", "c1"]
@@ -0,0 +1,70 @@
+import pytest
+
+from webapi.data.cache_index import IndexedCache
+
+clients = [
+    {"id": "1", "name": "Britney", "email": "britney@example.com", "role": "admin"},
+    {"id": "2", "name": "Manning", "email": "manning@example.com", "role": "user"},
+    {"id": "3", "name": "Britney", "email": "other@example.com", "role": "user"},
+]
+
+
+@pytest.fixture
+def cache():
+    return IndexedCache.for_collection("clients", clients)
+
+
+def test_primary_map(cache):
+    assert len(cache) == 3
+    assert cache["2"]["name"] == "Manning"
+    assert list(cache) == ["1", "2", "3"]
+
+
+def test_secondary_lookup(cache):
+    assert cache.ids_for("name", "Britney") == ["1", "3"]
+    assert [c["id"] for c in cache.lookup("role", "user")] == ["2", "3"]
+    assert cache.lookup("email", "missing@example.com") == []
+    assert cache.lookup("id", "1") == [clients[0]]
+
+
+def test_unindexed_field(cache):
+    assert not cache.is_indexed("missing")
+    with pytest.raises(KeyError):
+        cache.lookup("missing", "value")
+
+
+def test_rebuild_replaces_indexes(cache):
+    cache.rebuild(clients[:1])
+    assert cache.ids_for("name", "Britney") == ["1"]
+    assert cache.values_for("role") == {"admin"}
+
+
+def test_upsert_and_remove_update_indexes(cache):
+    version = cache.version
+    cache.upsert(
+        {"id": "2", "name": "Britney", "email": "m@example.com", "role": "admin"}
+    )
+    assert cache.ids_for("name", "Britney") == ["1", "3", "2"]
+    assert cache.ids_for("name", "Manning") == []
+    assert cache.values_for("role") == {"admin", "user"}
+
+    assert cache.remove("3")
+    assert not cache.remove("3")
+    assert cache.ids_for("name", "Britney") == ["1", "2"]
+    assert cache.values_for("role") == {"admin"}
+    assert cache.version == version + 2
+
+
+def test_index_buckets_keep_insertion_order(cache):
+    cache.upsert({"id": "4", "name": "Zed", "role": "user"})
+    cache.remove("2")
+    cache.upsert({"id": "2", "name": "Manning", "role": "user"})
+    assert cache.ids_for("role", "user") == ["3", "4", "2"]
+
+    restored = IndexedCache.from_state(cache.to_state())
+    assert restored.to_state()["indexes"]["role"] == {
+        "admin": ["1"],
+        "user": ["3", "4", "2"],
+    }
+    restored.remove("4")
+    assert restored.ids_for("role", "user") == ["3", "2"]
@@ -0,0 +1,115 @@
+from datetime import datetime
+
+from webapi.data.cache import Namespace
+from webapi.data.cache_index import IndexedCache
+from webapi.data.columnar import MISSING_DATE
+from webapi.data.columnar import PolicyColumns
+from webapi.data.columnar import to_epoch
+
+policies = [
+    {
+        "id": "p1",
+        "amountInsured": 1825.89,
+        "email": "ines@example.com",
+        "inceptionDate": "2016-06-01T03:33:32Z",
+        "installmentPayment": True,
+        "clientId": "c1",
+    },
+    {
+        "id": "p2",
+        "amountInsured": 15.0,
+        "email": "ines@example.com",
+        "inceptionDate": "2015-07-06T06:55:49Z",
+        "installmentPayment": False,
+        "clientId": "c2",
+    },
+    {
+        "id": "p3",
+        "amountInsured": 15.0,
+        "email": "other@example.com",
+        "inceptionDate": "not a date",
+        "installmentPayment": True,
+        "clientId": "c1",
+    },
+]
+by_id = {policy["id"]: policy for policy in policies}
+
+
+def test_to_epoch():
+    assert to_epoch("1970-01-01T00:01:00Z") == 60
+    assert to_epoch(datetime(1970, 1, 1, 0, 1)) == 60
+    assert to_epoch("garbage") == MISSING_DATE
+    assert to_epoch(None) == MISSING_DATE
+
+
+def test_filter_masks():
+    columns = PolicyColumns(by_id)
+    assert columns.filter({"amountInsured": 15.0}) == policies[1:]
+    assert columns.filter({"installmentPayment": True, "clientId": "c1"}) == [
+        policies[0],
+        policies[2],
+    ]
+    assert columns.filter({"inceptionDate": datetime(2015, 7, 6, 6, 55, 49)}) == [
+        policies[1]
+    ]
+    assert columns.filter({"email": "ines@example.com", "id": "p2"}) == [policies[1]]
+    assert columns.filter({"clientId": "unknown"}) == []
+    assert columns.filter({}) == policies
+
+
+def test_filter_candidates():
+    columns = PolicyColumns(by_id)
+    assert columns.filter({"amountInsured": 15.0}, keys=["p3", "p1", "p9"]) == [
+        policies[2]
+    ]
+    assert columns.filter({"id": "p2"}, keys=["p1", "p2"]) == [policies[1]]
+    assert columns.filter({}, keys=["p2"]) == [policies[1]]
+    assert columns.filter({"clientId": "c1"}, keys=[]) == []
+
+
+def test_filter_after_reads_reordered_the_table():
+    table = IndexedCache.for_collection("policies", policies)
+    table.bind(Namespace("policies"))
+    columns = PolicyColumns.for_table(table)
+    # Reads are recorded for the eviction policy of the namespace
+    table["p1"], table["p2"]
+
+    assert columns.filter({"clientId": "c1"}) == [policies[0], policies[2]]
+    assert columns.filter({"amountInsured": 15.0}) == policies[1:]
+
+
+def test_columns_rebuilt_per_table_version():
+    table = IndexedCache.for_collection("policies", policies)
+    columns = PolicyColumns.for_table(table)
+    assert PolicyColumns.for_table(table) is columns
+
+    table.upsert({**policies[0], "amountInsured": 15.0})
+    rebuilt = PolicyColumns.for_table(table)
+    assert rebuilt is not columns
+    assert len(rebuilt.filter({"amountInsured": 15.0})) == 3
+
+
+def test_portfolio_totals():
+    columns = PolicyColumns(by_id)
+    assert columns.totals_by_client() == [
+        {
+            "clientId": "c1",
+            "policies": 2,
+            "totalAmountInsured": 1840.89,
+            "meanAmountInsured": 920.445,
+        },
+        {
+            "clientId": "c2",
+            "policies": 1,
+            "totalAmountInsured": 15.0,
+            "meanAmountInsured": 15.0,
+        },
+    ]
+    assert columns.totals_by_installment() == [
+        {"installmentPayment": False, "policies": 1, "totalAmountInsured": 15.0},
+        {"installmentPayment": True, "policies": 2, "totalAmountInsured": 1840.89},
+    ]
+    assert columns.totals_by_inception_year() == [
+        {"year": 2015, "policies": 1, "totalAmountInsured": 15.0},
+        {"year": 2016, "policies": 1, "totalAmountInsured": 1825.89},
+    ]
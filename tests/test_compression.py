@@ -0,0 +1,138 @@
+import gzip
+import json
+import zlib
+
+import pytest
+from aiohttp import web
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from webapi.data.compression import CompressionMiddleware
+from webapi.data.compression import negotiate
+from webapi.data.compression import StreamDecoder
+from webapi.data.http_session import HTTPSessionManager
+from webapi.data.json_handler import JSONData
+
+policies = [{"id": f"p{i}", "clientId": "c1", "email": "a@b.c"} for i in range(200)]
+
+
+def decode_in_chunks(encoding, body, size=7):
+    decoder = StreamDecoder(encoding)
+    chunks = [decoder.decode(body[i : i + size]) for i in range(0, len(body), size)]
+    return b"".join(chunks) + decoder.flush()
+
+
+def test_stream_decoder():
+    payload = json.dumps(policies).encode()
+    raw_deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+    assert decode_in_chunks("gzip", gzip.compress(payload)) == payload
+    assert decode_in_chunks("deflate", zlib.compress(payload)) == payload
+    assert (
+        decode_in_chunks("deflate", raw_deflate.compress(payload) + raw_deflate.flush())
+        == payload
+    )
+    assert decode_in_chunks("identity", payload) == payload
+    with pytest.raises(ValueError):
+        StreamDecoder("br")
+    with pytest.raises(ValueError):
+        decode_in_chunks("gzip", b"not gzip")
+
+
+def test_negotiate():
+    encodings = ("zstd", "gzip", "deflate")
+    assert negotiate("gzip, deflate, br", encodings) == "gzip"
+    assert negotiate("deflate;q=1.0, gzip;q=0.5", encodings) == "deflate"
+    assert negotiate("*", encodings) == "zstd"
+    assert negotiate("*;q=0.5, zstd;q=0", encodings) == "gzip"
+    assert negotiate("identity, br", encodings) is None
+    assert negotiate("", encodings) is None
+
+
+def test_middleware_compresses_large_responses():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=500)
+
+    @app.get("/policies")
+    def get_policies():
+        return policies
+
+    @app.get("/token")
+    def get_token():
+        return {"access_token": "abc", "token_type": "bearer"}
+
+    @app.get("/stream")
+    def get_stream():
+        chunks = (json.dumps(policy).encode() for policy in policies)
+        return StreamingResponse(chunks, media_type="application/json")
+
+    client = TestClient(app)
+    response = client.get("/policies", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(json.dumps(policies)) / 4
+    assert response.json() == policies
+
+    small = client.get("/token", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    assert small.json()["access_token"] == "abc"
+
+    plain = client.get("/policies", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+
+    stream = client.get("/stream", headers={"Accept-Encoding": "deflate"})
+    assert stream.headers["content-encoding"] == "deflate"
+    assert stream.content == b"".join(json.dumps(p).encode() for p in policies)
+
+
+@pytest.mark.asyncio
+async def test_upstream_payloads_are_decoded():
+    accepted = []
+
+    async def handler(request):
+        accepted.append(request.headers.get("Accept-Encoding"))
+        body = gzip.compress(json.dumps({"policies": policies}).encode())
+        response = web.StreamResponse(headers={"Content-Encoding": "gzip"})
+        await response.prepare(request)
+        for start in range(0, len(body), 100):
+            await response.write(body[start : start + 100])
+        return response
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    upstream = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/"
+    sessions = HTTPSessionManager()
+    fetcher = JSONData(upstream, sessions)
+    try:
+        fetched = await fetcher.fetch_data_from_json_url()
+        streamed = [item async for item in fetcher.stream_json_items("policies")]
+    finally:
+        await sessions.close()
+        await runner.cleanup()
+
+    assert fetched == {"policies": policies}
+    assert streamed == policies
+    assert "gzip" in accepted[0]
+
+
+def test_zstd_when_available():
+    zstandard = pytest.importorskip("zstandard")
+    payload = json.dumps(policies).encode()
+    encoded = zstandard.ZstdCompressor().compress(payload)
+    assert decode_in_chunks("zstd", encoded) == payload
+
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=500)
+
+    @app.get("/policies")
+    def get_policies():
+        return policies
+
+    response = TestClient(app).get("/policies", headers={"Accept-Encoding": "zstd"})
+    assert response.headers["content-encoding"] == "zstd"
+    assert response.json() == policies
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import pytest
+from pymongo import DeleteMany
+
+from webapi.data.content_sync import content_hash
+from webapi.data.content_sync import CONTENT_HASH_FIELD
+from webapi.data.content_sync import ContentSync
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class FakeCollection:
+    name = "policies"
+
+    def __init__(self):
+        self.documents = {}
+        self.batches = []
+
+    def find(self, query, projection=None):
+        return FakeCursor(
+            [
+                {field: document[field] for field in projection if field in document}
+                for document in self.documents.values()
+            ]
+        )
+
+    async def bulk_write(self, operations, ordered=True):
+        assert not ordered
+        self.batches.append(operations)
+        upserted = deleted = 0
+        for operation in operations:
+            if isinstance(operation, DeleteMany):
+                for key in operation._filter["id"]["$in"]:
+                    deleted += self.documents.pop(key, None) is not None
+            else:
+                self.documents[operation._filter["id"]] = operation._doc
+                upserted += 1
+        return SimpleNamespace(
+            upserted_count=upserted, matched_count=0, deleted_count=deleted
+        )
+
+
+def test_content_hash_ignores_key_order_and_mongo_fields():
+    document = {"id": "p1", "amountInsured": 10.5, "clientId": "c1"}
+    reordered = {"clientId": "c1", "amountInsured": 10.5, "id": "p1", "_id": 1}
+    assert content_hash(document) == content_hash(reordered)
+    assert content_hash(document) != content_hash(dict(document, clientId="c2"))
+
+
+@pytest.mark.asyncio
+async def test_sync_writes_only_changes():
+    collection = FakeCollection()
+    sync = ContentSync(collection, batch_size=2)
+    documents = [{"id": f"p{i}", "amountInsured": i} for i in range(3)]
+
+    first = await sync.sync(documents)
+    assert (first.upserted, first.unchanged, first.deleted) == (3, 0, 0)
+    assert collection.documents["p0"][CONTENT_HASH_FIELD] == content_hash(documents[0])
+
+    collection.batches.clear()
+    second = await sync.sync(documents)
+    assert (second.upserted, second.unchanged, second.deleted) == (0, 3, 0)
+    assert collection.batches == []
+
+    changed = [{"id": "p0", "amountInsured": 99}, documents[1], {"id": "p3"}]
+    third = await sync.sync(changed)
+    assert (third.upserted, third.unchanged, third.deleted) == (2, 1, 1)
+    assert sorted(collection.documents) == ["p0", "p1", "p3"]
+    assert collection.documents["p0"]["amountInsured"] == 99
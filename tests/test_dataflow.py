@@ -0,0 +1,221 @@
+import asyncio
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import webapi.data.dataflow as dataflow_module
+from webapi.data.cache_index import IndexedCache
+from webapi.data.dataflow import DataFlow
+from webapi.data.json_handler import JSONData
+from webapi.data.store_json import JSONDataToMongoDB
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, field, direction):
+        self.documents = sorted(
+            self.documents, key=lambda d: d[field], reverse=direction < 0
+        )
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            # Like MongoDB, every read returns new documents
+            yield dict(document)
+
+
+class FakeCollection:
+    """Polling-only collection: change streams are not supported."""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def _matches(self, document, query):
+        for field, condition in query.items():
+            if isinstance(condition, dict):
+                if not document.get(field, 0) > condition["$gt"]:
+                    return False
+            elif document.get(field) != condition:
+                return False
+        return True
+
+    def find(self, query, projection=None, batch_size=None):
+        return FakeCursor([d for d in self.documents if self._matches(d, query)])
+
+    async def find_one(self, query, projection=None, sort=None):
+        documents = self.find(query).sort(*sort[0]).documents if sort else []
+        return documents[0] if documents else None
+
+    def watch(self, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica")
+
+
+@pytest.mark.asyncio
+async def test_update_cache_from_database_polls_watermark():
+    collection = FakeCollection(
+        [{"_id": 1, "id": "c1", "name": "Britney", "role": "admin"}]
+    )
+    dataflow = DataFlow(
+        db_names=["clients"], database={"clients": collection}, client=None
+    )
+    cache = dataflow.start_cache()
+    cache["clients"] = IndexedCache.for_collection("clients", collection.documents)
+
+    task = asyncio.create_task(
+        dataflow.update_cache_from_database("clients", interval=0.01)
+    )
+    await asyncio.sleep(0.02)
+    collection.documents.append(
+        {"_id": 2, "id": "c2", "name": "Manning", "role": "user"}
+    )
+    collection.documents.append(
+        {"_id": 3, "id": "c1", "name": "Britney", "role": "user"}
+    )
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await dataflow.publish_pending()
+
+    clients = dataflow.cache["clients"]
+    assert clients["c2"]["name"] == "Manning"
+    assert clients.ids_for("role", "user") == ["c2", "c1"]
+    assert clients.ids_for("role", "admin") == []
+    # The table the refresher started from was not changed in place
+    assert cache["clients"].ids_for("role", "admin") == ["c1"]
+
+
+@pytest.mark.asyncio
+async def test_refresher_polls_from_the_watermark_of_the_load():
+    collection = FakeCollection(
+        [{"_id": 1, "id": "c1", "name": "Britney", "role": "admin"}]
+    )
+    dataflow = DataFlow(["clients"], database={"clients": collection}, client=None)
+    dataflow.start_cache()
+    table = await dataflow.load_cache_from_database("clients", watermark_field="_id")
+    await dataflow.publish_generation({"clients": table})
+    # Inserted between the load and the start of the refresher
+    collection.documents.append(
+        {"_id": 2, "id": "c2", "name": "Manning", "role": "user", "_contentHash": "h"}
+    )
+
+    task = asyncio.create_task(
+        dataflow.update_cache_from_database("clients", interval=0.01)
+    )
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await dataflow.publish_pending()
+
+    assert dataflow.cache["clients"]["c2"] == {
+        "id": "c2",
+        "name": "Manning",
+        "role": "user",
+    }
+    assert dataflow._object_ids["clients"][2] == "c2"
+
+
+@pytest.mark.asyncio
+async def test_sync_collection_fetches_payload_once(monkeypatch):
+    payload = {
+        "clients": [{"id": "c1", "name": "Britney"}],
+        "policies": [{"id": "p1", "clientId": "c1"}],
+    }
+    fetches = []
+    stored = {}
+
+    async def fetch_data_from_json_url(self, if_modified=False):
+        fetches.append(self.url)
+        await asyncio.sleep(0.01)
+        return payload
+
+    async def store_documents(db_name, documents, url=None):
+        stored[db_name] = documents
+
+    monkeypatch.setattr(JSONData, "fetch_data_from_json_url", fetch_data_from_json_url)
+    dataflow = DataFlow(["clients", "policies"], database={}, client=None)
+    monkeypatch.setattr(dataflow, "store_documents", store_documents)
+
+    clients, policies = await asyncio.gather(
+        dataflow.sync_collection("http://upstream", "clients", fill=True),
+        dataflow.sync_collection("http://upstream", "policies"),
+    )
+
+    assert fetches == ["http://upstream"]
+    assert clients.lookup("name", "Britney") == payload["clients"]
+    assert policies.lookup("clientId", "c1") == payload["policies"]
+    assert stored == {"clients": payload["clients"]}
+
+
+@pytest.mark.asyncio
+async def test_stream_collection_builds_cache_and_fills(monkeypatch):
+    documents = [{"id": "c1", "name": "Britney"}, {"id": "c2", "name": "Manning"}]
+    stored = []
+
+    async def stream_json_items(self, key=None, url=None, chunk_size=0):
+        assert key == "clients"
+        for document in documents:
+            yield document
+
+    class FakeCRUD:
+        def __init__(self, collection_name):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+    async def store_json_stream(self, items):
+        async for item in items:
+            item["_id"] = len(stored)
+            stored.append(item)
+
+    monkeypatch.setattr(JSONData, "stream_json_items", stream_json_items)
+    monkeypatch.setattr(dataflow_module, "MongoDBAtlasCRUD", FakeCRUD)
+    monkeypatch.setattr(JSONDataToMongoDB, "store_json_stream", store_json_stream)
+    dataflow = DataFlow(["clients"], database={}, client=None)
+
+    table = await dataflow.stream_collection("http://upstream", "clients", fill=True)
+
+    assert table.lookup("name", "Manning") == [documents[1]]
+    assert "_id" not in table["c1"]
+    assert [document["id"] for document in stored] == ["c1", "c2"]
+
+
+class StreamingCollection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.find_kwargs = None
+
+    def find(self, query, projection=None, batch_size=None):
+        self.find_kwargs = {"projection": projection, "batch_size": batch_size}
+        return FakeCursor(
+            [
+                {k: v for k, v in d.items() if k == "_id" or k in projection}
+                for d in self.documents
+            ]
+        )
+
+
+@pytest.mark.asyncio
+async def test_load_cache_from_database_streams_projected_documents():
+    collection = StreamingCollection(
+        [
+            {"_id": 1, "id": "c1", "name": "Britney", "role": "admin", "notes": "x"},
+            {"_id": 2, "id": "c2", "name": "Manning", "role": "user", "notes": "y"},
+        ]
+    )
+    dataflow = DataFlow(["clients"], database={"clients": collection}, client=None)
+
+    table = await dataflow.load_cache_from_database(
+        "clients", batch_size=1, progress_every=1
+    )
+
+    assert collection.find_kwargs["batch_size"] == 1
+    assert table["c1"] == {"id": "c1", "name": "Britney", "role": "admin"}
+    assert table.ids_for("role", "user") == ["c2"]
+    assert dataflow._object_ids["clients"] == {1: "c1", 2: "c2"}
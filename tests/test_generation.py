@@ -0,0 +1,126 @@
+import pytest
+from fastapi import FastAPI
+from fastapi import Request
+from fastapi.testclient import TestClient
+
+import webapi.data.dataflow as dataflow_module
+from webapi.data.cache_index import IndexedCache
+from webapi.data.dataflow import DataFlow
+from webapi.data.generation import CacheGeneration
+from webapi.data.generation import CacheGenerationMiddleware
+from webapi.data.generation import current_generation
+from webapi.data.generation import GENERATION_HEADER
+
+
+def make_tables(name="Britney"):
+    return {
+        "clients": IndexedCache.for_collection("clients", [{"id": "c1", "name": name}]),
+        "policies": IndexedCache.for_collection(
+            "policies", [{"id": "p1", "clientId": "c1", "amountInsured": 10.0}]
+        ),
+    }
+
+
+def test_prepare_builds_the_join():
+    generation = CacheGeneration(1, make_tables()).prepare()
+    assert generation.join.policy_ids_for_client("c1") == ["p1"]
+
+    generation.release()
+    assert generation.join is None
+    assert not generation.tables["clients"]._listeners
+
+
+@pytest.mark.asyncio
+async def test_publish_swaps_every_table_at_once():
+    dataflow = DataFlow(db_names=["clients", "policies"], database={}, client=None)
+    dataflow.start_cache()
+    published = []
+    dataflow.subscribe(published.append)
+
+    first = await dataflow.publish_generation(make_tables())
+    second = await dataflow.publish_generation(
+        {"clients": make_tables("Manning")["clients"]}
+    )
+
+    assert [generation.number for generation in published] == [1, 2]
+    assert dataflow.cache is second.tables
+    assert first.tables["clients"]["c1"]["name"] == "Britney"
+    assert second.tables["clients"]["c1"]["name"] == "Manning"
+    # Tables not reloaded are carried over to the new generation
+    assert second.tables["policies"] is first.tables["policies"]
+    assert first.join is None
+
+
+def test_requests_are_pinned_to_a_generation():
+    app = FastAPI()
+    generations = [CacheGeneration(1, make_tables())]
+    app.add_middleware(CacheGenerationMiddleware, get_generation=lambda: generations[0])
+
+    @app.get("/name")
+    async def name(request: Request):
+        generations[0] = CacheGeneration(2, make_tables("Manning"))
+        return current_generation.get().tables["clients"]["c1"]["name"]
+
+    client = TestClient(app)
+    response = client.get("/name")
+    assert response.json() == "Britney"
+    assert response.headers[GENERATION_HEADER] == "1"
+    assert client.get("/name").headers[GENERATION_HEADER] == "2"
+
+
+@pytest.mark.asyncio
+async def test_updates_do_not_change_a_pinned_generation():
+    dataflow = DataFlow(db_names=["clients", "policies"], database={}, client=None)
+    dataflow.start_cache()
+    pinned = await dataflow.publish_generation(make_tables())
+
+    dataflow.update_cache("clients", {"id": "c1", "name": "Manning"})
+    dataflow.update_cache("policies", {"id": "p2", "clientId": "c1"})
+    assert dataflow.generation is pinned
+    published = await dataflow.publish_pending()
+
+    assert published.number == pinned.number + 1
+    assert pinned.tables["clients"]["c1"]["name"] == "Britney"
+    assert pinned.tables["clients"].ids_for("name", "Manning") == []
+    assert "p2" not in pinned.tables["policies"]
+    assert published.tables["clients"].ids_for("name", "Manning") == ["c1"]
+    assert published.join.policy_ids_for_client("c1") == ["p1", "p2"]
+
+
+@pytest.mark.asyncio
+async def test_failed_publication_is_retried(monkeypatch):
+    dataflow = DataFlow(db_names=["clients", "policies"], database={}, client=None)
+    dataflow.start_cache()
+    await dataflow.publish_generation(make_tables())
+    prepare = dataflow._prepare_changes
+    calls = []
+
+    def fail_once(base, changes):
+        calls.append(changes)
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")
+        return prepare(base, changes)
+
+    monkeypatch.setattr(dataflow_module, "PUBLISH_RETRY_SECONDS", 0)
+    monkeypatch.setattr(dataflow, "_prepare_changes", fail_once)
+    dataflow.update_cache("clients", {"id": "c1", "name": "Manning"})
+    published = await dataflow.publish_pending()
+
+    assert len(calls) == 2
+    assert published.tables["clients"]["c1"]["name"] == "Manning"
+
+
+@pytest.mark.asyncio
+async def test_reload_supersedes_pending_changes():
+    dataflow = DataFlow(db_names=["clients", "policies"], database={}, client=None)
+    dataflow.start_cache()
+    await dataflow.publish_generation(make_tables())
+
+    dataflow._apply_document("clients", {"id": "c1", "name": "Spears"})
+    dataflow.update_cache("clients", {"id": "c2", "name": "Local"})
+    await dataflow.publish_generation(make_tables("Manning"), derive=False)
+    published = await dataflow.publish_pending()
+
+    # The refreshed document is older than the reload, the local update is not
+    assert published.tables["clients"]["c1"]["name"] == "Manning"
+    assert published.tables["clients"]["c2"]["name"] == "Local"
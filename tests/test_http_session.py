@@ -0,0 +1,75 @@
+import asyncio
+import gc
+import warnings
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+
+from webapi.data.http_session import HTTPSessionManager
+from webapi.data.json_handler import JSONData
+
+
+@asynccontextmanager
+async def upstream():
+    peers = set()
+
+    async def handler(request):
+        peers.add(request.transport.get_extra_info("peername"))
+        return web.json_response({"clients": [{"id": "c1"}]})
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}/", peers
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_fetches_share_one_pooled_connection():
+    sessions = HTTPSessionManager(limit_per_host=1)
+    async with upstream() as (url, peers):
+        first = await JSONData(url, sessions).fetch_data_from_json_url()
+        second = await JSONData(url, sessions).fetch_data_from_json_url()
+        stream = JSONData(url, sessions).stream_json_items("clients")
+        items = [item async for item in stream]
+
+        session = sessions.session()
+        await sessions.close()
+
+    assert first == second == {"clients": [{"id": "c1"}]}
+    assert items == [{"id": "c1"}]
+    # Every request went through the same keep-alive connection
+    assert len(peers) == 1
+    assert session.closed
+
+
+def test_session_of_a_finished_loop_is_released():
+    sessions = HTTPSessionManager()
+
+    async def open_session():
+        return sessions.session()
+
+    # Loops of their own, so the event loop of the other tests is left alone
+    first_loop, second_loop = asyncio.new_event_loop(), asyncio.new_event_loop()
+    try:
+        first = first_loop.run_until_complete(open_session())
+        first_loop.close()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", ResourceWarning)
+            second = second_loop.run_until_complete(open_session())
+            assert first.closed
+            del first
+            gc.collect()
+        assert not second.closed
+        second_loop.run_until_complete(sessions.close())
+        assert second.closed
+    finally:
+        first_loop.close()
+        second_loop.close()
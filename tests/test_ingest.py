@@ -0,0 +1,81 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from webapi.data.ingest import IngestPipeline
+from webapi.data.ingest import IngestSource
+from webapi.data.ingest import load_sources
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def insert_many(self, documents, ordered=True):
+        assert not ordered
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        self.documents.extend(documents)
+        return SimpleNamespace(inserted_ids=[None] * len(documents))
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+
+def write_payload(path, payload):
+    path.write_text(json.dumps(payload))
+    return str(path)
+
+
+@pytest.mark.asyncio
+async def test_pipeline_ingests_every_source(tmp_path):
+    clients = write_payload(
+        tmp_path / "clients.json",
+        {"clients": [{"id": f"c{i}"} for i in range(25)] + [{"name": "no id"}]},
+    )
+    partners = write_payload(
+        tmp_path / "partners.json", [{"id": f"x{i}"} for i in range(7)]
+    )
+    broken = write_payload(tmp_path / "broken.json", {"policies": {"id": "p1"}})
+    sources = [
+        IngestSource(clients, "clients", root_key="clients"),
+        IngestSource(partners, "partners", name="partner feed"),
+        IngestSource(broken, "policies", root_key="policies"),
+        IngestSource(str(tmp_path / "missing.json"), "policies", name="missing"),
+    ]
+    database = FakeDatabase()
+
+    report = await IngestPipeline(
+        database, batch_size=4, write_concurrency=2, queue_size=2
+    ).run(sources)
+
+    assert len(database["clients"].documents) == 25
+    assert len(database["partners"].documents) == 7
+    assert database["policies"].documents == []
+    assert database["clients"].max_in_flight <= 2
+    assert report["clients"]["written"] == 25
+    assert report["clients"]["invalid"] == 1
+    assert report["partner feed"]["parsed"] == 7
+    assert report["partner feed"]["records_per_second"] > 0
+    assert report["policies"]["errors"]
+    assert report["missing"]["errors"][0].startswith("fetch")
+
+
+def test_load_sources(tmp_path):
+    path = write_payload(
+        tmp_path / "sources.json",
+        [{"location": "https://partner.example/feed", "collection": "partners"}],
+    )
+    (source,) = load_sources(path)
+    assert source.is_url
+    assert source.name == "partners"
+    assert source.root_key is None
@@ -0,0 +1,59 @@
+from webapi.data.cache_index import IndexedCache
+from webapi.data.join_index import JoinIndex
+
+clients = [
+    {"id": "c1", "name": "Britney"},
+    {"id": "c2", "name": "Manning"},
+    {"id": "c3", "name": "Britney"},
+]
+policies = [
+    {"id": "p1", "clientId": "c1"},
+    {"id": "p2", "clientId": "c1"},
+    {"id": "p3", "clientId": "c3"},
+    {"id": "p4"},
+]
+
+
+def make_join():
+    return JoinIndex(
+        IndexedCache.for_collection("clients", clients),
+        IndexedCache.for_collection("policies", policies),
+    )
+
+
+def test_join_maps_both_directions():
+    join = make_join()
+    assert join.client_ids_for_name("Britney") == ["c1", "c3"]
+    assert join.policy_ids_for_client("c1") == ["p1", "p2"]
+    assert join.client_id_for_policy("p3") == "c3"
+    assert join.client_id_for_policy("p4") is None
+
+
+def test_join_follows_document_changes():
+    join = make_join()
+    join.policies.upsert({"id": "p2", "clientId": "c2"})
+    join.policies.upsert({"id": "p5", "clientId": "c2"})
+    join.policies.remove("p1")
+    join.clients.upsert({"id": "c3", "name": "Barnett"})
+
+    assert join.policy_ids_for_client("c1") == []
+    assert join.policy_ids_for_client("c2") == ["p2", "p5"]
+    assert join.client_ids_for_name("Britney") == ["c1"]
+    assert join.client_ids_for_name("Barnett") == ["c3"]
+    assert join._versions == (join.clients.version, join.policies.version)
+
+
+def test_join_rebuilds_after_table_rebuild():
+    join = make_join()
+    join.clients.rebuild([{"id": "c9", "name": "Britney"}])
+    assert join.client_ids_for_name("Britney") == ["c9"]
+
+
+def test_join_buckets_keep_insertion_order():
+    join = make_join()
+    for index in range(5, 10):
+        join.policies.upsert({"id": f"p{index}", "clientId": "c1"})
+    join.policies.remove("p6")
+    join.policies.upsert({"id": "p2", "clientId": "c1"})
+
+    assert join.policy_ids_for_client("c1") == ["p1", "p5", "p7", "p8", "p9", "p2"]
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from webapi.data.json_stream import iter_json_array
+from webapi.data.json_stream import JSONArrayStream
+
+payload = {
+    "meta": {"skipped": [1, 'a "]{" string', {"nested": None}]},
+    "count": 12345,
+    "clients": [
+        {"id": f"c{i}", "name": "Brïtney \\ ]", "amount": i * 1.5} for i in range(50)
+    ]
+    + [7, 123456, "text", None, [], {}],
+    "after": [1],
+}
+
+
+async def chunked(raw, size):
+    for start in range(0, len(raw), size):
+        yield raw[start : start + size]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [1, 3, 64, 1 << 20])
+async def test_items_are_parsed_across_chunks(size):
+    raw = json.dumps(payload, ensure_ascii=False).encode()
+    items = [item async for item in iter_json_array(chunked(raw, size), "clients")]
+    assert items == payload["clients"]
+
+
+@pytest.mark.asyncio
+async def test_top_level_array():
+    raw = b' [1, 22, {"a": [1]}] '
+    items = [item async for item in iter_json_array(chunked(raw, 1))]
+    assert items == [1, 22, {"a": [1]}]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "raw",
+    [
+        b'{"clients": [1, 2',
+        b'{"policies": []}',
+        b'{"clients": [1,, 2]}',
+        b'{"clients": [1 2]}',
+        b'{"clients": [1,]}',
+    ],
+)
+async def test_invalid_payloads_raise(raw):
+    with pytest.raises(ValueError):
+        [item async for item in iter_json_array(chunked(raw, 4), "clients")]
+
+
+@pytest.mark.parametrize(
+    "chunks, key, expected",
+    [
+        ([b"[3", b".5]"], None, [3.5]),
+        ([b"[-", b"2e", b"-3, 1", b"0]"], None, [-2e-3, 10]),
+        ([b'{"policies": [3e', b"10]}"], "policies", [3e10]),
+        ([b'{"count": 1.', b'5, "policies": [1E', b"+2]}"], "policies", [100.0]),
+    ],
+)
+def test_numbers_cut_by_chunk_boundaries(chunks, key, expected):
+    parser = JSONArrayStream(key)
+    items = [item for chunk in chunks for item in parser.feed(chunk)]
+    assert items + parser.feed(b"", final=True) == expected
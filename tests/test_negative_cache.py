@@ -0,0 +1,37 @@
+import time
+
+from webapi.data.negative_cache import NegativeCache
+
+
+def test_remembers_missing_keys_until_ttl(monkeypatch):
+    cache = NegativeCache(ttl=10)
+    cache.add("find_one:clients:{}")
+    assert cache.is_missing("find_one:clients:{}")
+    assert not cache.is_missing("other")
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert not cache.is_missing("find_one:clients:{}")
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used():
+    cache = NegativeCache(max_size=2)
+    cache.add("a")
+    cache.add("b")
+    assert cache.is_missing("a")
+    cache.add("c")
+    assert cache.is_missing("a")
+    assert not cache.is_missing("b")
+    assert cache.stats() == {"size": 2, "hits": 2}
+
+
+def test_invalidate_by_collection():
+    cache = NegativeCache()
+    cache.add("clients-name", collections=("clients", "policies"))
+    cache.add("policy-id", collections=("policies",))
+    cache.add("user-id", collections=("users",))
+
+    assert cache.invalidate("policies") == 2
+    assert cache.is_missing("user-id")
+    assert cache.invalidate() == 1
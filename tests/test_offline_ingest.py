@@ -0,0 +1,160 @@
+import asyncio
+import gzip
+import json
+import os
+import runpy
+import subprocess
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import webapi.data.offline_ingest as offline_ingest
+from webapi.data.offline_ingest import ingest
+from webapi.data.offline_ingest import read_python_literal
+from webapi.data.offline_ingest import read_records
+from webapi.data.snapshot import CacheSnapshot
+
+RAW_DATA = Path(__file__).parents[1] / "data" / "raw.py"
+
+
+class FakeCRUD:
+    def __init__(self, name):
+        self.collection = SimpleNamespace(name=name)
+        self.documents = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def insert_many(self, documents, ordered=False):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        self.documents.extend(documents)
+        return len(documents), []
+
+
+def test_python_literal_matches_the_module():
+    raw_data = runpy.run_path(str(RAW_DATA))["raw_data"]
+    expected = [
+        (name, document)
+        for name, documents in raw_data.items()
+        for document in documents
+    ]
+
+    assert list(read_python_literal(RAW_DATA)) == expected
+
+
+def test_python_literal_is_read_in_small_chunks(tmp_path, monkeypatch):
+    path = tmp_path / "raw.py"
+    path.write_text(
+        "# [ ,\n"
+        "raw_data = {  # {\n"
+        "    'clients': [{'id': 'a,]'}, {\"id\": \"\"\"b\n}\"\"\"}, ('c',)],  # ]\n"
+        "    'settings': {'ids': [1]},\n"
+        "    'policies': [None, {'id': 'p\\'1'},],\n"
+        "}\n"
+    )
+    expected = list(read_python_literal(path))
+    monkeypatch.setattr(offline_ingest, "CHUNK_SIZE", 3)
+
+    assert (
+        list(read_python_literal(path))
+        == expected
+        == [
+            ("clients", {"id": "a,]"}),
+            ("clients", {"id": "b\n}"}),
+            ("clients", ("c",)),
+            ("policies", None),
+            ("policies", {"id": "p'1"}),
+        ]
+    )
+    assert list(read_python_literal(path, ["policies"])) == expected[3:]
+
+
+def test_read_json_and_ndjson(tmp_path):
+    payload = tmp_path / "payload.json"
+    payload.write_text(
+        json.dumps({"policies": [{"id": "p1"}], "clients": [{"id": "c1"}]})
+    )
+    array = tmp_path / "array.json"
+    array.write_text(json.dumps([{"id": "x1"}]))
+    ndjson = tmp_path / "policies.ndjson.gz"
+    with gzip.open(ndjson, "wt") as file:
+        file.write('{"id": "p1"}\n\n{"id": "p2"}\n')
+
+    assert list(read_records(payload)) == [
+        ("clients", {"id": "c1"}),
+        ("policies", {"id": "p1"}),
+    ]
+    assert list(read_records(array, ["partners"])) == [("partners", {"id": "x1"})]
+    policies = [document["id"] for _, document in read_records(ndjson, ["policies"])]
+    assert policies == ["p1", "p2"]
+    with pytest.raises(ValueError):
+        read_records(ndjson)
+    with pytest.raises(ValueError):
+        list(read_records(array))
+
+
+@pytest.mark.asyncio
+async def test_ingest_to_snapshot(tmp_path):
+    ndjson = tmp_path / "policies.ndjson.gz"
+    with gzip.open(ndjson, "wt") as file:
+        for i in range(30):
+            file.write(json.dumps({"id": f"p{i}", "clientId": "c1"}) + "\n")
+        file.write('{"clientId": "c1"}\n')
+    path = tmp_path / "cache.snap"
+
+    summary = await ingest(
+        [str(ndjson)], "snapshot", str(path), ["policies"], batch_size=4
+    )
+
+    tables = CacheSnapshot(path).load()
+    assert len(tables["policies"]) == 30
+    assert summary["records"] == 31
+    assert summary["collections"]["policies"]["invalid"] == 1
+    assert summary["records_per_second"] > 0
+    assert summary["peak_rss"] > 0
+
+
+@pytest.mark.asyncio
+async def test_ingest_to_mongo_in_batches():
+    cruds = {}
+
+    def crud_factory(name):
+        cruds[name] = FakeCRUD(name)
+        return cruds[name]
+
+    summary = await ingest(
+        [str(RAW_DATA)],
+        "mongo",
+        batch_size=10,
+        max_in_flight=2,
+        crud_factory=crud_factory,
+    )
+
+    (crud,) = cruds.values()
+    assert len(crud.documents) == summary["collections"]["clients"]["written"] > 10
+    assert crud.max_in_flight == 2
+
+
+def test_snapshot_target_needs_no_database_settings(tmp_path):
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith(("DB_", "SECRET_KEY"))
+    }
+    env["PYTHONPATH"] = str(RAW_DATA.parents[1])
+    path = tmp_path / "cache.snap"
+
+    subprocess.run(
+        [sys.executable, "-m", "webapi.data.offline_ingest", str(RAW_DATA)]
+        + ["--to", "snapshot", "--snapshot", str(path)],
+        cwd=tmp_path,
+        env=env,
+        check=True,
+        capture_output=True,
+    )
+
+    assert len(CacheSnapshot(path).load()["clients"]) == 194
@@ -0,0 +1,111 @@
+import gzip
+import json
+
+import pytest
+from aiohttp import web
+
+from webapi.data.http_session import HTTPSessionManager
+from webapi.data.json_handler import JSONData
+from webapi.data.json_handler import NOT_MODIFIED
+from webapi.data.payload_store import PayloadStore
+
+url = "https://upstream.example/clients"
+
+
+def test_roundtrip_keeps_payload_and_validators(tmp_path):
+    store = PayloadStore(tmp_path)
+    store.save(url, b'{"clients": []}', etag='"v1"', last_modified="Mon, 01 Jan 2024")
+
+    assert store.load(url) == b'{"clients": []}'
+    assert store.validators(url) == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Mon, 01 Jan 2024",
+    }
+    assert store.load("https://upstream.example/policies") is None
+
+
+def test_payload_without_validators_is_not_stored(tmp_path):
+    store = PayloadStore(tmp_path)
+    store.save(url, b"[]")
+    assert store.validators(url) == {}
+    assert store.load(url) is None
+
+
+def test_discarded_writer_keeps_stored_payload(tmp_path):
+    store = PayloadStore(tmp_path)
+    store.save(url, b"[1]", etag='"v1"')
+    writer = store.writer(url, etag='"v2"')
+    writer.write(b"[2")
+    writer.discard()
+
+    assert store.load(url) == b"[1]"
+    assert store.validators(url) == {"If-None-Match": '"v1"'}
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == [".json", ".payload"]
+
+
+@pytest.mark.asyncio
+async def test_fetched_payload_is_streamed_to_the_store(tmp_path):
+    payload = {"clients": [{"id": f"c{i}"} for i in range(2000)]}
+    body = gzip.compress(json.dumps(payload).encode())
+
+    async def handler(request):
+        response = web.StreamResponse(
+            headers={"Content-Encoding": "gzip", "ETag": '"v1"'}
+        )
+        await response.prepare(request)
+        for start in range(0, len(body), 1000):
+            await response.write(body[start : start + 1000])
+        return response
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    upstream = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/"
+    sessions = HTTPSessionManager()
+    store = PayloadStore(tmp_path)
+    try:
+        fetched = await JSONData(upstream, sessions, store).fetch_data_from_json_url()
+    finally:
+        await sessions.close()
+        await runner.cleanup()
+
+    assert fetched == payload
+    assert json.loads(store.load(upstream)) == payload
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+@pytest.mark.asyncio
+async def test_conditional_fetch_skips_unchanged_payload(tmp_path):
+    payload = {"clients": [{"id": "c1"}]}
+    served = []
+
+    async def handler(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            served.append(304)
+            return web.Response(status=304)
+        served.append(200)
+        return web.Response(body=json.dumps(payload), headers={"ETag": '"v1"'})
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    upstream = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/"
+    sessions = HTTPSessionManager()
+    fetcher = JSONData(upstream, sessions, PayloadStore(tmp_path))
+    try:
+        first = await fetcher.fetch_data_from_json_url()
+        unchanged = await fetcher.fetch_data_from_json_url(if_modified=True)
+        stored = await fetcher.fetch_data_from_json_url()
+    finally:
+        await sessions.close()
+        await runner.cleanup()
+
+    assert served == [200, 304, 304]
+    assert first == stored == payload
+    assert unchanged is NOT_MODIFIED
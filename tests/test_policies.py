@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from webapi.data.cache import Namespace
+from webapi.data.cache_index import IndexedCache
+from webapi.data.reader import DataReader
+from webapi.data.reader import ReadMode
+from webapi.routers.policies import policies_stats_by_client
+
+clients = [{"id": "c1", "name": "Britney", "role": "admin"}]
+policies = [
+    {"id": f"p{index}", "amountInsured": 10.0, "clientId": "c1"} for index in range(20)
+]
+
+
+def make_request():
+    app = SimpleNamespace(
+        cache={
+            "clients": IndexedCache.for_collection("clients", clients),
+            "policies": IndexedCache.for_collection("policies", policies),
+        },
+        mongodb={},
+    )
+    app.reader = DataReader(app, mode=ReadMode.cache)
+    return SimpleNamespace(app=app)
+
+
+@pytest.mark.asyncio
+async def test_stats_from_the_cached_policies():
+    (totals,) = await policies_stats_by_client(make_request(), userId="c1")
+    assert totals.policies == 20
+    assert totals.totalAmountInsured == 200.0
+
+
+@pytest.mark.asyncio
+async def test_stats_refused_on_a_partially_evicted_cache():
+    request = make_request()
+    table = request.app.cache["policies"]
+    table.bind(Namespace("policies", max_bytes=1000))
+    assert 0 < len(table) < len(policies)
+
+    with pytest.raises(HTTPException) as error:
+        await policies_stats_by_client(request, userId="c1")
+    assert error.value.status_code == 503
@@ -0,0 +1,46 @@
+import pytest
+
+from webapi.data.cache_index import IndexedCache
+from webapi.data.predicate import compile_predicate
+
+rows = [
+    {"id": "1", "userId": 1, "amount": 10.0, "done": True, "title": "a"},
+    {"id": "2", "userId": 1, "amount": 25.5, "done": False, "title": "b"},
+    {"id": "3", "userId": 2, "amount": 40.0, "done": True},
+]
+
+
+def test_equality_is_typed_from_rows():
+    predicate = compile_predicate({"userId": "1", "done": "true"}, rows)
+    assert predicate.equalities == {"userId": 1, "done": True}
+    assert predicate.filter(rows) == [rows[0]]
+
+
+def test_untyped_equality():
+    assert compile_predicate({"userId": "1"}).filter(rows) == []
+    assert compile_predicate({}).filter(rows) == rows
+
+
+def test_missing_field_does_not_match():
+    assert compile_predicate({"title": "a"}, rows).filter(rows) == [rows[0]]
+    assert compile_predicate({"title": {"$in": ["a", "b"]}}, rows).filter(rows) == [
+        rows[0],
+        rows[1],
+    ]
+
+
+def test_range_and_in_operators():
+    predicate = compile_predicate(
+        {"amount": {"$gte": "10", "$lt": 40}, "userId": {"$in": ["1", "2"]}}, rows
+    )
+    assert predicate.filter(rows) == rows[:2]
+    assert compile_predicate({"amount": {"$gt": 25.5}}, rows).filter(rows) == [rows[2]]
+    with pytest.raises(ValueError):
+        compile_predicate({"amount": {"$regex": "1"}})
+
+
+def test_indexed_rows_use_index():
+    table = IndexedCache(rows, indexed_fields=("userId",))
+    predicate = compile_predicate({"userId": 2, "done": True})
+    assert predicate.filter(table) == [rows[2]]
+    assert compile_predicate({"userId": [1]}).filter(table) == []
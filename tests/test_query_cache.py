@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from webapi.data.query_cache import QueryCache
+
+
+def test_make_key_is_order_independent():
+    assert QueryCache.make_key("clients", {"a": 1, "b": 2}) == QueryCache.make_key(
+        "clients", {"b": 2, "a": 1}
+    )
+    assert QueryCache.make_key("clients", {"a": 1}) != QueryCache.make_key(
+        "policies", {"a": 1}
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_or_fetch_caches_results():
+    cache = QueryCache()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return [{"id": "1"}]
+
+    assert await cache.get_or_fetch("clients", {"name": "x"}, fetch) == [{"id": "1"}]
+    assert await cache.get_or_fetch("clients", {"name": "x"}, fetch) == [{"id": "1"}]
+    assert len(calls) == 1
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_and_ttl():
+    cache = QueryCache(max_size=2)
+    await cache.set("a", 1)
+    await cache.set("b", 2)
+    await cache.get("a")
+    await cache.set("c", 3)
+    assert await cache.get("b") is None
+    assert await cache.get("a") == 1
+
+    await cache.set("short", 4, ttl=0.01)
+    await asyncio.sleep(0.05)
+    assert await cache.get("short") is None
+
+
+@pytest.mark.asyncio
+async def test_invalidate_by_collection():
+    cache = QueryCache()
+    await cache.set("clients:1", 1, collections=("clients",))
+    await cache.set("lookup", 2, collections=("clients", "policies"))
+    await cache.set("policies:1", 3, collections=("policies",))
+
+    assert await cache.invalidate("policies") == 2
+    assert await cache.get("clients:1") == 1
+    assert await cache.get("lookup") is None
@@ -0,0 +1,158 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from webapi.backend.classes import Role
+from webapi.data.cache import estimate_size
+from webapi.data.cache import Namespace
+from webapi.data.cache_index import IndexedCache
+from webapi.data.negative_cache import NegativeCache
+from webapi.data.reader import DataReader
+from webapi.data.reader import ReadMode
+
+clients = [
+    {"id": "c1", "name": "Britney", "email": "britney@example.com", "role": "admin"},
+    {"id": "c2", "name": "Manning", "email": "manning@example.com", "role": "user"},
+]
+policies = [
+    {
+        "id": "p1",
+        "amountInsured": 10.0,
+        "clientId": "c1",
+        "inceptionDate": "2016-06-01T03:33:32Z",
+    },
+    {
+        "id": "p2",
+        "amountInsured": 20.0,
+        "clientId": "c1",
+        "inceptionDate": "2015-07-06T06:55:49Z",
+    },
+]
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.calls = 0
+
+    async def find_one(self, query):
+        self.calls += 1
+        return next(
+            (d for d in self.documents if all(d.get(k) == v for k, v in query.items())),
+            None,
+        )
+
+
+def make_app(mongo_clients=()):
+    return SimpleNamespace(
+        cache={
+            "clients": IndexedCache.for_collection("clients", clients),
+            "policies": IndexedCache.for_collection("policies", policies),
+        },
+        mongodb={"clients": FakeCollection(list(mongo_clients))},
+    )
+
+
+@pytest.mark.asyncio
+async def test_cache_mode_reads_from_cache():
+    app = make_app()
+    reader = DataReader(app, mode=ReadMode.cache)
+    assert await reader.find("clients", {"role": Role.user}) == [clients[1]]
+    assert await reader.find_one("clients", {"id": "missing"}) is None
+    assert app.mongodb["clients"].calls == 0
+
+
+@pytest.mark.asyncio
+async def test_fallback_mode_queries_mongo_on_miss():
+    extra = {"id": "c3", "name": "Barnett", "role": "user"}
+    app = make_app(mongo_clients=[extra])
+    reader = DataReader(app, mode=ReadMode.cache_with_mongo_fallback)
+    assert await reader.find_one("clients", {"id": "c1"}) == clients[0]
+    assert await reader.find_one("clients", {"id": "c3"}) == extra
+    assert app.mongodb["clients"].calls == 1
+
+
+@pytest.mark.asyncio
+async def test_stale_cache_is_not_used():
+    app = make_app(mongo_clients=clients)
+    reader = DataReader(app, mode=ReadMode.cache, max_age=1)
+    app.cache["clients"].refreshed_at -= 10
+    assert await reader.find_one("clients", {"id": "c2"}) == clients[1]
+    assert app.mongodb["clients"].calls == 1
+
+
+@pytest.mark.asyncio
+async def test_joins_from_cache():
+    reader = DataReader(make_app(), mode=ReadMode.cache)
+    assert await reader.policies_by_client_name("Britney") == policies
+    assert await reader.policies_by_client_name("Nobody") is None
+    assert await reader.clients_by_policy("p2") == [clients[0]]
+
+
+@pytest.mark.asyncio
+async def test_policy_scans_use_columns():
+    reader = DataReader(make_app(), mode=ReadMode.cache)
+    assert await reader.find("policies", {"amountInsured": 20.0}) == [policies[1]]
+    assert await reader.find("policies", {"id": "p1", "amountInsured": 20.0}) == []
+    # Narrowed by the client index, the date is then matched by its column
+    inception = datetime(2015, 7, 6, 6, 55, 49)
+    query = {"clientId": "c1", "inceptionDate": inception}
+    assert await reader.find("policies", query) == [policies[1]]
+    assert await reader.find("policies", {"id": "p2", **query}) == [policies[1]]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_mongo_reads_are_coalesced():
+    app = make_app(mongo_clients=clients)
+    reader = DataReader(app, mode=ReadMode.mongo)
+    results = await asyncio.gather(
+        *(reader.find_one("clients", {"id": "c2"}) for _ in range(3))
+    )
+    assert results == [clients[1]] * 3
+    assert app.mongodb["clients"].calls == 1
+    assert reader.single_flight.coalesced == 2
+
+
+@pytest.mark.asyncio
+async def test_missing_documents_are_negatively_cached():
+    app = make_app(mongo_clients=clients)
+    negative_cache = NegativeCache()
+    reader = DataReader(app, mode=ReadMode.mongo, negative_cache=negative_cache)
+
+    assert await reader.find_one("clients", {"id": "unknown"}) is None
+    assert await reader.find_one("clients", {"id": "unknown"}) is None
+    assert app.mongodb["clients"].calls == 1
+
+    negative_cache.invalidate("clients")
+    assert await reader.find_one("clients", {"id": "unknown"}) is None
+    assert app.mongodb["clients"].calls == 2
+
+
+@pytest.mark.asyncio
+async def test_incomplete_table_falls_back_to_mongo():
+    app = make_app(mongo_clients=clients)
+    table = app.cache["clients"]
+    table.bind(Namespace("clients", max_bytes=estimate_size(clients[1]) + 1))
+    reader = DataReader(app, mode=ReadMode.cache)
+
+    assert not table.complete
+    assert await reader.find_one("clients", {"id": "c2"}) == clients[1]
+    assert app.mongodb["clients"].calls == 0
+    assert await reader.find_one("clients", {"id": "c1"}) == clients[0]
+    assert app.mongodb["clients"].calls == 1
+    assert reader.cached_table("clients") is None
+
+
+@pytest.mark.asyncio
+async def test_lookups_follow_cache_updates():
+    app = make_app()
+    reader = DataReader(app, mode=ReadMode.cache)
+    assert await reader.policies_by_client_name("Manning") == []
+
+    new_policy = {"id": "p3", "amountInsured": 5.0, "clientId": "c2"}
+    app.cache["policies"].upsert(new_policy)
+    assert await reader.policies_by_client_name("Manning") == [new_policy]
+    assert await reader.clients_by_policy("p3") == [clients[1]]
+    assert await reader.clients_by_policy("missing") is None
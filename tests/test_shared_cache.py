@@ -0,0 +1,271 @@
+import asyncio
+import gc
+import os
+import struct
+import tempfile
+import threading
+
+import pytest
+from bson import ObjectId
+
+import webapi.data.shared_cache as shared_cache_module
+from webapi.data.cache_index import IndexedCache
+from webapi.data.columnar import PolicyColumns
+from webapi.data.dataflow import DataFlow
+from webapi.data.shared_cache import SharedCache
+from webapi.data.shared_cache import SharedTable
+
+clients = [
+    {"_id": ObjectId(), "id": "c1", "name": "Britney", "role": "admin"},
+    {"id": "c2", "name": "Manning", "role": "user"},
+]
+policies = [{"id": "p1", "amountInsured": 10.5, "clientId": "c1"}]
+
+
+@pytest.fixture
+def prefix():
+    prefix = f"webapi-test-{os.getpid()}"
+    yield prefix
+    # The lock file records the last generation of the loaders
+    lock_path = os.path.join(tempfile.gettempdir(), f"{prefix}.lock")
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
+
+
+@pytest.fixture
+def loader(prefix):
+    shared = SharedCache(prefix)
+    assert shared.acquire_loader()
+    yield shared
+    shared.close()
+
+
+def make_tables():
+    return {
+        "clients": IndexedCache.for_collection("clients", clients),
+        "policies": IndexedCache.for_collection("policies", policies),
+    }
+
+
+def test_worker_attaches_to_published_generation(loader, prefix):
+    loader.publish(make_tables())
+
+    worker = SharedCache(prefix)
+    tables = worker.attach()
+    try:
+        assert worker.generation == 1
+        assert tables["clients"]["c1"]["_id"] == str(clients[0]["_id"])
+        assert tables["clients"].lookup("role", "user") == [clients[1]]
+        assert tables["clients"].find({"name": "Britney", "role": "admin"})
+        assert tables["policies"].lookup("clientId", "c1") == policies
+        assert list(tables["clients"]) == ["c1", "c2"]
+        assert worker.attach() is None
+    finally:
+        del tables
+        worker.close()
+
+
+def test_worker_swaps_to_new_generation(loader, prefix):
+    published = make_tables()
+    loader.publish(published)
+    worker = SharedCache(prefix)
+    assert worker.attach() is not None
+
+    published["clients"].upsert({"id": "c3", "name": "Lucy", "role": "user"})
+    loader.publish(published)
+
+    tables = worker.attach()
+    try:
+        assert worker.generation == 2
+        assert len(tables["clients"]) == 3
+        assert tables["clients"].ids_for("role", "user") == ["c2", "c3"]
+    finally:
+        del tables
+        worker.close()
+
+
+def test_only_one_loader(loader, prefix):
+    assert not SharedCache(prefix).acquire_loader()
+
+
+def test_nothing_published(prefix):
+    worker = SharedCache(prefix)
+    assert worker.current() == (0, "")
+    assert worker.attach() is None
+
+
+@pytest.mark.asyncio
+async def test_changes_are_published_off_the_event_loop(loader, monkeypatch):
+    tables = make_tables()
+    loader.publish(tables)
+    publishing_threads = []
+    publish = loader.publish
+
+    def record_thread(tables):
+        publishing_threads.append(threading.get_ident())
+        return publish(tables)
+
+    monkeypatch.setattr(loader, "publish", record_thread)
+    task = asyncio.create_task(loader.publish_changes(lambda: tables, interval=0.01))
+    tables["clients"].upsert({"id": "c3", "name": "Lucy", "role": "user"})
+    while loader.generation < 2:
+        await asyncio.sleep(0.01)
+    task.cancel()
+
+    assert publishing_threads
+    assert threading.get_ident() not in publishing_threads
+
+
+@pytest.mark.asyncio
+async def test_follower_does_not_decode_documents(loader, prefix, monkeypatch):
+    loader.publish(make_tables())
+    decoded = []
+    get_document = SharedTable.__getitem__
+
+    def record_decode(table, key):
+        decoded.append(key)
+        return get_document(table, key)
+
+    monkeypatch.setattr(SharedTable, "__getitem__", record_decode)
+    worker = SharedCache(prefix)
+    dataflow = DataFlow(db_names=["clients", "policies"], database={}, client=None)
+    dataflow.start_cache()
+    try:
+        generation = await dataflow.publish_generation(worker.attach(), derive=False)
+        clients = generation.tables["clients"]
+        assert clients.ids_for("role", "admin") == ["c1"]
+        assert clients.ids_for("role", "nobody") == []
+        assert clients.values_for("role") == {"admin", "user"}
+        assert "c2" in clients and "c9" not in clients
+        assert len(generation.tables["policies"]) == 1
+        assert generation.join is None
+        assert decoded == []
+
+        assert clients.lookup("name", "Manning") == [clients["c2"]]
+        assert decoded == ["c2", "c2"]
+    finally:
+        del clients, generation, dataflow
+        # The data flow is in a reference cycle with its write-behind buffer
+        gc.collect()
+        worker.close()
+
+
+def test_restarted_loader_continues_the_numbering(loader, prefix):
+    loader.publish(make_tables())
+    worker = SharedCache(prefix)
+    assert worker.attach() is not None
+    loader.close()
+
+    restarted = SharedCache(prefix)
+    try:
+        assert restarted.acquire_loader()
+        assert restarted.generation == 1
+        restarted.publish(make_tables())
+        tables = worker.attach()
+        assert worker.generation == 2
+        assert tables["clients"]["c2"]["name"] == "Manning"
+    finally:
+        del tables
+        worker.close()
+        restarted.close()
+
+
+def test_half_written_control_is_not_waited_for(loader, prefix, monkeypatch):
+    loader.publish(make_tables())
+    monkeypatch.setattr(shared_cache_module, "CONTROL_WAIT", 0.01)
+    struct.pack_into("<Q", loader._control.buf, 0, 3)
+
+    worker = SharedCache(prefix)
+    try:
+        assert worker.current() == (0, "")
+    finally:
+        worker.close()
+
+
+@pytest.mark.asyncio
+async def test_follower_takes_over_from_an_exited_loader(loader, prefix):
+    loader.publish(make_tables())
+    follower = SharedCache(prefix)
+    assert follower.attach() is not None
+    elected = []
+    task = asyncio.create_task(
+        follower.follow(
+            lambda tables: None,
+            interval=0.01,
+            on_elected=lambda: elected.append(follower.generation),
+        )
+    )
+    await asyncio.sleep(0.05)
+    assert not task.done()
+
+    loader.close()
+    try:
+        await asyncio.wait_for(task, 1)
+        assert follower.is_loader
+        assert elected == [1]
+    finally:
+        follower.close()
+
+
+@pytest.mark.asyncio
+async def test_follower_prepares_generation_from_shared_structures(
+    loader, prefix, monkeypatch
+):
+    loader.publish(make_tables())
+    decoded = []
+    get_document = SharedTable.__getitem__
+
+    def record_decode(table, key):
+        decoded.append(key)
+        return get_document(table, key)
+
+    monkeypatch.setattr(SharedTable, "__getitem__", record_decode)
+    worker = SharedCache(prefix)
+    dataflow = DataFlow(db_names=["clients", "policies"], database={}, client=None)
+    dataflow.start_cache()
+    try:
+        generation = await dataflow.publish_generation(worker.attach())
+        columns = PolicyColumns.for_table(generation.tables["policies"])
+        assert generation.join.policy_ids_for_client("c1") == ["p1"]
+        assert generation.join.client_ids_for_name("Manning") == ["c2"]
+        assert columns.totals_by_client()[0]["totalAmountInsured"] == 10.5
+        assert decoded == []
+
+        assert columns.filter({"clientId": "c1"}) == policies
+        assert decoded == ["p1"]
+    finally:
+        del columns, generation, dataflow
+        # The loop holds the last wakeup, and with it the generation, until
+        # its next iteration
+        await asyncio.sleep(0)
+        gc.collect()
+        worker.close()
+
+
+@pytest.mark.asyncio
+async def test_followers_see_the_loader_refresh_time(loader, prefix):
+    tables = make_tables()
+    loader.publish(tables)
+    worker = SharedCache(prefix)
+    attached = worker.attach()
+    try:
+        assert attached["clients"].refreshed_at == pytest.approx(
+            tables["clients"].refreshed_at, abs=0.1
+        )
+
+        for table in tables.values():
+            table.refreshed_at += 30
+        task = asyncio.create_task(
+            loader.publish_changes(lambda: tables, interval=0.01)
+        )
+        await asyncio.sleep(0.05)
+        task.cancel()
+        assert worker.attach() is None
+        assert loader.generation == 1
+        assert attached["policies"].refreshed_at == pytest.approx(
+            tables["policies"].refreshed_at, abs=0.1
+        )
+    finally:
+        del attached
+        gc.collect()
+        worker.close()
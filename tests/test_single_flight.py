@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from webapi.data.single_flight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    runs = 0
+
+    async def fetch():
+        nonlocal runs
+        runs += 1
+        await asyncio.sleep(0.01)
+        return ["result"]
+
+    key = SingleFlight.make_key("find", "clients", {"role": "admin"})
+    results = await asyncio.gather(*(flight.do(key, fetch) for _ in range(5)))
+
+    assert runs == 1
+    assert all(result == ["result"] for result in results)
+    assert flight.stats() == {"calls": 1, "coalesced": 4, "in_flight": 0}
+
+    await flight.do(key, fetch)
+    assert runs == 2
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_caller():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("down")
+
+    results = await asyncio.gather(
+        flight.do("key", fetch), flight.do("key", fetch), return_exceptions=True
+    )
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+    assert flight.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_the_call():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return 1
+
+    first = asyncio.ensure_future(flight.do("key", fetch))
+    second = asyncio.ensure_future(flight.do("key", fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == 1
+
+
+def test_key_ignores_field_order():
+    assert SingleFlight.make_key("find", "c", {"a": 1, "b": 2}) == (
+        SingleFlight.make_key("find", "c", {"b": 2, "a": 1})
+    )
+    assert SingleFlight.make_key("find", "c", {}) != (
+        SingleFlight.make_key("find_one", "c", {})
+    )
@@ -0,0 +1,59 @@
+import time
+
+import pytest
+from bson import ObjectId
+
+from webapi.data.cache_index import IndexedCache
+from webapi.data.snapshot import CacheSnapshot
+from webapi.data.snapshot import SnapshotError
+
+clients = [
+    {"_id": ObjectId(), "id": "c1", "name": "Britney", "role": "admin"},
+    {"id": "c2", "name": "Manning", "role": "user"},
+]
+policies = [{"id": "p1", "amountInsured": 10.5, "clientId": "c1"}]
+
+
+@pytest.fixture
+def tables():
+    return {
+        "clients": IndexedCache.for_collection("clients", clients),
+        "policies": IndexedCache.for_collection("policies", policies),
+    }
+
+
+def test_roundtrip_keeps_documents_and_indexes(tmp_path, tables):
+    snapshot = CacheSnapshot(tmp_path / "cache.snapshot")
+    snapshot.dump(tables)
+
+    loaded = snapshot.load()
+    assert set(loaded) == {"clients", "policies"}
+    assert loaded["clients"]["c1"]["_id"] == str(clients[0]["_id"])
+    assert loaded["clients"].ids_for("role", "user") == ["c2"]
+    assert loaded["policies"].lookup("clientId", "c1") == policies
+
+
+def test_missing_snapshot(tmp_path):
+    assert CacheSnapshot(tmp_path / "missing").load() is None
+
+
+def test_stale_snapshot_is_refused(tmp_path, tables, monkeypatch):
+    snapshot = CacheSnapshot(tmp_path / "cache.snapshot", max_age=60)
+    snapshot.dump(tables)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    with pytest.raises(SnapshotError, match="stale"):
+        snapshot.read()
+
+
+def test_corrupt_snapshot_is_refused(tmp_path, tables):
+    path = tmp_path / "cache.snapshot"
+    CacheSnapshot(path).dump(tables)
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(bytes(data))
+    with pytest.raises(SnapshotError, match="checksum"):
+        CacheSnapshot(path).read()
+
+    path.write_bytes(bytes(data[:10]))
+    assert CacheSnapshot(path).load() is None
@@ -1,3 +1,6 @@
+import asyncio
+from types import SimpleNamespace
+
 import pytest
 
 from webapi.data.database import MongoDBAtlasCRUD
@@ -46,3 +49,56 @@ async def test_search_cached_data(json_data):
     result = await json_data.search_cached_data(test_url, search_params)
     assert isinstance(result, list)
     assert all(item["userId"] == int(search_params["userId"]) for item in result)
+
+
+class FakeCRUD:
+    def __init__(self):
+        self.collection = SimpleNamespace(name="policies")
+        self.batches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def insert_many(self, documents, ordered=False):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        self.batches.append(documents)
+        errors = [
+            (index, "duplicate key")
+            for index, document in enumerate(documents)
+            if document["id"] == "p3"
+        ]
+        return len(documents) - len(errors), errors
+
+
+@pytest.mark.asyncio
+async def test_store_json_data_inserts_in_bounded_batches():
+    crud = FakeCRUD()
+    data = [{"id": f"p{i}"} for i in range(5)] + ["invalid", {"id": "p6"}]
+    report = await JSONDataToMongoDB(crud, None).store_json_data(
+        data, batch_size=2, max_in_flight=2
+    )
+
+    assert report.inserted == 5
+    assert report.batches == 4
+    assert report.errors == [(3, "duplicate key"), (5, "Invalid data format")]
+    assert max(len(batch) for batch in crud.batches) == 2
+    assert crud.max_in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_store_json_stream_bounds_batches_in_flight():
+    crud = FakeCRUD()
+
+    async def documents():
+        for i in range(7):
+            yield {"id": f"p{i}"} if i != 5 else "invalid"
+
+    report = await JSONDataToMongoDB(crud, None).store_json_stream(
+        documents(), batch_size=2, max_in_flight=2
+    )
+
+    assert report.inserted == 5
+    assert report.errors == [(3, "duplicate key"), (5, "Invalid data format")]
+    assert crud.max_in_flight == 2
@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+from pymongo.errors import AutoReconnect
+from pymongo.errors import BulkWriteError
+
+from webapi.data.content_sync import content_hash
+from webapi.data.content_sync import CONTENT_HASH_FIELD
+from webapi.data.write_behind import WriteBehindBuffer
+
+
+class FakeResult:
+    def __init__(self, operations):
+        self.upserted_count = len(operations)
+        self.matched_count = 0
+
+
+class FakeCollection:
+    def __init__(self):
+        self.batches = []
+
+    async def bulk_write(self, operations, ordered=True):
+        assert not ordered
+        self.batches.append(operations)
+        return FakeResult(operations)
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_batched_upserts():
+    collection = FakeCollection()
+    buffer = WriteBehindBuffer({"clients": collection}, batch_size=2)
+    for index in range(5):
+        buffer.mark_dirty("clients", {"id": str(index), "name": "old"})
+    buffer.mark_dirty("clients", {"_id": "x", "id": "0", "name": "new"})
+    assert buffer.is_dirty("clients", "0")
+    assert buffer.pending_count == 5
+
+    assert await buffer.flush() == 5
+    assert [len(batch) for batch in collection.batches] == [2, 2, 1]
+    first = collection.batches[0][0]
+    assert first._filter == {"id": "0"}
+    assert first._doc["name"] == "new"
+    assert "_id" not in first._doc
+    assert first._upsert
+    assert buffer.pending_count == 0
+
+
+@pytest.mark.asyncio
+async def test_threshold_triggers_flush():
+    collection = FakeCollection()
+    buffer = WriteBehindBuffer({"policies": collection}, max_pending=2)
+    buffer.mark_dirty("policies", {"id": "1"})
+    buffer.mark_dirty("policies", {"id": "2"})
+    assert await buffer.drain() == 0
+    assert len(collection.batches) == 1
+
+
+class SlowCollection(FakeCollection):
+    def __init__(self):
+        super().__init__()
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def bulk_write(self, operations, ordered=True):
+        self.started.set()
+        await self.release.wait()
+        return await super().bulk_write(operations, ordered)
+
+
+@pytest.mark.asyncio
+async def test_in_flight_entries_stay_dirty_until_acknowledged():
+    collection = SlowCollection()
+    buffer = WriteBehindBuffer({"clients": collection})
+    buffer.mark_dirty("clients", {"id": "1"})
+    flush = asyncio.create_task(buffer.flush())
+    await collection.started.wait()
+
+    assert buffer.pending_count == 0
+    assert buffer.is_dirty("clients", "1")
+    collection.release.set()
+    assert await flush == 1
+    assert not buffer.is_dirty("clients", "1")
+
+
+@pytest.mark.asyncio
+async def test_interrupted_flush_requeues_unwritten_entries():
+    collection = SlowCollection()
+    buffer = WriteBehindBuffer({"clients": collection})
+    buffer.mark_dirty("clients", {"id": "1", "name": "old"})
+    buffer.mark_dirty("clients", {"id": "2", "name": "old"})
+    flush = asyncio.create_task(buffer.flush())
+    await collection.started.wait()
+    buffer.mark_dirty("clients", {"id": "2", "name": "new"})
+    flush.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await flush
+
+    assert buffer.pending_count == 2
+    collection.release.set()
+    assert await buffer.flush() == 2
+    names = {op._filter["id"]: op._doc["name"] for op in collection.batches[0]}
+    assert names == {"1": "old", "2": "new"}
+
+
+@pytest.mark.asyncio
+async def test_stopped_run_flushes_before_returning():
+    collection = FakeCollection()
+    buffer = WriteBehindBuffer({"clients": collection})
+    task = asyncio.create_task(buffer.run(interval=3600))
+    buffer.mark_dirty("clients", {"id": "1"})
+    buffer.stop()
+
+    await asyncio.wait_for(task, 1)
+    assert buffer.pending_count == 0
+    assert len(collection.batches) == 1
+
+
+class FailingCollection(FakeCollection):
+    def __init__(self, codes):
+        super().__init__()
+        # Error code of each failing document id, None for a connection error
+        self.codes = codes
+
+    async def bulk_write(self, operations, ordered=True):
+        self.batches.append(operations)
+        if None in self.codes.values():
+            raise AutoReconnect("connection closed")
+        errors = [
+            {"index": index, "code": self.codes[op._filter["id"]]}
+            for index, op in enumerate(operations)
+            if op._filter["id"] in self.codes
+        ]
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+        return FakeResult(operations)
+
+
+@pytest.mark.asyncio
+async def test_permanently_rejected_documents_are_dropped():
+    collection = FailingCollection({"1": 11000})
+    buffer = WriteBehindBuffer({"clients": collection})
+    buffer.mark_dirty("clients", {"id": "1"})
+    buffer.mark_dirty("clients", {"id": "2"})
+
+    assert await buffer.flush() == 1
+    assert buffer.pending_count == 0
+    assert buffer.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_transient_failures_are_retried_a_limited_number_of_times():
+    collection = FailingCollection({"1": None})
+    buffer = WriteBehindBuffer({"clients": collection}, max_retries=2)
+    buffer.mark_dirty("clients", {"id": "1"})
+
+    for _ in range(2):
+        assert await buffer.flush() == 0
+        assert buffer.is_dirty("clients", "1")
+    await buffer.flush()
+    assert not buffer.is_dirty("clients", "1")
+    assert buffer.dropped == 1
+    assert len(collection.batches) == 3
+
+
+@pytest.mark.asyncio
+async def test_new_version_resets_the_retries():
+    collection = FailingCollection({"1": 189})
+    buffer = WriteBehindBuffer({"clients": collection}, max_retries=1)
+    buffer.mark_dirty("clients", {"id": "1", "name": "old"})
+    await buffer.flush()
+    buffer.mark_dirty("clients", {"id": "1", "name": "new"})
+    await buffer.flush()
+
+    assert buffer.is_dirty("clients", "1")
+    assert buffer.dropped == 0
+
+
+@pytest.mark.asyncio
+async def test_upserts_keep_the_content_hash():
+    collection = FakeCollection()
+    buffer = WriteBehindBuffer({"clients": collection})
+    document = {"_id": "object-id", "id": "1", "name": "a"}
+    buffer.mark_dirty("clients", document)
+    await buffer.flush()
+
+    replacement = collection.batches[0][0]._doc
+    assert "_id" not in replacement
+    assert replacement[CONTENT_HASH_FIELD] == content_hash(document)
@@ -113,3 +113,34 @@ class PoliciesDB(PoliciesBase):
     """
 
     pass
+
+
+class ClientPortfolio(BaseModel):
+    """
+    Aggregated amount insured of the policies of a client
+    """
+
+    clientId: str = Field(...)
+    policies: int = Field(...)
+    totalAmountInsured: float = Field(...)
+    meanAmountInsured: float = Field(...)
+
+
+class InstallmentSummary(BaseModel):
+    """
+    Aggregated amount insured of the policies with a given installment flag
+    """
+
+    installmentPayment: bool = Field(...)
+    policies: int = Field(...)
+    totalAmountInsured: float = Field(...)
+
+
+class InceptionYearSummary(BaseModel):
+    """
+    Aggregated amount insured of the policies started in a given year
+    """
+
+    year: int = Field(...)
+    policies: int = Field(...)
+    totalAmountInsured: float = Field(...)
@@ -1,31 +1,507 @@
-from webapi.data.store_json import JSONDataToCache
+"""
+webapi/data/cache.py
+
+This module contains the memory-bounded cache container. The cache is split
+into namespaces (clients, policies, query results), each with its own byte
+budget and eviction policy. The memory of every entry is estimated when it is
+stored, so the size of the cache can be reported and kept under the budget.
+"""
+import heapq
+import itertools
+import math
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from webapi.logs.logger import app_logger
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Estimate the memory held by a value and the containers it references.
+    Objects referenced several times are counted once.
+
+    Args:
+        value: Value to measure, usually a document.
+
+    Returns:
+        int: Estimated size in bytes.
+    """
+    seen = set()
+    size = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+
+class CacheEntry:
+    """
+    Value stored in a namespace, with its size and access statistics.
+    """
+
+    __slots__ = ("value", "size", "expires_at", "hits")
+
+    def __init__(self, value: Any, size: int, expires_at: Optional[float]):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.hits = 0
+
+    def expired(self, now: float) -> bool:
+        return self.expires_at is not None and self.expires_at <= now
+
+
+class EvictionPolicy:
+    """
+    Chooses the entry evicted when a namespace is over its budget.
+    """
+
+    name = ""
+
+    def added(self, entries: "OrderedDict[Any, CacheEntry]", key: Any) -> None:
+        """
+        Record that an entry was stored.
+        """
+
+    def touch(self, entries: "OrderedDict[Any, CacheEntry]", key: Any) -> None:
+        """
+        Record an access to an entry.
+        """
+
+    def victim(self, entries: "OrderedDict[Any, CacheEntry]") -> Any:
+        """
+        Get the key of the entry to evict.
+        """
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evicts the least recently used entry.
+    """
+
+    name = "lru"
+
+    def touch(self, entries, key):
+        entries.move_to_end(key)
+
+    def victim(self, entries):
+        return next(iter(entries))
+
+
+class _HeapPolicy(EvictionPolicy):
+    """
+    Policy keeping candidates in a heap of (priority, sequence, key). Heap
+    items made outdated by later accesses are skipped when they surface.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def priority(self, entry: CacheEntry) -> Any:
+        raise NotImplementedError
+
+    def _push(self, entries, key):
+        entry = entries[key]
+        heapq.heappush(self._heap, (self.priority(entry), next(self._sequence), key))
+        if len(self._heap) > 2 * len(entries) + 64:
+            self._heap = [
+                (self.priority(entry), next(self._sequence), key)
+                for key, entry in entries.items()
+            ]
+            heapq.heapify(self._heap)
+
+    def added(self, entries, key):
+        self._push(entries, key)
+
+    def victim(self, entries):
+        while self._heap:
+            priority, _, key = self._heap[0]
+            entry = entries.get(key)
+            if entry is not None and self.priority(entry) == priority:
+                return key
+            heapq.heappop(self._heap)
+        return next(iter(entries))
+
+
+class LFUPolicy(_HeapPolicy):
+    """
+    Evicts the least frequently used entry, the oldest one on ties.
+    """
+
+    name = "lfu"
+
+    def priority(self, entry):
+        return entry.hits
+
+    def touch(self, entries, key):
+        self._push(entries, key)
+
+
+class TTLPolicy(_HeapPolicy):
+    """
+    Evicts the entry closest to expiring. Entries without a TTL go last.
+    """
+
+    name = "ttl"
+
+    def priority(self, entry):
+        return entry.expires_at if entry.expires_at is not None else math.inf
+
+
+EVICTION_POLICIES = {
+    policy.name: policy for policy in (LRUPolicy, LFUPolicy, TTLPolicy)
+}
+
+
+class Namespace(MutableMapping):
+    """
+    Part of the cache with its own byte budget and eviction policy. It can be
+    used as a dictionary; storing an entry evicts others until the namespace
+    fits its budget.
+
+    Reads never change the namespace, since it may hold the documents of a
+    published cache generation: they are recorded in an access log that the
+    eviction policy catches up with on the next write, and expired entries
+    are only hidden until `expire` or the budget evicts them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_bytes: int = 0,
+        policy: str = "lru",
+        ttl: Optional[float] = None,
+        on_evict: Optional[Callable[[Any, Any], None]] = None,
+    ):
+        """
+        Initialize the Namespace object.
+
+        Args:
+            name (str): Name of the namespace.
+            max_bytes (int): Byte budget. 0 means unlimited.
+            policy (str): Eviction policy, one of EVICTION_POLICIES.
+            ttl (Optional[float]): Default time to live of an entry in
+                seconds. None keeps entries until they are evicted.
+            on_evict: Called with the key and value of every evicted or
+                expired entry.
+
+        Raises:
+            ValueError: If the policy is unknown.
+        """
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(
+                f"Unknown eviction policy {policy}, "
+                f"expected one of {sorted(EVICTION_POLICIES)}"
+            )
+        self.name = name
+        self.max_bytes = max_bytes
+        self.policy = EVICTION_POLICIES[policy]()
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.size_bytes = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Any, CacheEntry]" = OrderedDict()
+        # Hits by key since the last write, the most recently read last
+        self._accessed: Dict[Any, int] = {}
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry.expired(time.monotonic()):
+            return default
+        self._accessed[key] = self._accessed.pop(key, 0) + 1
+        return entry.value
+
+    def peek(self, key: Any, default: Any = None) -> Any:
+        """
+        Get a value, even if it expired, without recording the access.
+
+        Args:
+            key: Entry key.
+            default: Value returned when there is no entry.
+
+        Returns:
+            The stored value or the default.
+        """
+        entry = self._entries.get(key)
+        return default if entry is None else entry.value
+
+    def _apply_accesses(self) -> None:
+        accessed, self._accessed = self._accessed, {}
+        for key, hits in accessed.items():
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.hits += hits
+                self.policy.touch(self._entries, key)
+
+    def expire(self) -> int:
+        """
+        Evict the expired entries.
+
+        Returns:
+            int: Number of entries evicted.
+        """
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if entry.expired(now)]
+        for key in expired:
+            self._evict(key)
+        return len(expired)
+
+    def items_by_use(self) -> List[Tuple[Any, Any]]:
+        """
+        Get the entries that have not expired, the least recently used first,
+        including the reads not applied yet. The namespace is not changed.
+
+        Returns:
+            List[Tuple[Any, Any]]: Keys and values.
+        """
+        now = time.monotonic()
+        accessed = dict(self._accessed)
+        keys = [key for key in self._entries if key not in accessed]
+        keys.extend(key for key in accessed if key in self._entries)
+        return [
+            (key, self._entries[key].value)
+            for key in keys
+            if not self._entries[key].expired(now)
+        ]
+
+    def expired_items(self) -> List[Tuple[Any, Any]]:
+        """
+        Get the expired entries not evicted yet. The namespace is not changed.
+
+        Returns:
+            List[Tuple[Any, Any]]: Keys and values.
+        """
+        now = time.monotonic()
+        return [
+            (key, entry.value)
+            for key, entry in self._entries.items()
+            if entry.expired(now)
+        ]
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Store a value, evicting other entries if the namespace is over its
+        budget. An entry larger than the whole budget is still stored, alone.
+
+        Args:
+            key: Entry key.
+            value: Value to store.
+            ttl (Optional[float]): Time to live in seconds. Defaults to the
+                namespace TTL.
+        """
+        ttl = ttl or self.ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._apply_accesses()
+        self._discard(key)
+        entry = CacheEntry(value, estimate_size(value), expires_at)
+        self._entries[key] = entry
+        self.size_bytes += entry.size
+        self.policy.added(self._entries, key)
+
+        if self.max_bytes:
+            while self.size_bytes > self.max_bytes and len(self._entries) > 1:
+                victim = self.policy.victim(self._entries)
+                if victim == key:
+                    # Keep the new entry, evict the oldest other one
+                    victim = next(k for k in self._entries if k != key)
+                self._evict(victim)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._accessed.clear()
+        self.size_bytes = 0
+        self.policy = type(self.policy)()
+
+    def _discard(self, key: Any) -> Optional[CacheEntry]:
+        entry = self._entries.pop(key, None)
+        self._accessed.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry.size
+        return entry
+
+    def _evict(self, key: Any) -> None:
+        entry = self._discard(key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, entry.value)
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Get the size and budget of the namespace.
+
+        Returns:
+            Dict[str, Any]: Namespace statistics.
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "policy": self.policy.name,
+            "evictions": self.evictions,
+        }
+
+    def __getitem__(self, key: Any) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: Any) -> None:
+        if self._discard(key) is None:
+            raise KeyError(key)
+
+    def __contains__(self, key: Any) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not entry.expired(time.monotonic())
+
+    def __iter__(self) -> Iterator[Any]:
+        now = time.monotonic()
+        return iter(
+            [key for key, entry in self._entries.items() if not entry.expired(now)]
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_MISSING = object()
+
+
+class NamespaceBackend:
+    """
+    aiocache-like asynchronous interface over a namespace, so it can be used
+    as the backend of the query cache.
+    """
+
+    def __init__(self, namespace: Namespace):
+        self.namespace = namespace
+
+    async def get(self, key: str) -> Any:
+        return self.namespace.get(key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.namespace.set(key, value, ttl=ttl)
+
+    async def delete(self, key: str) -> None:
+        self.namespace.pop(key, None)
+
+    async def clear(self) -> None:
+        self.namespace.clear()
 
 
 class Cache:
     """
-    Cache class for loading and storing data.
+    Memory-bounded cache made of namespaces with their own budget and
+    eviction policy.
     """
 
-    def __init__(self, db_url: str, db_name: str):
+    def __init__(self, default_policy: str = "lru"):
         """
         Initialize the Cache object.
 
         Args:
-            db_url (str): Database URL.
-            db_name (str): Database name.
+            default_policy (str): Eviction policy of the namespaces created
+                without one.
         """
-        self.db_url = db_url
-        self.db_name = db_name
-        self.cache = {}
+        self.default_policy = default_policy
+        self.namespaces: Dict[str, Namespace] = {}
 
-    async def load_data(self) -> dict:
+    def namespace(
+        self,
+        name: str,
+        max_bytes: int = 0,
+        policy: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> Namespace:
         """
-        Load data into the cache using JSONDataToCache.
+        Create a namespace, or get it if it exists.
+
+        Args:
+            name (str): Name of the namespace.
+            max_bytes (int): Byte budget. 0 means unlimited.
+            policy (Optional[str]): Eviction policy. Defaults to the cache
+                default policy.
+            ttl (Optional[float]): Default time to live of an entry.
 
         Returns:
-            dict: The cache containing the loaded data.
+            Namespace: The namespace.
+        """
+        if name not in self.namespaces:
+            self.namespaces[name] = Namespace(
+                name, max_bytes, policy or self.default_policy, ttl
+            )
+        return self.namespaces[name]
+
+    def renew(self, name: str) -> Namespace:
+        """
+        Replace a namespace by an empty one with the same budget, policy and
+        TTL. Whoever holds the previous namespace keeps its entries.
+
+        Args:
+            name (str): Name of the namespace.
+
+        Returns:
+            Namespace: The new namespace.
+        """
+        previous = self.namespace(name)
+        self.namespaces[name] = Namespace(
+            name, previous.max_bytes, previous.policy.name, previous.ttl
+        )
+        return self.namespaces[name]
+
+    def __getitem__(self, name: str) -> Namespace:
+        return self.namespace(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.namespaces
+
+    @property
+    def size_bytes(self) -> int:
+        """
+        Estimated memory held by every namespace.
+        """
+        return sum(namespace.size_bytes for namespace in self.namespaces.values())
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the size and budget of every namespace.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Statistics by namespace.
+        """
+        return {name: ns.report() for name, ns in self.namespaces.items()}
+
+    def log_report(self) -> None:
+        """
+        Log the size of every namespace.
         """
-        dataloader = JSONDataToCache(self.db_url)
-        await dataloader.load_data_to_cache(name=self.db_name)
-        self.cache = await dataloader.get_cache()
-        return self.cache
+        for name, report in self.report().items():
+            budget = report["max_bytes"] or "unlimited"
+            app_logger.info(
+                f"Cache {name}: {report['entries']} entries, "
+                f"{report['bytes']} bytes (budget {budget}, "
+                f"{report['policy']}, {report['evictions']} evictions)"
+            )
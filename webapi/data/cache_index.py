@@ -0,0 +1,424 @@
+"""
+webapi/data/cache_index.py
+
+This module contains the in-memory table used for the cached collections.
+It keeps the primary map of documents keyed by their id together with
+secondary indexes on the fields that are looked up most often.
+"""
+import time
+from collections.abc import Mapping
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Sequence
+from typing import Set
+
+from webapi.data.cache import Namespace
+from webapi.data.predicate import compile_predicate
+
+# Fields indexed for each cached collection
+CLIENT_INDEX_FIELDS = ("name", "email", "role")
+POLICY_INDEX_FIELDS = ("clientId", "email")
+
+INDEX_FIELDS = {
+    "clients": CLIENT_INDEX_FIELDS,
+    "policies": POLICY_INDEX_FIELDS,
+}
+
+
+class IndexedCache(Mapping):
+    """
+    Read-mostly table of documents keyed by their primary key, with secondary
+    indexes mapping field values to the keys of the documents holding them.
+
+    It behaves like the plain ``{id: document}`` dictionary the cache used to
+    be, so ``cache["clients"][client_id]`` keeps working.
+    """
+
+    def __init__(
+        self,
+        documents: Iterable[dict] = (),
+        indexed_fields: Sequence[str] = (),
+        key: str = "id",
+    ):
+        """
+        Initialize the IndexedCache object.
+
+        Args:
+            documents: Documents to load into the table.
+            indexed_fields: Fields to keep a secondary index for.
+            key: Field used as primary key.
+        """
+        self.key = key
+        self.indexed_fields = tuple(indexed_fields)
+        self._documents: Dict[Any, dict] = {}
+        # Buckets are dicts used as ordered sets: insertion order, O(1) removal
+        self._indexes: Dict[str, Dict[Any, Dict[Any, None]]] = {}
+        self.refreshed_at = 0.0
+        self.version = 0
+        # Documents evicted to keep the table within its memory budget
+        self.evicted = 0
+        self._listeners: List[Callable[[Any, Any, Any], None]] = []
+        self._derived: Dict[str, Any] = {}
+        self.rebuild(documents)
+
+    @classmethod
+    def for_collection(cls, db_name: str, documents: Iterable[dict] = ()):
+        """
+        Create an IndexedCache with the default indexes of a collection.
+
+        Args:
+            db_name: Name of the cached collection.
+            documents: Documents to load into the table.
+
+        Returns:
+            IndexedCache: The populated table.
+        """
+        return cls(documents, indexed_fields=INDEX_FIELDS.get(db_name, ()))
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]):
+        """
+        Restore a table saved with `to_state` without rebuilding its indexes.
+
+        Args:
+            state: Table state as returned by `to_state`. The documents may
+                also be a read-only ``{key: document}`` mapping, which is used
+                as the primary map as is, and likewise the indexes read-only
+                ``{value: keys}`` mappings.
+
+        Returns:
+            IndexedCache: The restored table.
+        """
+        table = cls(indexed_fields=state["indexed_fields"], key=state["key"])
+        documents = state["documents"]
+        if isinstance(documents, Mapping):
+            table._documents = documents
+        else:
+            table._documents = {document[table.key]: document for document in documents}
+        table._indexes = {
+            field: {value: dict.fromkeys(keys) for value, keys in index.items()}
+            if isinstance(index, dict)
+            else index
+            for field, index in state["indexes"].items()
+        }
+        return table
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        Get the documents and indexes of the table as plain containers.
+
+        Returns:
+            Dict[str, Any]: The table state.
+        """
+        return {
+            "key": self.key,
+            "indexed_fields": list(self.indexed_fields),
+            "documents": list(self._documents.values()),
+            "indexes": {
+                field: {value: list(keys) for value, keys in index.items()}
+                for field, index in self._indexes.items()
+            },
+        }
+
+    def copy(self) -> "IndexedCache":
+        """
+        Copy the table and its indexes, so the copy can be changed while the
+        original keeps being read. The documents themselves are shared.
+
+        The reads and expiries of a bound table, which never change the
+        table itself, are applied to the copy: its documents are ordered
+        from the least recently used and the expired ones are evicted.
+
+        Returns:
+            IndexedCache: The copy, not bound to any cache namespace.
+        """
+        table = type(self)(indexed_fields=self.indexed_fields, key=self.key)
+        expired = []
+        if isinstance(self._documents, Namespace):
+            table._documents = dict(self._documents.items_by_use())
+            expired = self._documents.expired_items()
+        else:
+            table._documents = dict(self._documents)
+        table._indexes = {
+            field: {value: dict(keys) for value, keys in index.items()}
+            for field, index in self._indexes.items()
+        }
+        table.refreshed_at = self.refreshed_at
+        table.version = self.version
+        table.evicted = self.evicted
+        for primary_key, document in expired:
+            table._on_evict(primary_key, document)
+        return table
+
+    def rebuild(self, documents: Iterable[dict]) -> None:
+        """
+        Replace the contents of the table and rebuild every index.
+
+        Args:
+            documents: Documents to load into the table.
+        """
+        primary = {document[self.key]: document for document in documents}
+        indexes = {field: {} for field in self.indexed_fields}
+        for primary_key, document in primary.items():
+            for field, index in indexes.items():
+                if field in document:
+                    index.setdefault(document[field], {})[primary_key] = None
+
+        self._indexes = indexes
+        self.evicted = 0
+        if isinstance(self._documents, Namespace):
+            self._documents.clear()
+            for primary_key, document in primary.items():
+                self._documents[primary_key] = document
+        else:
+            self._documents = primary
+        self.version += 1
+        self.mark_refreshed()
+
+    def bind(self, namespace: Namespace) -> None:
+        """
+        Keep the documents in a memory-bounded cache namespace. Documents
+        evicted by the namespace are removed from the indexes and counted in
+        `evicted`, after which the table no longer holds every document.
+
+        Args:
+            namespace (Namespace): Namespace holding the documents.
+        """
+        documents = dict(self._documents)
+        namespace.clear()
+        namespace.on_evict = self._on_evict
+        self._documents = namespace
+        self.evicted = 0
+        for primary_key, document in documents.items():
+            namespace[primary_key] = document
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether the table holds every document it was loaded with.
+        """
+        return not self.evicted
+
+    def _on_evict(self, primary_key: Any, document: dict) -> None:
+        self._unindex(primary_key, document)
+        self.evicted += 1
+        self.version += 1
+        self._notify(primary_key, document, None)
+
+    def upsert(self, document: dict) -> None:
+        """
+        Insert a document, or replace the one with the same primary key,
+        keeping the indexes up to date.
+
+        Args:
+            document: Document to store.
+        """
+        primary_key = document[self.key]
+        previous = self._stored(primary_key)
+        self._unindex(primary_key, previous)
+        self._documents[primary_key] = document
+        for field, index in self._indexes.items():
+            if field in document:
+                index.setdefault(document[field], {})[primary_key] = None
+        self.version += 1
+        self._notify(primary_key, previous, document)
+
+    def remove(self, primary_key: Any) -> bool:
+        """
+        Remove a document and its index entries.
+
+        Args:
+            primary_key: Primary key of the document.
+
+        Returns:
+            bool: True if the document was present.
+        """
+        previous = self._stored(primary_key)
+        if previous is None:
+            return False
+        self._unindex(primary_key, previous)
+        del self._documents[primary_key]
+        self.version += 1
+        self._notify(primary_key, previous, None)
+        return True
+
+    def subscribe(self, listener: Callable[[Any, Any, Any], None]) -> None:
+        """
+        Call a function after every change of a single document, with the
+        primary key, the previous document (or None) and the new document
+        (None when it was removed). Whole-table rebuilds are not notified,
+        listeners detect them from `version`.
+
+        Args:
+            listener: Function to call.
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[Any, Any, Any], None]) -> None:
+        """
+        Stop calling a function subscribed with `subscribe`.
+
+        Args:
+            listener: Function to remove.
+        """
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, primary_key: Any, previous: Any, document: Any) -> None:
+        for listener in self._listeners:
+            listener(primary_key, previous, document)
+
+    def mark_refreshed(self) -> None:
+        """
+        Record that the table has just been synchronised with its source.
+        """
+        self.refreshed_at = time.monotonic()
+
+    def _stored(self, primary_key: Any) -> Any:
+        # Expired documents are hidden from reads but still indexed
+        if isinstance(self._documents, Namespace):
+            return self._documents.peek(primary_key)
+        return self._documents.get(primary_key)
+
+    def _unindex(self, primary_key: Any, document: Any = None) -> None:
+        if document is None:
+            document = self._stored(primary_key)
+        if document is None:
+            return
+        for field, index in self._indexes.items():
+            if field not in document:
+                continue
+            keys = index.get(document[field])
+            if keys is None:
+                continue
+            keys.pop(primary_key, None)
+            if not keys:
+                del index[document[field]]
+
+    def ids_for(self, field: str, value: Any) -> List[Any]:
+        """
+        Get the primary keys of the documents whose field equals the value.
+
+        Args:
+            field: Indexed field name.
+            value: Value to look up.
+
+        Returns:
+            List: Primary keys of the matching documents.
+
+        Raises:
+            KeyError: If the field is not indexed.
+        """
+        if field == self.key:
+            return [value] if value in self._documents else []
+        return list(self._indexes[field].get(value, ()))
+
+    def lookup(self, field: str, value: Any) -> List[dict]:
+        """
+        Get the documents whose field equals the value using the indexes.
+
+        Args:
+            field: Indexed field name.
+            value: Value to look up.
+
+        Returns:
+            List[dict]: The matching documents.
+        """
+        # Expired documents stay indexed until the table is next copied
+        return [
+            self._documents[key]
+            for key in self.ids_for(field, value)
+            if key in self._documents
+        ]
+
+    def find(self, query: Dict[str, Any]) -> List[dict]:
+        """
+        Get the documents matching a query.
+
+        The most selective indexed equality of the query narrows the
+        candidates, the rest of the query is tested on those candidates only.
+
+        Args:
+            query: Search parameters, see `webapi.data.predicate`.
+
+        Returns:
+            List[dict]: The matching documents, in insertion order.
+        """
+        return compile_predicate(query).filter(self)
+
+    def derive(self, name: str, builder: Callable[["IndexedCache"], Any]) -> Any:
+        """
+        Get a structure computed from the table, such as an alternative
+        representation or an aggregate, rebuilding it only when the table
+        changed since it was last computed.
+
+        Args:
+            name: Name of the derived structure.
+            builder: Function computing the structure from the table.
+
+        Returns:
+            The derived structure.
+        """
+        version, value = self._derived.get(name, (None, None))
+        if version != self.version:
+            value = builder(self)
+            self._derived[name] = (self.version, value)
+        return value
+
+    def set_derived(self, name: str, value: Any) -> None:
+        """
+        Store a structure derived from the current version of the table that
+        was computed elsewhere, such as by another process, so `derive`
+        does not compute it again.
+
+        Args:
+            name: Name of the derived structure.
+            value: The derived structure.
+        """
+        self._derived[name] = (self.version, value)
+
+    def values_for(self, field: str) -> Set[Any]:
+        """
+        Get the distinct values of an indexed field.
+
+        Args:
+            field: Indexed field name.
+
+        Returns:
+            Set: Distinct values present in the table.
+        """
+        return set(self._indexes[field])
+
+    def is_indexed(self, field: str) -> bool:
+        """
+        Check whether a field can be looked up through an index.
+
+        Args:
+            field: Field name.
+
+        Returns:
+            bool: True if the field is the primary key or has an index.
+        """
+        return field == self.key or field in self._indexes
+
+    def __getitem__(self, key: Any) -> dict:
+        return self._documents[key]
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._documents
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._documents)
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(documents={len(self)}, "
+            f"indexed_fields={self.indexed_fields})"
+        )
@@ -0,0 +1,356 @@
+"""
+webapi/data/columnar.py
+
+This module contains the columnar representation of the cached policies.
+The filterable fields are stored as NumPy arrays so the policy filters run
+as vectorized masks instead of per-document comparisons.
+"""
+from datetime import datetime
+from datetime import timezone
+from itertools import compress
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+
+from webapi.data.cache_index import IndexedCache
+
+# Epoch value stored for policies without a valid inception date
+MISSING_DATE = np.iinfo(np.int64).min
+
+
+def to_epoch(value: Any) -> int:
+    """
+    Convert an inception date to seconds since the epoch. Naive dates are
+    taken as UTC.
+
+    Args:
+        value: ISO 8601 string or datetime.
+
+    Returns:
+        int: Seconds since the epoch, or MISSING_DATE if it cannot be parsed.
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return MISSING_DATE
+    if not isinstance(value, datetime):
+        return MISSING_DATE
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+class CodedColumn:
+    """
+    Column of strings stored as integer codes into a table of distinct values.
+    """
+
+    def __init__(self, values: Iterable[Any]):
+        self.codes_by_value: Dict[Any, int] = {}
+        codes = [
+            self.codes_by_value.setdefault(value, len(self.codes_by_value))
+            for value in values
+        ]
+        self.codes = np.array(codes, dtype=np.int32)
+        self.values = list(self.codes_by_value)
+
+    @classmethod
+    def from_codes(cls, codes: np.ndarray, values: Sequence[Any]) -> "CodedColumn":
+        """
+        Restore a column from its codes and its table of distinct values.
+        """
+        column = cls(())
+        column.codes = codes
+        column.values = list(values)
+        column.codes_by_value = {value: code for code, value in enumerate(values)}
+        return column
+
+    def code(self, value: Any) -> int:
+        """
+        Get the code of a value, or -1 if the column does not hold it.
+        """
+        return self.codes_by_value.get(value, -1)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class PolicyColumns:
+    """
+    Columnar view of the cached policies.
+    """
+
+    # Query fields that can be answered by a mask
+    FIELDS = (
+        "id",
+        "amountInsured",
+        "inceptionDate",
+        "installmentPayment",
+        "clientId",
+        "email",
+    )
+
+    def __init__(self, policies: Mapping[Any, dict]):
+        """
+        Initialize the PolicyColumns object.
+
+        Args:
+            policies (Mapping[Any, dict]): Policies by primary key, such as a
+                cached table, in the order results are returned. They are not
+                copied, so they must not change while the columns are used.
+        """
+        self.policies = policies
+        # Keys in column order, the table may be reordered by later reads
+        self.keys = list(policies)
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        documents = [policies[key] for key in self.keys]
+        self.amount = np.array(
+            [document.get("amountInsured", np.nan) for document in documents],
+            dtype=np.float64,
+        )
+        self.inception = np.array(
+            [to_epoch(document.get("inceptionDate")) for document in documents],
+            dtype=np.int64,
+        )
+        self.installment = np.array(
+            [bool(document.get("installmentPayment")) for document in documents],
+            dtype=bool,
+        )
+        self.client = CodedColumn(document.get("clientId") for document in documents)
+        self.email = CodedColumn(document.get("email") for document in documents)
+
+    @classmethod
+    def from_state(
+        cls,
+        policies: Mapping[Any, dict],
+        state: Dict[str, Any],
+        keys: Optional[Iterable[Any]] = None,
+        positions: Optional[Mapping[Any, int]] = None,
+    ) -> "PolicyColumns":
+        """
+        Restore columns saved with `to_state` without reading the policies.
+
+        Args:
+            policies (Mapping[Any, dict]): Policies the columns were built
+                from.
+            state (Dict[str, Any]): Columns as returned by `to_state`. The
+                arrays may be read-only views, such as of shared memory.
+            keys (Optional[Iterable[Any]]): Keys of the policies in column
+                order. Defaults to the keys of `policies`.
+            positions (Optional[Mapping[Any, int]]): Position of each key.
+                Defaults to a dictionary built from `keys`.
+
+        Returns:
+            PolicyColumns: The columns.
+        """
+        columns = cls.__new__(cls)
+        columns.policies = policies
+        columns.keys = list(policies) if keys is None else keys
+        columns.positions = (
+            {key: position for position, key in enumerate(columns.keys)}
+            if positions is None
+            else positions
+        )
+        columns.amount = state["amount"]
+        columns.inception = state["inception"]
+        columns.installment = state["installment"]
+        columns.client = CodedColumn.from_codes(*state["client"])
+        columns.email = CodedColumn.from_codes(*state["email"])
+        return columns
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        Get the arrays of the columns, and the distinct values of the coded
+        columns, to restore them with `from_state`.
+
+        Returns:
+            Dict[str, Any]: The columns.
+        """
+        return {
+            "amount": self.amount,
+            "inception": self.inception,
+            "installment": self.installment,
+            "client": (self.client.codes, self.client.values),
+            "email": (self.email.codes, self.email.values),
+        }
+
+    @classmethod
+    def for_table(cls, table: IndexedCache) -> "PolicyColumns":
+        """
+        Get the columns of a cached policies table, built once per version of
+        the table.
+
+        Args:
+            table (IndexedCache): Cached policies.
+
+        Returns:
+            PolicyColumns: The columns.
+        """
+        return table.derive("policy_columns", cls)
+
+    @classmethod
+    def supports(cls, query: Dict[str, Any]) -> bool:
+        """
+        Check whether every field of a query has a column.
+        """
+        return all(field in cls.FIELDS for field in query)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def mask(
+        self,
+        id: Optional[str] = None,
+        amountInsured: Optional[float] = None,
+        inceptionDate: Any = None,
+        installmentPayment: Optional[bool] = None,
+        clientId: Optional[str] = None,
+        email: Optional[str] = None,
+        positions: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Build the boolean mask of the policies matching every given filter.
+
+        Args:
+            id (Optional[str]): Policy ID.
+            amountInsured (Optional[float]): Amount insured.
+            inceptionDate: Inception date, as a datetime or ISO 8601 string.
+            installmentPayment (Optional[bool]): Installment payment flag.
+            clientId (Optional[str]): Client ID.
+            email (Optional[str]): Email.
+            positions (Optional[np.ndarray]): Positions of the policies to
+                test. Defaults to every policy.
+
+        Returns:
+            np.ndarray: One boolean per tested policy.
+        """
+
+        def column(values: np.ndarray) -> np.ndarray:
+            return values if positions is None else values[positions]
+
+        mask = np.ones(len(self) if positions is None else len(positions), dtype=bool)
+        if id is not None:
+            position = self.positions.get(id, -1)
+            if positions is None:
+                selected = np.zeros(len(self), dtype=bool)
+                if position >= 0:
+                    selected[position] = True
+            else:
+                selected = positions == position
+            mask &= selected
+        if amountInsured is not None:
+            mask &= column(self.amount) == amountInsured
+        if inceptionDate is not None:
+            mask &= column(self.inception) == to_epoch(inceptionDate)
+        if installmentPayment is not None:
+            mask &= column(self.installment) == bool(installmentPayment)
+        if clientId is not None:
+            mask &= column(self.client.codes) == self.client.code(clientId)
+        if email is not None:
+            mask &= column(self.email.codes) == self.email.code(email)
+        return mask
+
+    def filter(
+        self, query: Dict[str, Any], keys: Optional[Iterable[Any]] = None
+    ) -> List[dict]:
+        """
+        Get the policies matching an equality query.
+
+        Args:
+            query (Dict[str, Any]): Query using the fields in FIELDS.
+            keys (Optional[Iterable[Any]]): Primary keys of the candidate
+                policies, such as those found through an index. Defaults to
+                every policy.
+
+        Returns:
+            List[dict]: The matching policies.
+        """
+        if keys is None:
+            matching = compress(self.keys, self.mask(**query))
+            return [self.policies[key] for key in matching]
+        keys = [key for key in keys if key in self.positions]
+        positions = np.array([self.positions[key] for key in keys], dtype=np.intp)
+        matching = compress(keys, self.mask(positions=positions, **query))
+        return [self.policies[key] for key in matching]
+
+    def totals_by_client(self) -> List[Dict[str, Any]]:
+        """
+        Count the policies and sum and average the amount insured per client.
+
+        Returns:
+            List[Dict[str, Any]]: One entry per client ID.
+        """
+        amount = np.nan_to_num(self.amount)
+        counts = np.bincount(self.client.codes, minlength=len(self.client))
+        totals = np.bincount(
+            self.client.codes, weights=amount, minlength=len(self.client)
+        )
+        return [
+            {
+                "clientId": client_id,
+                "policies": int(count),
+                "totalAmountInsured": float(total),
+                "meanAmountInsured": float(total / count),
+            }
+            for client_id, count, total in zip(self.client.values, counts, totals)
+            if count and client_id is not None
+        ]
+
+    def totals_by_installment(self) -> List[Dict[str, Any]]:
+        """
+        Count the policies and sum the amount insured per installment flag.
+
+        Returns:
+            List[Dict[str, Any]]: One entry per installment flag present.
+        """
+        flags = self.installment.astype(np.int64)
+        counts = np.bincount(flags, minlength=2)
+        totals = np.bincount(flags, weights=np.nan_to_num(self.amount), minlength=2)
+        return [
+            {
+                "installmentPayment": bool(flag),
+                "policies": int(counts[flag]),
+                "totalAmountInsured": float(totals[flag]),
+            }
+            for flag in (0, 1)
+            if counts[flag]
+        ]
+
+    def totals_by_inception_year(self) -> List[Dict[str, Any]]:
+        """
+        Count the policies and sum the amount insured per inception year.
+        Policies without a valid inception date are left out.
+
+        Returns:
+            List[Dict[str, Any]]: One entry per year, in ascending order.
+        """
+        valid = self.inception != MISSING_DATE
+        years = (
+            self.inception[valid]
+            .astype("datetime64[s]")
+            .astype("datetime64[Y]")
+            .astype(np.int64)
+            + 1970
+        )
+        distinct, groups = np.unique(years, return_inverse=True)
+        counts = np.bincount(groups, minlength=len(distinct))
+        totals = np.bincount(
+            groups,
+            weights=np.nan_to_num(self.amount[valid]),
+            minlength=len(distinct),
+        )
+        return [
+            {
+                "year": int(year),
+                "policies": int(count),
+                "totalAmountInsured": float(total),
+            }
+            for year, count, total in zip(distinct, counts, totals)
+        ]
@@ -0,0 +1,337 @@
+"""
+webapi/data/compression.py
+
+This module contains the compressed transport of the upstream fetches and of
+the API responses.
+
+Upstream payloads are requested with every encoding available here (gzip,
+deflate, and zstd when the optional `zstandard` package is installed) and
+decoded chunk by chunk as they arrive, so the streaming readers keep working
+on compressed payloads.
+
+API responses are compressed by `CompressionMiddleware` with the encoding the
+client prefers in its Accept-Encoding header. Responses smaller than a
+minimum size, such as the authentication ones, are sent as they are.
+"""
+import zlib
+from typing import AsyncIterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+
+import aiohttp
+from starlette.datastructures import Headers
+from starlette.datastructures import MutableHeaders
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd is not offered without it
+    zstandard = None
+
+# Supported encodings by order of preference
+ENCODINGS = (("zstd",) if zstandard is not None else ()) + ("gzip", "deflate")
+ACCEPT_ENCODING = ", ".join(ENCODINGS)
+
+# Media types of the responses worth compressing
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "text/")
+
+_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class _DeflateDecoder:
+    """
+    Decoder of the deflate encoding. It is meant to be zlib-wrapped, but some
+    servers send a raw deflate stream.
+    """
+
+    def __init__(self):
+        self._decoder = zlib.decompressobj()
+        self._started = False
+
+    def decompress(self, data: bytes) -> bytes:
+        if not self._started and data:
+            self._started = True
+            try:
+                return self._decoder.decompress(data)
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data)
+
+    def flush(self) -> bytes:
+        return self._decoder.flush()
+
+
+def _decoder(encoding: str):
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return _DeflateDecoder()
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _compressor(encoding: str, level: int):
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.compressobj(level)
+    return zstandard.ZstdCompressor().compressobj()
+
+
+class StreamDecoder:
+    """
+    Incremental decoder of a body sent with a Content-Encoding.
+    """
+
+    def __init__(self, content_encoding: Optional[str]):
+        """
+        Initialize the StreamDecoder object.
+
+        Args:
+            content_encoding (Optional[str]): Content-Encoding header of the
+                body, None or "identity" if it is not encoded.
+
+        Raises:
+            ValueError: If an encoding is not supported.
+        """
+        encodings = [
+            encoding.strip().lower()
+            for encoding in (content_encoding or "").split(",")
+            if encoding.strip().lower() not in ("", "identity")
+        ]
+        unsupported = [encoding for encoding in encodings if encoding not in ENCODINGS]
+        if unsupported:
+            raise ValueError(f"Unsupported content encoding {', '.join(unsupported)}")
+        # The encodings are listed in the order they were applied
+        self._decoders = [_decoder(encoding) for encoding in reversed(encodings)]
+
+    def decode(self, chunk: bytes) -> bytes:
+        """
+        Decode the next chunk of the body.
+
+        Args:
+            chunk (bytes): Encoded chunk.
+
+        Returns:
+            bytes: The decoded bytes available so far, possibly none.
+
+        Raises:
+            ValueError: If the body is corrupt.
+        """
+        try:
+            for decoder in self._decoders:
+                chunk = decoder.decompress(chunk)
+        except _ERRORS as e:
+            raise ValueError(f"Invalid compressed body: {e}") from e
+        return chunk
+
+    def flush(self) -> bytes:
+        """
+        Decode what is left once the whole body was read.
+
+        Returns:
+            bytes: The last decoded bytes.
+        """
+        data = b""
+        try:
+            for decoder in self._decoders:
+                # A zstd decoder refuses any input after the end of its frame
+                data = (decoder.decompress(data) if data else b"") + decoder.flush()
+        except _ERRORS as e:
+            raise ValueError(f"Invalid compressed body: {e}") from e
+        return data
+
+
+async def iter_decoded(
+    response: aiohttp.ClientResponse, chunk_size: int = 2**16
+) -> AsyncIterator[bytes]:
+    """
+    Read the body of a response chunk by chunk, decoding its
+    Content-Encoding. The session must not decompress it already, see
+    `HTTPSessionManager`.
+
+    Args:
+        response (aiohttp.ClientResponse): Response to read.
+        chunk_size (int): Maximum number of encoded bytes read at a time.
+
+    Yields:
+        bytes: Decoded chunks.
+
+    Raises:
+        ValueError: If the encoding is not supported or the body is corrupt.
+    """
+    decoder = StreamDecoder(response.headers.get("Content-Encoding"))
+    async for chunk in response.content.iter_chunked(chunk_size):
+        if data := decoder.decode(chunk):
+            yield data
+    if data := decoder.flush():
+        yield data
+
+
+async def read_decoded(response: aiohttp.ClientResponse) -> bytes:
+    """
+    Read the whole body of a response, decoding its Content-Encoding.
+
+    Args:
+        response (aiohttp.ClientResponse): Response to read.
+
+    Returns:
+        bytes: Decoded body.
+    """
+    return b"".join([chunk async for chunk in iter_decoded(response)])
+
+
+def negotiate(
+    accept_encoding: str, encodings: Sequence[str] = ENCODINGS
+) -> Optional[str]:
+    """
+    Choose the encoding of a response from the Accept-Encoding header of its
+    request: the one with the highest quality, then the first of `encodings`.
+
+    Args:
+        accept_encoding (str): Accept-Encoding header.
+        encodings (Sequence[str]): Supported encodings by order of preference.
+
+    Returns:
+        Optional[str]: The encoding, or None to send the response as it is.
+    """
+    qualities = {}
+    for part in accept_encoding.split(","):
+        name, *parameters = part.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            qualities[name.strip().lower()] = quality
+
+    chosen, best = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best:
+            chosen, best = encoding, quality
+    return chosen
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing the responses with the encoding negotiated
+    from the Accept-Encoding header of the request.
+    """
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = 1024,
+        level: int = 6,
+        encodings: Sequence[str] = ENCODINGS,
+    ):
+        """
+        Initialize the CompressionMiddleware object.
+
+        Args:
+            app: ASGI application.
+            minimum_size (int): Size in bytes under which a response is sent
+                uncompressed.
+            level (int): Compression level of gzip and deflate, from 1 to 9.
+            encodings (Sequence[str]): Encodings offered, by order of
+                preference.
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.encodings = [encoding for encoding in encodings if encoding in ENCODINGS]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(
+            Headers(scope=scope).get("accept-encoding", ""), self.encodings
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        response = _CompressedResponse(send, encoding, self.minimum_size, self.level)
+        await self.app(scope, receive, response.send)
+
+
+class _CompressedResponse:
+    """
+    Compresses the messages of one response on their way out. The body is
+    held back until it reaches the minimum size, or ends before it.
+    """
+
+    def __init__(self, send, encoding: str, minimum_size: int, level: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.level = level
+        self.start = None
+        self.passthrough = False
+        self.compressor = None
+        self.pending: List[bytes] = []
+        self.pending_size = 0
+
+    async def send(self, message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self.passthrough = (
+                message["status"] < 200
+                or message["status"] in (204, 304)
+                or "content-encoding" in headers
+                or "no-transform" in headers.get("cache-control", "")
+                or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+            )
+            if self.passthrough:
+                await self._send(message)
+            else:
+                self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is not None:
+            data = self.compressor.compress(body)
+            if not more_body:
+                data += self.compressor.flush()
+            await self._send(
+                {"type": "http.response.body", "body": data, "more_body": more_body}
+            )
+            return
+
+        self.pending.append(body)
+        self.pending_size += len(body)
+        if more_body and self.pending_size < self.minimum_size:
+            return
+        body, self.pending = b"".join(self.pending), []
+        headers = MutableHeaders(scope=self.start)
+        headers.add_vary_header("Accept-Encoding")
+        if self.pending_size < self.minimum_size:
+            # Too small for the compression to pay off
+            self.passthrough = True
+            await self._send(self.start)
+            await self._send({"type": "http.response.body", "body": body})
+            return
+
+        self.compressor = _compressor(self.encoding, self.level)
+        data = self.compressor.compress(body)
+        headers["Content-Encoding"] = self.encoding
+        if more_body:
+            # The compressed size is not known until the end
+            del headers["Content-Length"]
+        else:
+            data += self.compressor.flush()
+            headers["Content-Length"] = str(len(data))
+        await self._send(self.start)
+        await self._send(
+            {"type": "http.response.body", "body": data, "more_body": more_body}
+        )
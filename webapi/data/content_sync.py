@@ -0,0 +1,197 @@
+"""
+webapi/data/content_sync.py
+
+This module contains the idempotent synchronisation of a MongoDB collection
+with a set of upstream documents. Every stored document carries a hash of its
+content; a sync compares the hash of each upstream document with the stored
+one and only writes the documents that are new or changed, then deletes the
+ones that vanished upstream. Re-ingesting an unchanged dataset costs a hash
+pass and no writes.
+"""
+import hashlib
+import json
+from typing import Any
+from typing import AsyncIterable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+from typing import Union
+
+from pymongo import DeleteMany
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from pymongo.errors import PyMongoError
+
+from webapi.logs.logger import app_logger
+
+# Field holding the content hash of a stored document
+CONTENT_HASH_FIELD = "_contentHash"
+
+
+def content_hash(document: dict) -> str:
+    """
+    Compute a stable hash of the content of a document. The key order, the
+    MongoDB `_id` and the stored hash itself do not change it.
+
+    Args:
+        document (dict): Document to hash.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    content = {
+        field: value
+        for field, value in document.items()
+        if field not in ("_id", CONTENT_HASH_FIELD)
+    }
+    encoded = json.dumps(
+        content, sort_keys=True, separators=(",", ":"), default=str
+    ).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+class SyncReport:
+    """
+    Outcome of a sync: how many documents were written, left alone or
+    deleted, and why the others failed.
+    """
+
+    def __init__(self):
+        # Documents written, new or changed
+        self.upserted = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.batches = 0
+        # (document key, error message)
+        self.errors: List[Tuple[Any, str]] = []
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(upserted={self.upserted}, "
+            f"unchanged={self.unchanged}, deleted={self.deleted}, "
+            f"failed={len(self.errors)}, batches={self.batches})"
+        )
+
+
+class ContentSync:
+    """
+    Synchronises a MongoDB collection with upstream documents using content
+    hashes.
+    """
+
+    def __init__(self, collection, key: str = "id", batch_size: int = 1000):
+        """
+        Initialize the ContentSync object.
+
+        Args:
+            collection: Asynchronous MongoDB collection to synchronise.
+            key (str): Field identifying a document.
+            batch_size (int): Maximum number of operations per `bulk_write`.
+        """
+        self.collection = collection
+        self.key = key
+        self.batch_size = batch_size
+
+    async def stored_hashes(self) -> Dict[Any, str]:
+        """
+        Read the content hash of every stored document.
+
+        Returns:
+            Dict[Any, str]: Hash by document key. Documents stored without a
+            hash map to an empty string, so they are rewritten.
+        """
+        cursor = self.collection.find(
+            {}, projection={"_id": 0, self.key: 1, CONTENT_HASH_FIELD: 1}
+        )
+        return {
+            document[self.key]: document.get(CONTENT_HASH_FIELD, "")
+            async for document in cursor
+            if self.key in document
+        }
+
+    async def sync(
+        self, documents: Union[Iterable[dict], AsyncIterable[dict]]
+    ) -> SyncReport:
+        """
+        Upsert the new and changed documents and delete the stored documents
+        missing from `documents`, in unordered `bulk_write` batches.
+
+        Args:
+            documents: Every upstream document of the collection, as a list
+                or an asynchronous stream.
+
+        Returns:
+            SyncReport: Outcome of the sync.
+        """
+        report = SyncReport()
+        stored = await self.stored_hashes()
+        seen = set()
+        batch = []
+        keys = []
+
+        async for document in _iterate(documents):
+            if not isinstance(document, dict) or self.key not in document:
+                report.errors.append((None, f"Document without {self.key}"))
+                continue
+            key = document[self.key]
+            seen.add(key)
+            digest = content_hash(document)
+            if stored.get(key) == digest:
+                report.unchanged += 1
+                continue
+            replacement = {
+                field: value for field, value in document.items() if field != "_id"
+            }
+            replacement[CONTENT_HASH_FIELD] = digest
+            batch.append(ReplaceOne({self.key: key}, replacement, upsert=True))
+            keys.append(key)
+            if len(batch) >= self.batch_size:
+                await self._write(batch, keys, report)
+                batch, keys = [], []
+        if batch:
+            await self._write(batch, keys, report)
+
+        vanished = [key for key in stored if key not in seen]
+        for start in range(0, len(vanished), self.batch_size):
+            keys = vanished[start : start + self.batch_size]
+            await self._write(
+                [DeleteMany({self.key: {"$in": keys}})], [tuple(keys)], report
+            )
+
+        name = getattr(self.collection, "name", "")
+        app_logger.info(f"Synced {name}: {report}")
+        if report.errors:
+            app_logger.error(
+                f"Error syncing {len(report.errors)} {name} documents: "
+                f"{report.errors[:1]}"
+            )
+        return report
+
+    async def _write(self, operations: list, keys: list, report: SyncReport) -> None:
+        # keys[i] identifies the documents of operations[i] in the report
+        report.batches += 1
+        try:
+            result = await self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            details = e.details
+            for error in details.get("writeErrors", []):
+                report.errors.append((keys[error["index"]], error.get("errmsg", "")))
+            report.upserted += details.get("nUpserted", 0) + details.get("nMatched", 0)
+            report.deleted += details.get("nRemoved", 0)
+            return
+        except PyMongoError as e:
+            app_logger.error(f"Error syncing documents: {e}")
+            report.errors.extend((key, str(e)) for key in keys)
+            return
+        report.upserted += result.upserted_count + result.matched_count
+        report.deleted += result.deleted_count
+
+
+async def _iterate(documents: Union[Iterable[dict], AsyncIterable[dict]]):
+    if hasattr(documents, "__aiter__"):
+        async for document in documents:
+            yield document
+    else:
+        for document in documents:
+            yield document
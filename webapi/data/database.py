@@ -1,8 +1,12 @@
 """
 webapi/data/database.py
 """
+from typing import List
+from typing import Tuple
+
 from decouple import config
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
 from pymongo.errors import PyMongoError
 
 from webapi.logs.logger import app_logger
@@ -107,6 +111,35 @@ class MongoDBAtlasCRUD:
             app_logger.error(f"Error inserting document: {e}")
             raise
 
+    async def insert_many(
+        self, documents: List[dict], ordered: bool = False
+    ) -> Tuple[int, List[Tuple[int, str]]]:
+        """
+        Inserts documents into the collection in a single round trip. With an
+        unordered insert, a document that fails does not stop the others.
+
+        Args:
+            documents (List[dict]): The documents to be inserted.
+            ordered (bool): Stop at the first failing document.
+
+        Returns:
+            Tuple[int, List[Tuple[int, str]]]: The number of inserted
+            documents, and the position and error message of every document
+            that could not be inserted.
+        """
+        try:
+            result = await self.collection.insert_many(documents, ordered=ordered)
+            return len(result.inserted_ids), []
+        except BulkWriteError as e:
+            errors = [
+                (error["index"], error.get("errmsg", ""))
+                for error in e.details.get("writeErrors", [])
+            ]
+            return e.details.get("nInserted", 0), errors
+        except Exception as e:
+            app_logger.error(f"Error inserting documents: {e}")
+            raise
+
     async def find_one(self, query):
         """
         Find a single document in the collection based on a query.
@@ -1,16 +1,89 @@
+import asyncio
+from typing import Any
+from typing import AsyncIterator
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+from pymongo.errors import PyMongoError
+
+from webapi.data.cache_index import IndexedCache
+from webapi.data.content_sync import CONTENT_HASH_FIELD
+from webapi.data.content_sync import ContentSync
+from webapi.data.content_sync import SyncReport
 from webapi.data.database import MongoDBAtlasCRUD
+from webapi.data.generation import CacheGeneration
+from webapi.data.ingest import IngestPipeline
+from webapi.data.ingest import IngestSource
 from webapi.data.json_handler import JSONData
-from webapi.data.store_json import JSONDataToCache
+from webapi.data.json_handler import NOT_MODIFIED
+from webapi.data.negative_cache import negative_cache
+from webapi.data.single_flight import SingleFlight
+from webapi.data.snapshot import CacheSnapshot
 from webapi.data.store_json import JSONDataToMongoDB
+from webapi.data.write_behind import WriteBehindBuffer
 from webapi.logs.logger import app_logger
+from webapi.logs.logger import log_duration
+
+# Seconds before publishing cache changes again after a failure
+PUBLISH_RETRY_SECONDS = 1
+
+# Fields of the documents used by the API, loaded by `load_cache_from_database`
+CACHE_FIELDS = {
+    "clients": ("id", "name", "email", "role"),
+    "policies": (
+        "id",
+        "amountInsured",
+        "email",
+        "inceptionDate",
+        "installmentPayment",
+        "clientId",
+    ),
+}
 
 
 class DataFlow:
-    def __init__(self, db_names, database, client):
+    def __init__(
+        self,
+        db_names,
+        database,
+        client,
+        query_cache=None,
+        single_flight=None,
+        memory=None,
+    ):
         self.db_names = db_names
         self.database = database
         self.client = client
+        self.query_cache = query_cache
+        # Memory-bounded Cache holding the documents of the cached tables
+        self.memory = memory
+        # Coalesces concurrent loads of the same collection
+        self.single_flight = single_flight or SingleFlight()
         self.data_handler = None
+        self.cache = {}
+        self.generation = CacheGeneration(0, self.cache)
+        self._generation_listeners: List[Callable[[CacheGeneration], None]] = []
+        # Changes made since the last publication, by table: the new version
+        # of each changed document, or None if it was removed. They are
+        # published together as the next generation, see `_change`
+        self._draft: Dict[str, Dict[Any, Optional[dict]]] = {}
+        # Changes of the generation being prepared
+        self._publishing: Dict[str, Dict[Any, Optional[dict]]] = {}
+        self._draft_task: Optional[asyncio.Task] = None
+        # MongoDB _id -> cache key of the documents seen by the refresher,
+        # needed to apply change stream deletes
+        self._object_ids: Dict[str, Dict[Any, Any]] = {}
+        # Watermark field and value recorded before loading a collection,
+        # where the refresher starts polling from
+        self._watermarks: Dict[str, Tuple[str, Any]] = {}
+        self.write_behind = WriteBehindBuffer(
+            database, on_flush=self._invalidate_queries
+        )
 
     async def check_database(self, db_name: str) -> int:
         try:
@@ -22,56 +95,757 @@ class DataFlow:
             app_logger.error(f"Error checking database {db_name}: {e}")
             raise
 
-    async def load_cache(self, url: str, db_name: str) -> dict:
+    async def load_cache(self, url: str, db_name: str) -> IndexedCache:
         try:
-            data_handler = JSONDataToCache(url)
-            app_logger.info(f"Loading {db_name} into cache")
-            data = await data_handler.load_data_to_cache(db_name)
-            return {d["id"]: d for d in data}
+            return await self.sync_collection(url, db_name)
         except Exception as e:
             app_logger.error(f"Error loading cache for {db_name}: {e}")
             raise
 
+    async def fetch_collection(
+        self, url: str, db_name: str, if_modified: bool = False
+    ) -> Optional[List[dict]]:
+        """
+        Fetch the upstream documents of a collection. Concurrent fetches of
+        the same URL share a single request.
+
+        Args:
+            url (str): URL of the upstream JSON payload.
+            db_name (str): Key of the documents in the payload.
+            if_modified (bool): Return None instead of the documents when the
+                payload did not change since it was last stored.
+
+        Returns:
+            Optional[List[dict]]: The documents, or None if not modified.
+
+        Raises:
+            ValueError: If the payload could not be fetched.
+        """
+
+        async def fetch():
+            with log_duration(f"Fetching {url}"):
+                return await JSONData(url).fetch_data_from_json_url(
+                    if_modified=if_modified
+                )
+
+        # Keyed on the URL only, so a payload holding several collections is
+        # fetched once for all of them
+        operation = "fetch_if_modified" if if_modified else "fetch"
+        data = await self.single_flight.do(
+            SingleFlight.make_key(operation, url, {}), fetch
+        )
+        if data is NOT_MODIFIED:
+            return None
+        if data is None:
+            raise ValueError(f"No upstream data for {db_name} at {url}")
+        return data[db_name]
+
+    def build_cache(self, db_name: str, documents: List[dict]) -> IndexedCache:
+        """
+        Build the cached table of a collection from its documents.
+
+        Args:
+            db_name (str): Name of the collection.
+            documents (List[dict]): Documents of the collection.
+
+        Returns:
+            IndexedCache: The table.
+        """
+        with log_duration(f"Building {db_name} cache"):
+            return self._bind(db_name, IndexedCache.for_collection(db_name, documents))
+
+    async def store_documents(
+        self, db_name: str, documents: List[dict], url: str = None
+    ) -> None:
+        """
+        Insert documents into a MongoDB collection. The documents are copied
+        so the `_id` added by MongoDB does not leak into the cache.
+
+        Args:
+            db_name (str): Name of the collection.
+            documents (List[dict]): Documents to insert.
+            url (str): Upstream URL of the documents.
+        """
+        with log_duration(f"Filling {db_name}"):
+            async with MongoDBAtlasCRUD(collection_name=db_name) as mongodb_crud:
+                self.data_handler = JSONDataToMongoDB(mongodb_crud, url)
+                await self.data_handler.store_json_data(
+                    [dict(document) for document in documents]
+                )
+
+    async def sync_documents(
+        self, db_name: str, documents: Union[List[dict], AsyncIterator[dict]]
+    ) -> SyncReport:
+        """
+        Make a MongoDB collection hold exactly the given documents, writing
+        only the new and changed ones and deleting the vanished ones. See
+        `webapi.data.content_sync`.
+
+        Args:
+            db_name (str): Name of the collection.
+            documents: Every upstream document of the collection.
+
+        Returns:
+            SyncReport: Outcome of the sync.
+        """
+        with log_duration(f"Syncing {db_name}"):
+            report = await ContentSync(self.database[db_name]).sync(documents)
+        if report.upserted or report.deleted:
+            await self._invalidate_queries(db_name)
+        return report
+
+    async def sync_collection(
+        self,
+        url: str,
+        db_name: str,
+        fill: bool = False,
+        if_modified: bool = False,
+        idempotent: bool = False,
+    ) -> Optional[IndexedCache]:
+        """
+        Fetch the upstream payload of a collection once and fan it out to the
+        cache build and, if requested, the MongoDB fill, which run
+        concurrently. The table is built in a thread so the event loop keeps
+        serving while it is indexed.
+
+        Args:
+            url (str): URL of the upstream JSON payload.
+            db_name (str): Name of the collection.
+            fill (bool): Also insert the documents into MongoDB.
+            if_modified (bool): Skip the build and the fill when the payload
+                did not change since it was last stored.
+            idempotent (bool): Fill with `sync_documents` instead of inserting
+                every document.
+
+        Returns:
+            Optional[IndexedCache]: The cached table, or None if the payload
+            was not modified.
+        """
+        documents = await self.fetch_collection(url, db_name, if_modified)
+        if documents is None:
+            app_logger.info(f"Upstream {db_name} not modified, keeping the cache")
+            return None
+        stages = [asyncio.to_thread(self.build_cache, db_name, documents)]
+        if fill and idempotent:
+            stages.append(self.sync_documents(db_name, documents))
+        elif fill:
+            stages.append(self.store_documents(db_name, documents, url))
+        table, *_ = await asyncio.gather(*stages)
+        return table
+
+    async def stream_collection(
+        self, url: str, db_name: str, fill: bool = False, idempotent: bool = False
+    ) -> IndexedCache:
+        """
+        Stream the upstream documents of a collection into the cache and, if
+        requested, into MongoDB. The payload is parsed as it arrives and each
+        document goes to the cached table and the MongoDB batch writer as soon
+        as it is complete, so the payload is never held in memory as a whole.
+
+        Args:
+            url (str): URL of the upstream JSON payload.
+            db_name (str): Key of the documents in the payload.
+            fill (bool): Also insert the documents into MongoDB.
+            idempotent (bool): Fill with `sync_documents` instead of inserting
+                every document.
+
+        Returns:
+            IndexedCache: The cached table.
+        """
+        table = self._bind(db_name, IndexedCache.for_collection(db_name))
+
+        async def documents():
+            async for document in JSONData(url).stream_json_items(db_name):
+                if isinstance(document, dict) and table.key in document:
+                    table.upsert(document)
+                # The copy keeps the _id added by MongoDB out of the cache
+                yield dict(document) if isinstance(document, dict) else document
+
+        with log_duration(f"Streaming {db_name} from {url}"):
+            if fill and idempotent:
+                await self.sync_documents(db_name, documents())
+            elif fill:
+                async with MongoDBAtlasCRUD(collection_name=db_name) as mongodb_crud:
+                    self.data_handler = JSONDataToMongoDB(mongodb_crud, url)
+                    await self.data_handler.store_json_stream(documents())
+            else:
+                async for _ in documents():
+                    pass
+
+        table.mark_refreshed()
+        app_logger.info(f"Loaded {len(table)} {db_name} documents into cache")
+        return table
+
     def start_cache(self):
         app_logger.info("Starting cache")
-        return {db_name: "" for db_name in self.db_names}
+        self.cache = {db_name: "" for db_name in self.db_names}
+        self.generation = CacheGeneration(0, self.cache)
+        return self.cache
+
+    def subscribe(self, listener: Callable[[CacheGeneration], None]) -> None:
+        """
+        Call a function with every published cache generation.
+
+        Args:
+            listener: Function to call.
+        """
+        self._generation_listeners.append(listener)
+
+    def publish(self, tables: Dict[str, Any]) -> CacheGeneration:
+        """
+        Prepare a new cache generation from the given tables, completed with
+        the current tables of the other collections, and make it current.
+        Preparing the generation builds its derived structures, so call it
+        from a thread, or use `publish_generation`.
+
+        Args:
+            tables (Dict[str, Any]): New tables by name.
+
+        Returns:
+            CacheGeneration: The published generation.
+        """
+        generation = self._prepare({**self.cache, **tables})
+        self._drop_changes(tables)
+        return self._swap(generation)
+
+    async def publish_generation(
+        self, tables: Dict[str, Any], derive: bool = True
+    ) -> CacheGeneration:
+        """
+        Prepare a new cache generation in a thread and make it current with a
+        single reference swap on the event loop.
+
+        Args:
+            tables (Dict[str, Any]): New tables by name.
+            derive (bool): Build the derived structures of the generation
+                before publishing it. Without it they are built on first use.
 
-    def dump_cache_into_database(self):
-        # Method not implemented
-        pass
+        Returns:
+            CacheGeneration: The published generation.
+        """
+        reloaded = tables
+        tables = {**self.cache, **tables}
+        if derive:
+            generation = await asyncio.to_thread(self._prepare, tables)
+        else:
+            generation = CacheGeneration(self.generation.number + 1, tables)
+        self._drop_changes(reloaded)
+        return self._swap(generation)
 
-    def update_cache_from_database(self):
-        # Method not implemented
-        pass
+    def _prepare(self, tables: Dict[str, Any]) -> CacheGeneration:
+        with log_duration("Preparing cache generation"):
+            return CacheGeneration(self.generation.number + 1, tables).prepare()
 
-    async def fill_database(self, url: str, db_name: str) -> None:
+    def _swap(self, generation: CacheGeneration) -> CacheGeneration:
+        previous, self.generation = self.generation, generation
+        self.cache = generation.tables
+        for listener in self._generation_listeners:
+            listener(generation)
+        previous.release()
+        app_logger.info(f"Published cache generation {generation.number}")
+        return generation
+
+    async def publish_pending(self) -> CacheGeneration:
+        """
+        Wait until the changes made through `update_cache` and the cache
+        refresher are published.
+
+        Returns:
+            CacheGeneration: The current generation.
+        """
+        while self._draft_task is not None:
+            await asyncio.shield(self._draft_task)
+        return self.generation
+
+    async def _publish_drafts(self, delay: float = 0) -> None:
+        await asyncio.sleep(delay)
+        failed = False
         try:
-            json_url = JSONData(url)
-            data = await json_url.fetch_data_from_json_url()
+            while self._draft:
+                # Changes made in the same loop iteration join the generation
+                await asyncio.sleep(0)
+                self._publishing, self._draft = self._draft, {}
+                base = self.cache
+                generation = await asyncio.to_thread(
+                    self._prepare_changes, base, self._publishing
+                )
+                if self.cache is not base:
+                    # A reload was published meanwhile, apply the changes
+                    # again on top of it
+                    self._draft = self._merge_changes(self._publishing, self._draft)
+                    self._publishing = {}
+                    self._drop_changes(
+                        {
+                            db_name: table
+                            for db_name, table in self.cache.items()
+                            if base.get(db_name) is not table
+                        }
+                    )
+                    continue
+                for db_name in self._publishing:
+                    # Refreshes marked on the base table while preparing
+                    generation.tables[db_name].refreshed_at = max(
+                        generation.tables[db_name].refreshed_at,
+                        getattr(base.get(db_name), "refreshed_at", 0.0),
+                    )
+                self._swap(generation)
+        except Exception as e:
+            app_logger.error(f"Error publishing cache changes: {e}")
+            failed = True
+            # The newer changes win over these
+            self._draft = self._merge_changes(self._publishing, self._draft)
+        finally:
+            self._publishing = {}
+            self._draft_task = None
+        if failed and self._draft:
+            self._schedule_publish(delay=PUBLISH_RETRY_SECONDS)
 
-            async with MongoDBAtlasCRUD(collection_name=db_name) as mongodb_crud:
-                self.data_handler = JSONDataToMongoDB(mongodb_crud, url)
-                await self.data_handler.store_json_data(data[db_name])
+    def _schedule_publish(self, delay: float = 0) -> None:
+        if self._draft_task is None:
+            self._draft_task = asyncio.create_task(
+                self._publish_drafts(delay), name="cache-publisher"
+            )
+
+    def _prepare_changes(
+        self, base: Dict[str, Any], changes: Dict[str, Dict[Any, Optional[dict]]]
+    ) -> CacheGeneration:
+        """
+        Copy the changed tables of a generation, apply the changes to the
+        copies and prepare the next generation with them. It runs in a
+        thread, copying and binding a large table takes seconds.
+        """
+        tables = {}
+        for db_name, documents in changes.items():
+            current = base.get(db_name)
+            if isinstance(current, IndexedCache):
+                table = current.copy()
+            else:
+                table = IndexedCache.for_collection(db_name)
+            self._bind(db_name, table)
+            for primary_key, document in documents.items():
+                if document is None:
+                    table.remove(primary_key)
+                else:
+                    table.upsert(document)
+            tables[db_name] = table
+        with log_duration("Preparing cache generation"):
+            return CacheGeneration(
+                self.generation.number + 1, {**base, **tables}
+            ).prepare()
+
+    @staticmethod
+    def _merge_changes(
+        older: Dict[str, Dict[Any, Optional[dict]]],
+        newer: Dict[str, Dict[Any, Optional[dict]]],
+    ) -> Dict[str, Dict[Any, Optional[dict]]]:
+        return {
+            db_name: {**older.get(db_name, {}), **newer.get(db_name, {})}
+            for db_name in {**older, **newer}
+        }
+
+    def _drop_changes(self, tables: Dict[str, Any]) -> None:
+        """
+        Drop the pending changes of tables replaced by a reload, which holds
+        a newer version of the collection. Documents updated through
+        `update_cache` and not written to MongoDB yet are newer than any
+        reload and are kept.
+        """
+        for db_name in tables:
+            changes = self._draft.get(db_name)
+            if not changes:
+                continue
+            kept = {
+                primary_key: document
+                for primary_key, document in changes.items()
+                if self.write_behind.is_dirty(db_name, primary_key)
+            }
+            if len(kept) < len(changes):
+                app_logger.info(
+                    f"Dropped {len(changes) - len(kept)} {db_name} changes "
+                    f"superseded by a reload"
+                )
+            if kept:
+                self._draft[db_name] = kept
+            else:
+                del self._draft[db_name]
+
+    def _change(self, db_name: str, primary_key: Any, document: Optional[dict]) -> None:
+        """
+        Record a change of a cached document, published with the next
+        generation. Published generations are never changed in place: the
+        changed tables are copied, changed and published together with a
+        single swap, off the event loop.
+        """
+        self._draft.setdefault(db_name, {})[primary_key] = document
+        self._schedule_publish()
+
+    def load_snapshot(self, snapshot: CacheSnapshot) -> bool:
+        """
+        Publish a cache generation from a snapshot file.
 
+        Args:
+            snapshot (CacheSnapshot): Snapshot to read.
+
+        Returns:
+            bool: True if the snapshot was fresh, valid and held every cached
+            collection.
+        """
+        tables = snapshot.load()
+        if not tables:
+            return False
+        missing = [db_name for db_name in self.db_names if db_name not in tables]
+        if missing:
+            app_logger.warning(f"Cache snapshot has no {missing} tables, ignoring it")
+            return False
+
+        self.publish(
+            {db_name: self._bind(db_name, table) for db_name, table in tables.items()}
+        )
+        return True
+
+    def save_snapshot(self, snapshot: CacheSnapshot) -> None:
+        """
+        Write the cached tables and their indexes to a snapshot file.
+
+        Args:
+            snapshot (CacheSnapshot): Snapshot to write.
+        """
+        try:
+            snapshot.dump(self.cache)
+        except Exception as e:
+            app_logger.error(f"Error saving cache snapshot: {e}")
+
+    def update_cache(self, db_name: str, document: dict) -> None:
+        """
+        Store a document in the cache and queue it to be written to MongoDB
+        by `dump_cache_into_database`. The document is served once the next
+        cache generation is published, see `publish_pending`.
+
+        Args:
+            db_name (str): Name of the collection and of the cached table.
+            document (dict): Document to store.
+        """
+        self._change(db_name, document[self._table_key(db_name)], document)
+        self.write_behind.mark_dirty(db_name, document)
+
+    async def dump_cache_into_database(self) -> int:
+        """
+        Flush the cache entries updated through `update_cache` to MongoDB in
+        batched `bulk_write` upserts.
+
+        Returns:
+            int: Number of documents written.
+        """
+        return await self.write_behind.flush()
+
+    def start_write_behind(
+        self, interval: float = 5, batch_size: int = 500, max_pending: int = 1000
+    ) -> asyncio.Task:
+        """
+        Start the background task flushing the updated cache entries every
+        `interval` seconds. Stop it with `write_behind.stop` and call
+        `dump_cache_into_database` once it returned to write what is still
+        pending.
+
+        Args:
+            interval (float): Seconds between flushes.
+            batch_size (int): Maximum number of upserts per `bulk_write`.
+            max_pending (int): Number of updated entries that triggers a flush
+                before the timer.
+
+        Returns:
+            asyncio.Task: The running task, to be awaited on shutdown.
+        """
+        self.write_behind.batch_size = batch_size
+        self.write_behind.max_pending = max_pending
+        return asyncio.create_task(
+            self.write_behind.run(interval), name="cache-write-behind"
+        )
+
+    async def update_cache_from_database(
+        self, db_name: str, interval: float = 60, watermark_field: str = "_id"
+    ) -> None:
+        """
+        Keep the cached table of a collection in sync with MongoDB.
+
+        Changes are followed through a change stream when the server supports
+        them (replica sets and Atlas). Otherwise the collection is polled every
+        `interval` seconds for documents whose `watermark_field` is greater
+        than the highest value seen so far, so only changed documents are
+        pulled. Polling does not see deletes, and polling on `_id`, which is
+        only set on insert, does not see updates either: use a field set on
+        every write, such as `updatedAt`, to follow updates. Changes are
+        applied to copies of the cached table and published as new cache
+        generations.
+
+        Polling starts from the watermark recorded by
+        `load_cache_from_database`, if the table was loaded with the same
+        watermark field, so the changes made since the load are not missed.
+
+        Runs until cancelled, see `start_cache_refresher`.
+
+        Args:
+            db_name (str): Name of the collection and of the cached table.
+            interval (float): Seconds between polls.
+            watermark_field (str): Monotonic field used when polling, such as
+                `_id` or an `updatedAt` timestamp.
+        """
+        collection = self.database[db_name]
+        key = self._table_key(db_name)
+        await self._load_object_ids(db_name, key)
+
+        try:
+            await self._watch_collection(db_name)
+        except PyMongoError as e:
+            app_logger.info(
+                f"Change streams unavailable for {db_name} ({e}), "
+                f"polling every {interval}s on {watermark_field}"
+            )
+
+        if watermark_field == "_id":
+            app_logger.warning(
+                f"Polling {db_name} on _id only sees inserted documents, "
+                f"set CACHE_REFRESH_WATERMARK to follow updates"
+            )
+        loaded_field, watermark = self._watermarks.pop(db_name, (None, None))
+        if loaded_field != watermark_field:
+            watermark = await self._watermark(db_name, watermark_field)
+        fields = CACHE_FIELDS.get(db_name)
+        projection = (
+            {field: 1 for field in (*fields, watermark_field)} if fields else None
+        )
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                query = (
+                    {} if watermark is None else {watermark_field: {"$gt": watermark}}
+                )
+                cursor = collection.find(query, projection=projection).sort(
+                    watermark_field, 1
+                )
+                changed = 0
+                async for document in cursor:
+                    watermark = document.get(watermark_field, watermark)
+                    self._apply_document(db_name, document)
+                    changed += 1
+                self._mark_refreshed(db_name)
+                if changed:
+                    app_logger.info(f"Refreshed {changed} {db_name} documents in cache")
+                    await self._invalidate_queries(db_name)
+            except Exception as e:
+                app_logger.error(f"Error refreshing cache for {db_name}: {e}")
+
+    def start_cache_refresher(
+        self, interval: float = 60, watermark_field: str = "_id"
+    ) -> List[asyncio.Task]:
+        """
+        Start one background `update_cache_from_database` task per cached
+        collection.
+
+        Args:
+            interval (float): Seconds between polls.
+            watermark_field (str): Monotonic field used when polling.
+
+        Returns:
+            List[asyncio.Task]: The running tasks, to be cancelled on shutdown.
+        """
+        return [
+            asyncio.create_task(
+                self.update_cache_from_database(db_name, interval, watermark_field),
+                name=f"cache-refresher-{db_name}",
+            )
+            for db_name in self.db_names
+        ]
+
+    async def _invalidate_queries(self, db_name: str) -> None:
+        if self.query_cache is not None:
+            await self.query_cache.invalidate(db_name)
+        negative_cache.invalidate(db_name)
+
+    def _table_key(self, db_name: str) -> str:
+        table = self.cache.get(db_name)
+        return table.key if isinstance(table, IndexedCache) else "id"
+
+    def _latest(self, db_name: str, primary_key: Any) -> Optional[dict]:
+        """
+        Get the latest version of a cached document, with the changes not
+        published yet, or None if it is not cached.
+        """
+        for changes in (self._draft, self._publishing):
+            if primary_key in changes.get(db_name, {}):
+                return changes[db_name][primary_key]
+        table = self.cache.get(db_name)
+        if not isinstance(table, IndexedCache):
+            return None
+        return table.get(primary_key)
+
+    def _mark_refreshed(self, db_name: str) -> None:
+        # Only a timestamp, carried over to the next generation of the table
+        table = self.cache.get(db_name)
+        if isinstance(table, IndexedCache):
+            table.mark_refreshed()
+
+    def _bind(self, db_name: str, table: IndexedCache) -> IndexedCache:
+        """
+        Move the documents of a new table into a fresh namespace of the
+        memory-bounded cache, when there is one.
+        """
+        if self.memory is not None:
+            table.bind(self.memory.renew(db_name))
+        return table
+
+    async def _load_object_ids(self, db_name: str, key: str) -> None:
+        cursor = self.database[db_name].find({}, projection={"_id": 1, key: 1})
+        self._object_ids[db_name] = {
+            document["_id"]: document[key]
+            async for document in cursor
+            if key in document
+        }
+
+    async def _watch_collection(self, db_name: str) -> None:
+        collection = self.database[db_name]
+        async with collection.watch(full_document="updateLookup") as stream:
+            app_logger.info(f"Following {db_name} changes through a change stream")
+            async for change in stream:
+                try:
+                    operation = change["operationType"]
+                    if operation == "delete":
+                        self._remove_document(db_name, change["documentKey"]["_id"])
+                    elif change.get("fullDocument"):
+                        self._apply_document(db_name, change["fullDocument"])
+                    self._mark_refreshed(db_name)
+                    await self._invalidate_queries(db_name)
+                except Exception as e:
+                    app_logger.error(f"Error applying change to {db_name}: {e}")
+
+    async def _watermark(self, db_name: str, watermark_field: str) -> Any:
+        latest = await self.database[db_name].find_one(
+            {}, projection={watermark_field: 1}, sort=[(watermark_field, -1)]
+        )
+        return latest.get(watermark_field) if latest else None
+
+    def _apply_document(self, db_name: str, document: dict) -> None:
+        key = self._table_key(db_name)
+        if key not in document:
+            return
+        if self.write_behind.is_dirty(db_name, document[key]):
+            # The cached version is newer and has not been written yet
+            return
+        # Cached like the documents of `load_cache_from_database`
+        object_id = document.pop("_id", None)
+        fields = CACHE_FIELDS.get(db_name)
+        if fields:
+            document = {field: document[field] for field in fields if field in document}
+        document.pop(CONTENT_HASH_FIELD, None)
+        self._change(db_name, document[key], document)
+        if object_id is not None:
+            self._object_ids.setdefault(db_name, {})[object_id] = document[key]
+
+    def _remove_document(self, db_name: str, object_id: Any) -> None:
+        primary_key = self._object_ids.get(db_name, {}).pop(object_id, None)
+        if primary_key is not None and self._latest(db_name, primary_key) is not None:
+            self._change(db_name, primary_key, None)
+
+    async def fill_database(
+        self, url: str, db_name: str, idempotent: bool = False
+    ) -> None:
+        try:
+            documents = await self.fetch_collection(url, db_name)
+            if idempotent:
+                await self.sync_documents(db_name, documents)
+            else:
+                await self.store_documents(db_name, documents, url)
             app_logger.info(f"Filled database {db_name}")
         except Exception as e:
             app_logger.error(f"Error filling database {db_name}: {e}")
             raise
 
-    async def load_collection_to_dict(self, db_name: str) -> dict:
-        try:
-            async with MongoDBAtlasCRUD(collection_name=db_name) as crud_instance:
-                collection = crud_instance.collection
-                cursor = collection.find({})
-                data_dict = {}
+    async def ingest(
+        self, sources: Sequence[IngestSource], **options
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Insert the documents of many sources into their MongoDB collections
+        with the concurrent ingest pipeline, see `webapi.data.ingest`.
+
+        Args:
+            sources (Sequence[IngestSource]): Sources to ingest.
+            **options: Batch size, concurrency and queue size of the
+                pipeline, see `IngestPipeline`.
 
+        Returns:
+            Dict[str, Dict[str, Any]]: Statistics by source name.
+        """
+        report = await IngestPipeline(self.database, **options).run(sources)
+        for collection in {source.collection for source in sources}:
+            await self._invalidate_queries(collection)
+        return report
+
+    async def load_cache_from_database(
+        self,
+        db_name: str,
+        batch_size: int = 1000,
+        projection: Optional[Sequence[str]] = None,
+        progress_every: int = 10000,
+        watermark_field: Optional[str] = None,
+    ) -> IndexedCache:
+        """
+        Build the cached table of a collection straight from MongoDB. The
+        documents are streamed from the cursor in batches into the table, so
+        no intermediate copy of the collection is held.
+
+        Args:
+            db_name (str): Name of the collection.
+            batch_size (int): Number of documents per cursor batch.
+            projection (Optional[Sequence[str]]): Fields to load. Defaults to
+                the fields of the collection in CACHE_FIELDS, or every field.
+            progress_every (int): Log the progress every this many documents.
+                0 disables progress logs.
+            watermark_field (Optional[str]): Record the highest value of this
+                field before loading, for `update_cache_from_database` to
+                poll the changes made since from there.
+
+        Returns:
+            IndexedCache: The cached table.
+        """
+        fields = CACHE_FIELDS.get(db_name) if projection is None else projection
+
+        async def load():
+            if watermark_field:
+                self._watermarks[db_name] = (
+                    watermark_field,
+                    await self._watermark(db_name, watermark_field),
+                )
+            table = self._bind(db_name, IndexedCache.for_collection(db_name))
+            object_ids = {}
+            loaded = 0
+            cursor = self.database[db_name].find(
+                {},
+                projection={field: 1 for field in fields} if fields else None,
+                batch_size=batch_size,
+            )
+            with log_duration(f"Loading {db_name} from MongoDB"):
                 async for document in cursor:
-                    for field, value in document.items():
-                        data_dict[field] = value
+                    object_id = document.pop("_id", None)
+                    if table.key not in document:
+                        continue
+                    table.upsert(document)
+                    if object_id is not None:
+                        object_ids[object_id] = document[table.key]
+                    loaded += 1
+                    if progress_every and loaded % progress_every == 0:
+                        app_logger.info(f"Loaded {loaded} {db_name} documents")
 
-                    app_logger.info(f"Loaded {db_name} into dictionary")
+            # Needed by the refresher to apply change stream deletes
+            self._object_ids[db_name] = object_ids
+            table.mark_refreshed()
+            app_logger.info(f"Loaded {len(table)} {db_name} documents into cache")
+            return table
 
-            return data_dict
+        try:
+            return await self.single_flight.do(
+                SingleFlight.make_key("load_database", db_name, fields), load
+            )
         except Exception as e:
-            app_logger.error(f"Error loading collection {db_name} to dict: {e}")
+            app_logger.error(f"Error loading cache for {db_name} from MongoDB: {e}")
             raise
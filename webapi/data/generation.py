@@ -0,0 +1,116 @@
+"""
+webapi/data/generation.py
+
+This module contains the cache generations. A generation is a complete set of
+cached tables with their derived structures (policy columns and the
+client/policy join), built off the event loop and published with a single
+reference swap. Every request is pinned to the generation current when it
+started, so it never mixes tables of two generations, and its response is
+tagged with the generation number.
+"""
+import time
+from contextvars import ContextVar
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+from starlette.datastructures import MutableHeaders
+
+from webapi.data.cache_index import IndexedCache
+from webapi.data.columnar import PolicyColumns
+from webapi.data.join_index import JoinIndex
+
+GENERATION_HEADER = "X-Cache-Generation"
+
+# Generation the current request is served from
+current_generation: ContextVar[Optional["CacheGeneration"]] = ContextVar(
+    "current_generation", default=None
+)
+
+
+class CacheGeneration:
+    """
+    Complete set of cached tables published together.
+    """
+
+    def __init__(self, number: int, tables: Dict[str, Any]):
+        """
+        Initialize the CacheGeneration object.
+
+        Args:
+            number (int): Generation number, increasing with every publication.
+            tables (Dict[str, Any]): Cached tables by name.
+        """
+        self.number = number
+        self.tables = tables
+        self.created_at = time.monotonic()
+        self.join: Optional[JoinIndex] = None
+
+    def prepare(self) -> "CacheGeneration":
+        """
+        Build the structures derived from the tables, so the first requests
+        served from the generation do not build them. Meant to run in a
+        thread before the generation is published.
+
+        Returns:
+            CacheGeneration: The generation itself.
+        """
+        clients = self.tables.get("clients")
+        policies = self.tables.get("policies")
+        if isinstance(policies, IndexedCache):
+            PolicyColumns.for_table(policies)
+            if isinstance(clients, IndexedCache):
+                self.join = JoinIndex(clients, policies)
+        return self
+
+    def release(self) -> None:
+        """
+        Stop maintaining the derived structures of a replaced generation.
+        """
+        if self.join is not None:
+            self.join.close()
+            self.join = None
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(number={self.number}, tables={list(self.tables)})"
+        )
+
+
+class CacheGenerationMiddleware:
+    """
+    ASGI middleware pinning each request to the current cache generation and
+    adding its number to the response headers.
+    """
+
+    def __init__(self, app, get_generation: Callable[[], Optional[CacheGeneration]]):
+        """
+        Initialize the CacheGenerationMiddleware object.
+
+        Args:
+            app: ASGI application.
+            get_generation: Returns the current generation, or None before the
+                cache is loaded.
+        """
+        self.app = app
+        self.get_generation = get_generation
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        generation = self.get_generation()
+
+        async def send_with_generation(message):
+            if message["type"] == "http.response.start" and generation is not None:
+                headers = MutableHeaders(scope=message)
+                headers.append(GENERATION_HEADER, str(generation.number))
+            await send(message)
+
+        token = current_generation.set(generation)
+        try:
+            await self.app(scope, receive, send_with_generation)
+        finally:
+            current_generation.reset(token)
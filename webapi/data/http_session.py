@@ -0,0 +1,126 @@
+"""
+webapi/data/http_session.py
+
+This module contains the HTTP session shared by every upstream fetch. A
+single aiohttp session keeps a pool of connections, so fetches reuse open
+connections and cached DNS lookups instead of paying for a new connection,
+lookup and TLS handshake every time. The session is created on first use and
+closed on application shutdown.
+
+Responses are not decompressed by the session: the payloads are requested
+with the encodings of `webapi.data.compression` and read through its
+decoders.
+"""
+import asyncio
+from typing import Optional
+
+import aiohttp
+from decouple import config
+
+from webapi.data.compression import ACCEPT_ENCODING
+from webapi.logs.logger import app_logger
+
+HTTP_POOL_LIMIT = config("HTTP_POOL_LIMIT", default=100, cast=int)
+HTTP_POOL_LIMIT_PER_HOST = config("HTTP_POOL_LIMIT_PER_HOST", default=10, cast=int)
+HTTP_KEEPALIVE_TIMEOUT = config("HTTP_KEEPALIVE_TIMEOUT", default=30, cast=float)
+HTTP_DNS_CACHE_TTL = config("HTTP_DNS_CACHE_TTL", default=300, cast=int)
+HTTP_TIMEOUT = config("HTTP_TIMEOUT", default=60, cast=float)
+
+
+class HTTPSessionManager:
+    """
+    Owner of the aiohttp session shared by the upstream fetches.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
+        timeout: float = 60,
+    ):
+        """
+        Initialize the HTTPSessionManager object.
+
+        Args:
+            limit (int): Maximum number of open connections. 0 is unlimited.
+            limit_per_host (int): Maximum number of open connections to one
+                host. 0 is unlimited.
+            keepalive_timeout (float): Seconds an idle connection is kept open.
+            dns_cache_ttl (int): Seconds a DNS lookup is cached.
+            timeout (float): Seconds to wait for a connection or for the next
+                bytes of a response. Large payloads may take longer overall.
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared session, creating it on first use. Must be called from
+        the event loop the session is used on.
+
+        Returns:
+            aiohttp.ClientSession: The session.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            # A session cannot outlive its event loop, nor be shared between two
+            self._discard()
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.timeout, sock_read=self.timeout
+                ),
+                headers={"Accept-Encoding": ACCEPT_ENCODING},
+                auto_decompress=False,
+            )
+            self._loop = loop
+            app_logger.info("Opened the upstream HTTP session")
+        return self._session
+
+    def _discard(self) -> None:
+        """
+        Release the session of another event loop before it is replaced.
+        """
+        session, loop = self._session, self._loop
+        self._session = None
+        if session is None or session.closed:
+            return
+        if loop is not None and loop.is_running():
+            # Closed on its own loop, which runs in another thread
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            # Its loop is stopped, and its connections went with it
+            session.detach()
+        app_logger.warning("Released the upstream HTTP session of another event loop")
+
+    async def close(self) -> None:
+        """
+        Close the shared session and its connections.
+        """
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+            app_logger.info("Closed the upstream HTTP session")
+
+
+# Shared by every JSONData instance, closed on application shutdown
+http_sessions = HTTPSessionManager(
+    limit=HTTP_POOL_LIMIT,
+    limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+    keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    dns_cache_ttl=HTTP_DNS_CACHE_TTL,
+    timeout=HTTP_TIMEOUT,
+)
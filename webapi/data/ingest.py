@@ -0,0 +1,379 @@
+"""
+webapi/data/ingest.py
+
+This module contains the multi-source ingest pipeline. Each source is declared
+with its location (an URL or a file), the collection it fills and the key of
+its documents in the payload. Sources run through four stages:
+
+fetch -> parse -> validate -> batch write
+
+Every stage has its own number of workers, and the stages are connected by
+bounded queues, so a slow stage holds back the ones before it instead of
+letting data pile up in memory. Throughput is reported per source.
+"""
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from decouple import config
+from pymongo.errors import BulkWriteError
+from pymongo.errors import PyMongoError
+
+from webapi.data.compression import iter_decoded
+from webapi.data.http_session import http_sessions
+from webapi.data.http_session import HTTPSessionManager
+from webapi.data.json_stream import JSONArrayStream
+from webapi.logs.logger import app_logger
+
+# JSON file with a list of sources, see `load_sources`
+INGEST_SOURCES = config("INGEST_SOURCES", default="", cast=str)
+INGEST_FETCH_CONCURRENCY = config("INGEST_FETCH_CONCURRENCY", default=4, cast=int)
+
+CHUNK_SIZE = 2**16
+
+
+class IngestSource:
+    """
+    Declaration of a source of documents and of the collection it fills.
+    """
+
+    def __init__(
+        self,
+        location: str,
+        collection: str,
+        root_key: Optional[str] = None,
+        name: Optional[str] = None,
+        required: Sequence[str] = ("id",),
+    ):
+        """
+        Initialize the IngestSource object.
+
+        Args:
+            location (str): URL or path of the JSON payload.
+            collection (str): MongoDB collection to fill.
+            root_key (Optional[str]): Key of the documents array in the
+                payload. None if the payload is the array itself.
+            name (Optional[str]): Name used in the reports. Defaults to the
+                collection.
+            required (Sequence[str]): Fields every valid document must have.
+        """
+        self.location = location
+        self.collection = collection
+        self.root_key = root_key
+        self.name = name or collection
+        self.required = tuple(required)
+
+    @classmethod
+    def from_dict(cls, spec: Dict[str, Any]) -> "IngestSource":
+        """
+        Build a source from its declaration, such as an entry of the
+        INGEST_SOURCES file.
+
+        Args:
+            spec (Dict[str, Any]): `location`, `collection` and optionally
+                `root_key`, `name` and `required`.
+
+        Returns:
+            IngestSource: The source.
+        """
+        return cls(
+            location=spec["location"],
+            collection=spec["collection"],
+            root_key=spec.get("root_key"),
+            name=spec.get("name"),
+            required=spec.get("required", ("id",)),
+        )
+
+    @property
+    def is_url(self) -> bool:
+        return self.location.startswith(("http://", "https://"))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.name}: {self.location})"
+
+
+def load_sources(path: str) -> List[IngestSource]:
+    """
+    Read the sources declared in a JSON file holding a list of source
+    declarations, see `IngestSource.from_dict`.
+
+    Args:
+        path (str): JSON file.
+
+    Returns:
+        List[IngestSource]: The sources.
+    """
+    with open(path) as file:
+        return [IngestSource.from_dict(spec) for spec in json.load(file)]
+
+
+class SourceStats:
+    """
+    Progress and throughput of one source.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.parsed = 0
+        self.invalid = 0
+        self.written = 0
+        self.failed = 0
+        self.errors: List[str] = []
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def error(self, message: str) -> None:
+        # A few messages are enough to diagnose a source
+        if len(self.errors) < 10:
+            self.errors.append(message)
+
+    @property
+    def seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @property
+    def records_per_second(self) -> float:
+        return self.written / self.seconds if self.seconds else 0.0
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "bytes": self.bytes,
+            "parsed": self.parsed,
+            "invalid": self.invalid,
+            "written": self.written,
+            "failed": self.failed,
+            "seconds": round(self.seconds, 3),
+            "records_per_second": round(self.records_per_second, 1),
+            "errors": list(self.errors),
+        }
+
+
+class _SourceRun:
+    """
+    State of a source flowing through the pipeline.
+    """
+
+    def __init__(self, source: IngestSource, queue_size: int):
+        self.source = source
+        self.stats = SourceStats()
+        # Chunks from the fetch stage, None once the payload is fully read
+        self.chunks: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(queue_size)
+        self.batch: List[dict] = []
+
+
+class IngestPipeline:
+    """
+    Concurrent fetch -> parse -> validate -> batch write pipeline over many
+    sources.
+    """
+
+    def __init__(
+        self,
+        database,
+        batch_size: int = 1000,
+        fetch_concurrency: int = 4,
+        parse_concurrency: int = 2,
+        validate_concurrency: int = 2,
+        write_concurrency: int = 4,
+        queue_size: int = 64,
+        sessions: Optional[HTTPSessionManager] = None,
+    ):
+        """
+        Initialize the IngestPipeline object.
+
+        Args:
+            database: Asynchronous MongoDB database, or any mapping of
+                collection names to collections with `insert_many`.
+            batch_size (int): Maximum number of documents per write.
+            fetch_concurrency (int): Sources downloaded at a time.
+            parse_concurrency (int): Sources parsed at a time.
+            validate_concurrency (int): Workers validating documents.
+            write_concurrency (int): Batches written at a time.
+            queue_size (int): Capacity of the queues between the stages, in
+                chunks, documents or batches.
+            sessions: Provider of the HTTP session. Defaults to the session
+                shared by the whole application.
+        """
+        self.database = database
+        self.batch_size = batch_size
+        self.fetch_concurrency = max(1, fetch_concurrency)
+        self.parse_concurrency = max(1, parse_concurrency)
+        self.validate_concurrency = max(1, validate_concurrency)
+        self.write_concurrency = max(1, write_concurrency)
+        self.queue_size = queue_size
+        self.sessions = sessions or http_sessions
+
+    async def run(self, sources: Sequence[IngestSource]) -> Dict[str, Dict[str, Any]]:
+        """
+        Ingest every source. A failing source is reported without stopping
+        the others.
+
+        Args:
+            sources (Sequence[IngestSource]): Sources to ingest.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Statistics by source name.
+        """
+        runs = [_SourceRun(source, self.queue_size) for source in sources]
+        to_fetch: "asyncio.Queue[Optional[_SourceRun]]" = asyncio.Queue()
+        to_parse: "asyncio.Queue[Optional[_SourceRun]]" = asyncio.Queue()
+        documents: "asyncio.Queue[Optional[Tuple[_SourceRun, Any]]]" = asyncio.Queue(
+            self.queue_size * self.batch_size
+        )
+        batches: "asyncio.Queue[Optional[Tuple[_SourceRun, List[dict]]]]" = (
+            asyncio.Queue(self.queue_size)
+        )
+        for run in runs:
+            to_fetch.put_nowait(run)
+
+        async def stage(workers, worker, *args, then=None, stop_count=0):
+            # Run the workers of a stage, then stop the workers of the next
+            await asyncio.gather(*(worker(*args) for _ in range(workers)))
+            if then is not None:
+                for _ in range(stop_count):
+                    await then.put(None)
+
+        for _ in range(self.fetch_concurrency):
+            to_fetch.put_nowait(None)
+
+        async def validate_then_flush():
+            await stage(self.validate_concurrency, self._validate, documents, batches)
+            # Partial batches left once every document was validated
+            for run in runs:
+                if run.batch:
+                    await batches.put((run, run.batch))
+                    run.batch = []
+            for _ in range(self.write_concurrency):
+                await batches.put(None)
+
+        started = time.perf_counter()
+        await asyncio.gather(
+            stage(
+                self.fetch_concurrency,
+                self._fetch,
+                to_fetch,
+                to_parse,
+                then=to_parse,
+                stop_count=self.parse_concurrency,
+            ),
+            stage(
+                self.parse_concurrency,
+                self._parse,
+                to_parse,
+                documents,
+                then=documents,
+                stop_count=self.validate_concurrency,
+            ),
+            validate_then_flush(),
+            stage(self.write_concurrency, self._write, batches),
+        )
+
+        report = {}
+        for run in runs:
+            if run.stats.finished_at is None:
+                run.stats.finished_at = time.perf_counter()
+            report[run.source.name] = run.stats.report()
+            app_logger.info(
+                f"Ingested {run.source.name}: {run.stats.written} documents "
+                f"in {run.stats.seconds:.3f}s "
+                f"({run.stats.records_per_second:.1f} records/s), "
+                f"{run.stats.invalid} invalid, {run.stats.failed} failed"
+            )
+        app_logger.info(
+            f"Ingested {len(runs)} sources in {time.perf_counter() - started:.3f}s"
+        )
+        return report
+
+    async def _fetch(self, to_fetch: asyncio.Queue, to_parse: asyncio.Queue) -> None:
+        while (run := await to_fetch.get()) is not None:
+            run.stats.started_at = time.perf_counter()
+            # Parsing starts with the download, reading the chunks as they come
+            await to_parse.put(run)
+            try:
+                async for chunk in self._read(run.source):
+                    run.stats.bytes += len(chunk)
+                    await run.chunks.put(chunk)
+            except Exception as e:
+                app_logger.error(f"Error fetching {run.source}: {e}")
+                run.stats.error(f"fetch: {e}")
+            await run.chunks.put(None)
+
+    async def _read(self, source: IngestSource) -> AsyncIterator[bytes]:
+        if source.is_url:
+            async with self.sessions.session().get(source.location) as response:
+                response.raise_for_status()
+                async for chunk in iter_decoded(response, CHUNK_SIZE):
+                    yield chunk
+            return
+        with open(Path(source.location), "rb") as file:
+            while chunk := await asyncio.to_thread(file.read, CHUNK_SIZE):
+                yield chunk
+
+    async def _parse(self, to_parse: asyncio.Queue, documents: asyncio.Queue) -> None:
+        while (run := await to_parse.get()) is not None:
+            parser = JSONArrayStream(run.source.root_key)
+            failed = False
+            while True:
+                chunk = await run.chunks.get()
+                if failed:
+                    # Keep draining so the fetch stage is not blocked
+                    if chunk is None:
+                        break
+                    continue
+                try:
+                    items = parser.feed(chunk or b"", final=chunk is None)
+                    if chunk is None and run.source.root_key and not parser.found:
+                        raise ValueError(f"No {run.source.root_key} array")
+                except ValueError as e:
+                    app_logger.error(f"Error parsing {run.source}: {e}")
+                    run.stats.error(f"parse: {e}")
+                    failed = chunk is not None
+                    items = []
+                for item in items:
+                    run.stats.parsed += 1
+                    await documents.put((run, item))
+                if chunk is None:
+                    break
+
+    async def _validate(self, documents: asyncio.Queue, batches: asyncio.Queue) -> None:
+        while (entry := await documents.get()) is not None:
+            run, document = entry
+            if not isinstance(document, dict) or any(
+                field not in document for field in run.source.required
+            ):
+                run.stats.invalid += 1
+                run.stats.error(f"invalid document: {str(document)[:80]}")
+                continue
+            run.batch.append(document)
+            if len(run.batch) >= self.batch_size:
+                batch, run.batch = run.batch, []
+                await batches.put((run, batch))
+
+    async def _write(self, batches: asyncio.Queue) -> None:
+        while (entry := await batches.get()) is not None:
+            run, batch = entry
+            collection = self.database[run.source.collection]
+            try:
+                result = await collection.insert_many(batch, ordered=False)
+                run.stats.written += len(result.inserted_ids)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                run.stats.written += e.details.get("nInserted", 0)
+                run.stats.failed += len(errors)
+                if errors:
+                    run.stats.error(f"write: {errors[0].get('errmsg', '')}")
+            except PyMongoError as e:
+                app_logger.error(f"Error writing {run.source}: {e}")
+                run.stats.failed += len(batch)
+                run.stats.error(f"write: {e}")
+            run.stats.finished_at = time.perf_counter()
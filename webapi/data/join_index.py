@@ -0,0 +1,165 @@
+"""
+webapi/data/join_index.py
+
+This module contains the in-memory join between the cached clients and
+policies, used instead of the `$lookup` aggregations. It maps client ids to
+policy ids, policy ids to client ids and client names to client ids, and is
+kept up to date incrementally as documents of either table change.
+"""
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from webapi.data.cache_index import IndexedCache
+
+
+# Buckets are dicts used as ordered sets: insertion order, O(1) removal
+Buckets = Dict[Any, Dict[Any, None]]
+
+
+def _add(index: Buckets, value: Any, key: Any) -> None:
+    index.setdefault(value, {})[key] = None
+
+
+def _discard(index: Buckets, value: Any, key: Any) -> None:
+    keys = index.get(value)
+    if keys is None or key not in keys:
+        return
+    del keys[key]
+    if not keys:
+        del index[value]
+
+
+class JoinIndex:
+    """
+    Bidirectional client/policy join over two cached tables.
+    """
+
+    def __init__(self, clients: IndexedCache, policies: IndexedCache):
+        """
+        Build the join of two tables and follow their changes.
+
+        Args:
+            clients (IndexedCache): Cached clients.
+            policies (IndexedCache): Cached policies.
+        """
+        self.clients = clients
+        self.policies = policies
+        self.policies_by_client: Buckets = {}
+        self.client_by_policy: Dict[Any, Any] = {}
+        self.clients_by_name: Buckets = {}
+        self._versions: Tuple[int, int] = (-1, -1)
+        self.rebuild()
+        clients.subscribe(self._client_changed)
+        policies.subscribe(self._policy_changed)
+
+    def close(self) -> None:
+        """
+        Stop following the changes of the tables.
+        """
+        self.clients.unsubscribe(self._client_changed)
+        self.policies.unsubscribe(self._policy_changed)
+
+    def covers(self, clients: IndexedCache, policies: IndexedCache) -> bool:
+        """
+        Check whether the join is over these tables.
+        """
+        return self.clients is clients and self.policies is policies
+
+    def rebuild(self) -> None:
+        """
+        Recompute the join from both tables. When they are indexed on the
+        joined fields the indexes are used, so the documents are not read,
+        which for shared tables would decode every one of them.
+        """
+        self.policies_by_client = {}
+        self.client_by_policy = {}
+        self.clients_by_name = {}
+        if self.clients.is_indexed("name") and self.policies.is_indexed("clientId"):
+            for name in self.clients.values_for("name"):
+                self.clients_by_name[name] = dict.fromkeys(
+                    self.clients.ids_for("name", name)
+                )
+            for client_id in self.policies.values_for("clientId"):
+                if client_id is None:
+                    continue
+                policy_ids = self.policies.ids_for("clientId", client_id)
+                self.policies_by_client[client_id] = dict.fromkeys(policy_ids)
+                for policy_id in policy_ids:
+                    self.client_by_policy[policy_id] = client_id
+        else:
+            for client_id, client in self.clients.items():
+                self._add_client(client_id, client)
+            for policy_id, policy in self.policies.items():
+                self._add_policy(policy_id, policy)
+        self._versions = (self.clients.version, self.policies.version)
+
+    def ensure_current(self) -> None:
+        """
+        Rebuild the join if a table changed without notifying it, such as
+        after `IndexedCache.rebuild`.
+        """
+        if self._versions != (self.clients.version, self.policies.version):
+            self.rebuild()
+
+    def client_ids_for_name(self, name: str) -> List[Any]:
+        """
+        Get the ids of the clients with a name.
+        """
+        self.ensure_current()
+        return list(self.clients_by_name.get(name, ()))
+
+    def policy_ids_for_client(self, client_id: Any) -> List[Any]:
+        """
+        Get the ids of the policies of a client.
+        """
+        self.ensure_current()
+        return list(self.policies_by_client.get(client_id, ()))
+
+    def client_id_for_policy(self, policy_id: Any) -> Optional[Any]:
+        """
+        Get the id of the client of a policy, if any.
+        """
+        self.ensure_current()
+        return self.client_by_policy.get(policy_id)
+
+    def _add_client(self, client_id: Any, client: dict) -> None:
+        if "name" in client:
+            _add(self.clients_by_name, client["name"], client_id)
+
+    def _add_policy(self, policy_id: Any, policy: dict) -> None:
+        client_id = policy.get("clientId")
+        if client_id is None:
+            return
+        self.client_by_policy[policy_id] = client_id
+        _add(self.policies_by_client, client_id, policy_id)
+
+    def _client_changed(
+        self, client_id: Any, old: Optional[dict], new: Optional[dict]
+    ) -> None:
+        if old is not None and "name" in old:
+            _discard(self.clients_by_name, old["name"], client_id)
+        if new is not None:
+            self._add_client(client_id, new)
+        self._synced(0, self.clients.version)
+
+    def _policy_changed(
+        self, policy_id: Any, old: Optional[dict], new: Optional[dict]
+    ) -> None:
+        if old is not None and policy_id in self.client_by_policy:
+            _discard(
+                self.policies_by_client, self.client_by_policy.pop(policy_id), policy_id
+            )
+        if new is not None:
+            self._add_policy(policy_id, new)
+        self._synced(1, self.policies.version)
+
+    def _synced(self, position: int, version: int) -> None:
+        # Only a join in sync before the change is in sync after it
+        if self._versions[position] != version - 1:
+            return
+        versions = list(self._versions)
+        versions[position] = version
+        self._versions = tuple(versions)
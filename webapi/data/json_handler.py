@@ -1,6 +1,10 @@
 """
 webapi/data/json_handler.py
 """
+import asyncio
+import json
+from typing import Any
+from typing import AsyncIterator
 from typing import Dict
 from typing import List
 from typing import Optional
@@ -8,40 +12,152 @@ from typing import Union
 
 import aiohttp
 
+from webapi.data.compression import iter_decoded
+from webapi.data.compression import read_decoded
+from webapi.data.http_session import http_sessions
+from webapi.data.http_session import HTTPSessionManager
+from webapi.data.json_stream import iter_json_array
+from webapi.data.payload_store import payload_store
+from webapi.data.payload_store import PayloadStore
 from webapi.logs.logger import app_logger
 
 
+# Returned by conditional fetches when the upstream payload did not change
+NOT_MODIFIED = object()
+
+
 class JSONData:
-    def __init__(self, url: str):
+    def __init__(
+        self,
+        url: str,
+        sessions: Optional[HTTPSessionManager] = None,
+        store: Optional[PayloadStore] = None,
+    ):
         """
         Initialize the JSONData class.
 
         Args:
             url: The URL for fetching JSON data.
+            sessions: Provider of the HTTP session. Defaults to the session
+                shared by the whole application.
+            store: Local store of the fetched payloads, used for conditional
+                fetches. Defaults to the store configured with
+                UPSTREAM_PAYLOAD_DIR, if any.
         """
         self.url = url
+        self.sessions = sessions or http_sessions
+        self.store = store or payload_store
 
     async def fetch_data_from_json_url(
-        self, url: Optional[str] = None
-    ) -> Union[Dict, List, None]:
+        self, url: Optional[str] = None, if_modified: bool = False
+    ) -> Union[Dict, List, None, object]:
         """
         Fetch JSON data from the provided URL.
 
+        With a payload store, the request is conditional on the validators of
+        the stored payload. When the upstream answers 304 Not Modified, the
+        stored payload is parsed instead of downloaded again, or, with
+        `if_modified`, not parsed at all.
+
         Args:
             url: The URL for fetching JSON data (optional).
+            if_modified: Return NOT_MODIFIED instead of the data when the
+                payload did not change since it was stored.
 
         Returns:
             A dictionary or a list containing the fetched JSON data,
-             or None if an error occurs.
+             NOT_MODIFIED, or None if an error occurs.
+        """
+        url = url or self.url
+        headers = (
+            await asyncio.to_thread(self.store.validators, url)
+            if self.store is not None
+            else {}
+        )
+        try:
+            async with self.sessions.session().get(url, headers=headers) as response:
+                if response.status == 304:
+                    app_logger.info(f"Upstream payload of {url} not modified")
+                    if if_modified:
+                        return NOT_MODIFIED
+                    payload = await asyncio.to_thread(self.store.load, url)
+                    if payload is not None:
+                        return json.loads(payload)
+                    # The stored payload vanished, fetch it again in full
+                    return await self._fetch_payload(url, {})
+                return await self._read_payload(url, response)
+        except (aiohttp.ClientError, OSError, ValueError) as e:
+            app_logger.error(f"Error fetching JSON data from URL: {e}")
+            return None
+
+    async def _fetch_payload(
+        self, url: str, headers: Dict[str, str]
+    ) -> Union[Dict, List]:
+        async with self.sessions.session().get(url, headers=headers) as response:
+            return await self._read_payload(url, response)
+
+    async def _read_payload(
+        self, url: str, response: aiohttp.ClientResponse
+    ) -> Union[Dict, List]:
+        response.raise_for_status()
+        writer = None
+        if self.store is not None:
+            writer = await asyncio.to_thread(
+                self.store.writer,
+                url,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+        if writer is None:
+            return json.loads(await read_decoded(response))
+
+        # Streamed to the store instead of buffered, then parsed from it
+        try:
+            async for chunk in iter_decoded(response):
+                await asyncio.to_thread(writer.write, chunk)
+            await asyncio.to_thread(writer.commit)
+        except BaseException:
+            writer.discard()
+            raise
+        payload = await asyncio.to_thread(self.store.load, url)
+        if payload is None:
+            raise ValueError(f"Stored payload of {url} could not be read")
+        return json.loads(payload)
+
+    async def stream_json_items(
+        self,
+        key: Optional[str] = None,
+        url: Optional[str] = None,
+        chunk_size: int = 2**16,
+    ) -> AsyncIterator[Any]:
+        """
+        Stream the items of a JSON array from the provided URL. The response
+        is decoded and parsed as its chunks arrive, so each item is yielded without the
+        whole payload being held in memory.
+
+        Args:
+            key: Key of the array in the top-level object, such as "clients".
+                None streams a top-level array.
+            url: The URL for fetching JSON data. Defaults to the URL of the
+                object.
+            chunk_size: Maximum number of bytes read at a time.
+
+        Yields:
+            Each item of the array.
+
+        Raises:
+            aiohttp.ClientError: If the payload could not be fetched.
+            ValueError: If the payload is invalid or has no such array.
         """
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(self.url) as response:
-                    response.raise_for_status()
-                    return await response.json()
-            except aiohttp.ClientError as e:
-                app_logger.error(f"Error fetching JSON data from URL: {e}")
-                return None
+        try:
+            async with self.sessions.session().get(url or self.url) as response:
+                response.raise_for_status()
+                chunks = iter_decoded(response, chunk_size)
+                async for item in iter_json_array(chunks, key):
+                    yield item
+        except aiohttp.ClientError as e:
+            app_logger.error(f"Error streaming JSON data from URL: {e}")
+            raise
 
     async def return_data_in_json(self):
         # Method not implemented
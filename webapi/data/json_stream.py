@@ -0,0 +1,231 @@
+"""
+webapi/data/json_stream.py
+
+This module contains the incremental JSON parser used to stream upstream
+payloads. It reads the payload chunk by chunk and yields the items of one
+array as soon as each of them is complete, so the whole body and the whole
+document tree are never held in memory at once. Only the array items are
+decoded; the values of the other keys are parsed and dropped.
+"""
+import codecs
+import json
+import re
+from typing import Any
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Optional
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters that matter when skipping a container or a string
+STRUCTURE = re.compile(r'["\[\]{}]')
+STRING_END = re.compile(r'["\\]')
+# Characters that may go on a number
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+_decoder = json.JSONDecoder()
+
+
+class _NeedMoreData(Exception):
+    """
+    Raised when the buffered text ends in the middle of a value, with the
+    position up to which the buffer was consumed.
+    """
+
+    def __init__(self, position: Optional[int] = None):
+        super().__init__(position)
+        self.position = position
+
+
+class JSONArrayStream:
+    """
+    Push parser yielding the items of a top-level array, or of the array held
+    by a key of a top-level object.
+    """
+
+    def __init__(self, key: Optional[str] = None):
+        """
+        Initialize the JSONArrayStream object.
+
+        Args:
+            key (Optional[str]): Key of the array in the top-level object.
+                None streams a top-level array.
+        """
+        self.key = key
+        self.found = False
+        self._buffer = ""
+        self._state = "start"
+        # Progress through a skipped value
+        self._depth = 0
+        self._in_string = False
+        # Last token of the current container: "open", "value" or ","
+        self._last = "open"
+        self._decode = codecs.getincrementaldecoder("utf-8")().decode
+
+    def feed(self, chunk: bytes, final: bool = False) -> list:
+        """
+        Parse a chunk of the payload.
+
+        Args:
+            chunk (bytes): Next bytes of the payload.
+            final (bool): Whether it is the last chunk.
+
+        Returns:
+            list: The array items completed by the chunk.
+
+        Raises:
+            ValueError: If the payload is not valid JSON, or ends before the
+                array does.
+        """
+        self._buffer += self._decode(chunk, final)
+        items = []
+        position = 0
+        try:
+            while self._state != "done":
+                position = self._step(position, items, final)
+        except _NeedMoreData as e:
+            if final:
+                raise ValueError(f"Truncated JSON payload while in {self._state}")
+            if e.position is not None:
+                position = e.position
+        # Anything after the array is ignored
+        self._buffer = "" if self._state == "done" else self._buffer[position:]
+        return items
+
+    def _step(self, position: int, items: list, final: bool) -> int:
+        # Each step consumes one complete token or value and moves to the
+        # next state; it raises _NeedMoreData without consuming anything
+        # when the buffer ends before it.
+        if self._state == "skip":
+            self._last = "value"
+            return self._skip_value(position)
+
+        position = self._skip(position)
+        char = self._buffer[position]
+
+        if self._state == "start":
+            expected = "{" if self.key is not None else "["
+            if char != expected:
+                raise ValueError(f"Expected '{expected}' at the start of the payload")
+            self._state = "key" if self.key is not None else "item"
+            return position + 1
+
+        if char == "," and self._last == "value":
+            self._last = ","
+            return position + 1
+        if char in "]}":
+            unexpected = self._last == ","
+        else:
+            unexpected = char == "," or self._last == "value"
+        if unexpected:
+            raise ValueError(f"Unexpected '{char}' in the JSON payload")
+
+        if self._state == "key":
+            if char == "}":
+                self._state = "done"
+                return position + 1
+            key, end = self._value(position, final)
+            end = self._skip(end)
+            if self._buffer[end] != ":":
+                raise ValueError(f"Expected ':' after key {key}")
+            end = self._skip(end + 1)
+            if key == self.key and self._buffer[end] == "[":
+                self.found = True
+                self._state = "item"
+                self._last = "open"
+                return end + 1
+            if self._buffer[end] in '{["':
+                # Scanned rather than decoded, as it may be large
+                self._state = "skip"
+                self._depth = 0
+                return end
+            _, end = self._value(end, final)
+            self._last = "value"
+            return end
+
+        # Items of the array
+        if char == "]":
+            self._state = "done"
+            return position + 1
+        item, end = self._value(position, final)
+        items.append(item)
+        self._last = "value"
+        return end
+
+    def _skip(self, position: int) -> int:
+        position = WHITESPACE.match(self._buffer, position).end()
+        if position >= len(self._buffer):
+            raise _NeedMoreData
+        return position
+
+    def _skip_value(self, position: int) -> int:
+        buffer = self._buffer
+        while True:
+            if self._in_string:
+                match = STRING_END.search(buffer, position)
+                if match is None:
+                    raise _NeedMoreData(len(buffer))
+                if match.group() == "\\":
+                    if match.end() >= len(buffer):
+                        raise _NeedMoreData(match.start())
+                    position = match.end() + 1
+                    continue
+                self._in_string = False
+            else:
+                match = STRUCTURE.search(buffer, position)
+                if match is None:
+                    raise _NeedMoreData(len(buffer))
+                char = match.group()
+                if char == '"':
+                    self._in_string = True
+                elif char in "{[":
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+            position = match.end()
+            if self._depth == 0 and not self._in_string:
+                self._state = "key"
+                return position
+
+    def _value(self, position: int, final: bool):
+        try:
+            value, end = _decoder.raw_decode(self._buffer, position)
+        except json.JSONDecodeError as e:
+            if final:
+                raise ValueError(f"Invalid JSON payload: {e}") from e
+            raise _NeedMoreData
+        # A value at the end of the buffer may go on in the next chunk, and so
+        # may a number cut after its ".", "e" or sign
+        if not final and (
+            end == len(self._buffer)
+            or isinstance(value, (int, float))
+            and NUMBER_TAIL.match(self._buffer, end).end() == len(self._buffer)
+        ):
+            raise _NeedMoreData
+        return value, end
+
+
+async def iter_json_array(
+    chunks: AsyncIterable[bytes], key: Optional[str] = None
+) -> AsyncIterator[Any]:
+    """
+    Yield the items of a JSON array as the chunks of the payload arrive.
+
+    Args:
+        chunks (AsyncIterable[bytes]): Chunks of the payload.
+        key (Optional[str]): Key of the array in the top-level object. None
+            streams a top-level array.
+
+    Yields:
+        Any: Each item of the array.
+
+    Raises:
+        ValueError: If the payload is invalid, truncated or has no such key.
+    """
+    parser = JSONArrayStream(key)
+    async for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.feed(b"", final=True):
+        yield item
+    if key is not None and not parser.found:
+        raise ValueError(f"No {key} array in the JSON payload")
@@ -0,0 +1,119 @@
+"""
+webapi/data/negative_cache.py
+
+This module contains the cache of "not found" results. Queries for user IDs,
+client names or policy IDs that do not exist are remembered for a short time
+so repeated requests for them do not reach MongoDB. Entries are dropped when
+documents are ingested into a collection they depend on.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from decouple import config
+
+NEGATIVE_CACHE_MAX_SIZE = config("NEGATIVE_CACHE_MAX_SIZE", default=10000, cast=int)
+NEGATIVE_CACHE_TTL = config("NEGATIVE_CACHE_TTL", default=10, cast=float)
+
+
+class NegativeCache:
+    """
+    Bounded LRU set of query keys known to have no result, with a TTL.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 10):
+        """
+        Initialize the NegativeCache object.
+
+        Args:
+            max_size (int): Maximum number of remembered keys.
+            ttl (float): Seconds a key is remembered.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # Key -> (expiry time, collections whose changes invalidate it)
+        self._entries: "OrderedDict[str, Tuple[float, Tuple[str, ...]]]" = OrderedDict()
+        self.hits = 0
+
+    def is_missing(self, key: str) -> bool:
+        """
+        Check whether a query is known to have no result.
+
+        Args:
+            key (str): Query key.
+
+        Returns:
+            bool: True if the query had no result less than `ttl` seconds ago.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return False
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True
+
+    def add(
+        self, key: str, collections: Sequence[str] = (), ttl: Optional[float] = None
+    ) -> None:
+        """
+        Remember that a query has no result.
+
+        Args:
+            key (str): Query key.
+            collections (Sequence[str]): Collections whose new documents may
+                give the query a result.
+            ttl (Optional[float]): Seconds to remember it. Defaults to the
+                cache TTL.
+        """
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        self._entries[key] = (expires_at, tuple(collections))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, collection: Optional[str] = None) -> int:
+        """
+        Forget the queries depending on a collection.
+
+        Args:
+            collection (Optional[str]): Name of the changed collection. None
+                forgets every query.
+
+        Returns:
+            int: Number of forgotten queries.
+        """
+        if collection is None:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+        stale = [
+            key
+            for key, (_, collections) in self._entries.items()
+            if collection in collections
+        ]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the size and hit count of the cache.
+
+        Returns:
+            Dict[str, int]: Cache statistics.
+        """
+        return {"size": len(self._entries), "hits": self.hits}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Shared by the read path and the ingestion, which invalidates it
+negative_cache = NegativeCache(max_size=NEGATIVE_CACHE_MAX_SIZE, ttl=NEGATIVE_CACHE_TTL)
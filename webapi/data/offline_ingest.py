@@ -0,0 +1,512 @@
+"""
+webapi/data/offline_ingest.py
+
+This script ingests local files, without going through the upstream URLs.
+It reads:
+
+- JSON files, either an array of documents or an object holding one array by
+  collection, such as the upstream payloads,
+- NDJSON files, one document per line, optionally gzip'd,
+- Python modules assigning a dict of lists, such as `data/raw.py`.
+
+The records are streamed, so a file is never fully loaded in memory, and go
+in batches either into MongoDB or straight into a cache snapshot the API can
+warm start from. Throughput and peak memory are printed at the end:
+
+python -m webapi.data.offline_ingest data/raw.py --to snapshot --snapshot cache.snap
+"""
+import argparse
+import ast
+import asyncio
+import gzip
+import itertools
+import json
+import re
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any
+from typing import AsyncIterator
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import IO
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from decouple import config
+
+from webapi.data.cache_index import IndexedCache
+from webapi.data.ingest import CHUNK_SIZE
+from webapi.data.ingest import SourceStats
+from webapi.data.json_stream import JSONArrayStream
+from webapi.data.snapshot import CacheSnapshot
+from webapi.logs.logger import app_logger
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not available on Windows
+    resource = None
+
+# Same settings as the upstream ingest in webapi.data.store_json, read here
+# because the MongoDB modules are only imported for the "mongo" target: they
+# need the database settings, which an offline machine may not have
+INGEST_BATCH_SIZE = config("INGEST_BATCH_SIZE", default=1000, cast=int)
+INGEST_MAX_IN_FLIGHT = config("INGEST_MAX_IN_FLIGHT", default=4, cast=int)
+
+# Collections read from the JSON objects and Python modules by default
+DEFAULT_COLLECTIONS = ("clients", "policies")
+
+NDJSON_SUFFIXES = (".ndjson", ".jsonl")
+
+# Strings, comments and brackets of a Python module. Strings and comments are
+# matched whole so their content is skipped; "partial" is the start of one
+# that ends past the data read so far.
+_PYTHON_TOKENS = re.compile(
+    r"(?P<string>"
+    r'"{3}[\s\S]*?"{3}'
+    r"|'{3}[\s\S]*?'{3}"
+    r'|"(?!"")(?:[^"\\\n]|\\[\s\S])*"'
+    r"|'(?!'')(?:[^'\\\n]|\\[\s\S])*')"
+    r"|(?P<comment>#[^\n]*\n)"
+    r"""|(?P<partial>"{3}|'{3}|["'#])"""
+    r"|(?P<bracket>[()\[\]{},])"
+)
+
+Record = Tuple[str, Any]
+
+
+def _open(path: Path) -> IO[bytes]:
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _stem(path: Path) -> str:
+    # Name of the file without the compression suffix
+    return path.name[:-3] if path.suffix == ".gz" else path.name
+
+
+def read_ndjson(path: Path, collection: str) -> Iterator[Record]:
+    """
+    Read the documents of a NDJSON file, one JSON document per line.
+
+    Args:
+        path (Path): File, gzip'd when its name ends with `.gz`.
+        collection (str): Collection of the documents.
+
+    Yields:
+        Record: (collection, document) pairs.
+
+    Raises:
+        ValueError: If a line is not valid JSON.
+    """
+    with _open(path) as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield collection, json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{number}: {e}") from e
+
+
+def read_json(path: Path, collections: Optional[Sequence[str]]) -> Iterator[Record]:
+    """
+    Read the documents of a JSON file. An array holds the documents of a
+    single collection; an object holds one array by collection, and the file
+    is read once per collection.
+
+    Args:
+        path (Path): File, gzip'd when its name ends with `.gz`.
+        collections (Optional[Sequence[str]]): Collections to read, None for
+            the default ones of an object.
+
+    Yields:
+        Record: (collection, document) pairs.
+
+    Raises:
+        ValueError: If the file is not valid JSON, or is an array and not
+            exactly one collection is given.
+    """
+    with _open(path) as file:
+        head = file.read(CHUNK_SIZE).lstrip()
+    if head.startswith(b"["):
+        if not collections or len(collections) != 1:
+            raise ValueError(f"{path}: JSON arrays need exactly one collection")
+        keys = [None]
+    else:
+        keys = list(collections or DEFAULT_COLLECTIONS)
+    for key in keys:
+        parser = JSONArrayStream(key)
+        collection = key or collections[0]
+        with _open(path) as file:
+            while chunk := file.read(CHUNK_SIZE):
+                for document in parser.feed(chunk):
+                    yield collection, document
+            for document in parser.feed(b"", final=True):
+                yield collection, document
+        if not parser.found:
+            app_logger.warning(f"No {collection} array in {path}")
+
+
+def read_python_literal(
+    path: Path, collections: Optional[Sequence[str]] = None
+) -> Iterator[Record]:
+    """
+    Read the documents of a Python module assigning a dict of lists, such as
+    `data/raw.py`. The module is scanned as it is read, and the source of
+    each document is evaluated on its own with `ast.literal_eval`, so only
+    one document is held in memory at a time.
+
+    Args:
+        path (Path): Python module.
+        collections (Optional[Sequence[str]]): Keys of the dict to read, None
+            for every key.
+
+    Yields:
+        Record: (collection, document) pairs.
+
+    Raises:
+        ValueError: If a document is not a Python literal.
+    """
+    stack: List[str] = []
+    key = None
+    # Start of the source of the current document in the buffer
+    start: Optional[int] = None
+    buffer = ""
+    position = 0
+
+    def document(end: int) -> Iterator[Record]:
+        source = buffer[start:end].strip()
+        if not source or (collections is not None and key not in collections):
+            return
+        try:
+            yield key, ast.literal_eval(source)
+        except (SyntaxError, ValueError) as e:
+            raise ValueError(f"{path}: invalid {key} document: {e}") from e
+
+    with open(path, encoding="utf-8") as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            buffer += chunk
+            while match := _PYTHON_TOKENS.search(buffer, position):
+                kind = match.lastgroup
+                if chunk and (kind == "partial" or match.end() == len(buffer)):
+                    # It may go on in the next chunk
+                    break
+                position = match.end()
+                if kind == "string" and stack == ["{"]:
+                    key = ast.literal_eval(match.group())
+                if kind != "bracket":
+                    continue
+                char = match.group()
+                in_list = stack[:2] == ["{", "["]
+                if char in "([{":
+                    if stack == ["{"] and char == "[":
+                        start = position
+                    stack.append(char)
+                elif char in ")]}":
+                    if not stack:
+                        raise ValueError(f"{path}: unbalanced {char}")
+                    stack.pop()
+                    if in_list and stack == ["{"]:
+                        yield from document(match.start())
+                        start = None
+                elif in_list and len(stack) == 2:
+                    yield from document(match.start())
+                    start = position
+            if not chunk:
+                break
+            # Keep the source of the current document only
+            cut = position if start is None else start
+            buffer = buffer[cut:]
+            position -= cut
+            if start is not None:
+                start -= cut
+
+
+def read_records(
+    path: Path, collections: Optional[Sequence[str]] = None
+) -> Iterator[Record]:
+    """
+    Read the documents of a file, choosing the reader from its name.
+
+    Args:
+        path (Path): `.py`, `.json`, `.ndjson` or `.jsonl` file, the JSON
+            ones optionally gzip'd.
+        collections (Optional[Sequence[str]]): Collections to read. NDJSON
+            files and JSON arrays need exactly one.
+
+    Returns:
+        Iterator[Record]: (collection, document) pairs.
+
+    Raises:
+        ValueError: If the file type is unknown or the collection is missing.
+    """
+    name = _stem(path)
+    if path.suffix == ".py":
+        return read_python_literal(path, collections)
+    if name.endswith(NDJSON_SUFFIXES):
+        if not collections or len(collections) != 1:
+            raise ValueError(f"{path}: NDJSON files need exactly one collection")
+        return read_ndjson(path, collections[0])
+    if name.endswith(".json"):
+        return read_json(path, collections)
+    raise ValueError(f"{path}: unknown file type")
+
+
+class _RecordReader:
+    """
+    Reads the records of the files in batches, in a worker thread so the
+    writes keep going while the files are read.
+    """
+
+    def __init__(self, records: Iterator[Record], batch_size: int):
+        self.records = records
+        self.batch_size = batch_size
+        self.buffer: Deque[Record] = deque()
+
+    async def peek(self) -> Optional[str]:
+        """
+        Collection of the next record, None once every record was read.
+        """
+        if not self.buffer:
+            self.buffer.extend(
+                await asyncio.to_thread(
+                    list, itertools.islice(self.records, self.batch_size)
+                )
+            )
+        return self.buffer[0][0] if self.buffer else None
+
+    async def documents(self, collection: str) -> AsyncIterator[Any]:
+        """
+        Yield the documents up to the first record of another collection.
+        """
+        while await self.peek() == collection:
+            yield self.buffer.popleft()[1]
+
+
+def mongo_collection(name: str) -> str:
+    """
+    Name of the MongoDB collection of a cached collection, from the
+    DB_COLLECTION_<NAME> settings.
+    """
+    return config(f"DB_COLLECTION_{name.upper()}", default=name)
+
+
+async def ingest_to_mongo(
+    records: Iterator[Record],
+    stats: Dict[str, SourceStats],
+    batch_size: int = INGEST_BATCH_SIZE,
+    max_in_flight: int = INGEST_MAX_IN_FLIGHT,
+    crud_factory: Optional[Callable[[str], Any]] = None,
+) -> None:
+    """
+    Insert the documents into their MongoDB collections in unordered
+    `insert_many` batches, see `JSONDataToMongoDB.store_json_stream`.
+
+    Args:
+        records (Iterator[Record]): (collection, document) pairs.
+        stats (Dict[str, SourceStats]): Statistics by collection, updated.
+        batch_size (int): Maximum number of documents per batch.
+        max_in_flight (int): Maximum number of batches sent concurrently.
+        crud_factory: Builds the MongoDBAtlasCRUD of a collection name.
+            Defaults to MongoDBAtlasCRUD itself.
+    """
+    from webapi.data.database import MongoDBAtlasCRUD
+    from webapi.data.store_json import JSONDataToMongoDB
+
+    crud_factory = crud_factory or MongoDBAtlasCRUD
+    reader = _RecordReader(records, batch_size)
+    cruds = {}
+
+    async def documents(name: str, collection: SourceStats):
+        async for document in reader.documents(name):
+            collection.parsed += 1
+            yield document
+
+    try:
+        while (name := await reader.peek()) is not None:
+            collection = stats.setdefault(name, SourceStats())
+            collection.started_at = collection.started_at or time.perf_counter()
+            if name not in cruds:
+                cruds[name] = crud_factory(mongo_collection(name))
+            report = await JSONDataToMongoDB(cruds[name], None).store_json_stream(
+                documents(name, collection), batch_size, max_in_flight
+            )
+            collection.written += report.inserted
+            collection.failed += report.failed
+            for _, message in report.errors:
+                collection.error(f"write: {message}")
+            collection.finished_at = time.perf_counter()
+    finally:
+        for crud in cruds.values():
+            if hasattr(crud, "client"):
+                crud.client.close()
+
+
+async def ingest_to_snapshot(
+    records: Iterator[Record],
+    stats: Dict[str, SourceStats],
+    path: str,
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> int:
+    """
+    Load the documents into cached tables and save them as a cache snapshot.
+
+    Args:
+        records (Iterator[Record]): (collection, document) pairs.
+        stats (Dict[str, SourceStats]): Statistics by collection, updated.
+        path (str): Snapshot file.
+        batch_size (int): Number of documents read at a time.
+
+    Returns:
+        int: Size of the snapshot in bytes.
+    """
+    reader = _RecordReader(records, batch_size)
+    tables: Dict[str, IndexedCache] = {}
+    while (name := await reader.peek()) is not None:
+        async for document in reader.documents(name):
+            collection = stats.setdefault(name, SourceStats())
+            collection.started_at = collection.started_at or time.perf_counter()
+            collection.parsed += 1
+            if name not in tables:
+                tables[name] = IndexedCache.for_collection(name)
+            table = tables[name]
+            if not isinstance(document, dict) or table.key not in document:
+                collection.invalid += 1
+                collection.error(f"invalid document: {str(document)[:80]}")
+                continue
+            table.upsert(document)
+            collection.written += 1
+            collection.finished_at = time.perf_counter()
+    return await asyncio.to_thread(CacheSnapshot(path).dump, tables)
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Peak resident memory of the process, in bytes, or None where it is not
+    available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def ingest(
+    paths: Sequence[str],
+    target: str = "mongo",
+    snapshot: Optional[str] = None,
+    collections: Optional[Sequence[str]] = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+    max_in_flight: int = INGEST_MAX_IN_FLIGHT,
+    crud_factory: Optional[Callable[[str], Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Ingest local files into MongoDB or into a cache snapshot.
+
+    Args:
+        paths (Sequence[str]): Files to read, see `read_records`.
+        target (str): "mongo" or "snapshot".
+        snapshot (Optional[str]): Snapshot file, for the "snapshot" target.
+        collections (Optional[Sequence[str]]): Collections to read.
+        batch_size (int): Maximum number of documents per batch.
+        max_in_flight (int): Maximum number of batches sent concurrently.
+        crud_factory: Builds the MongoDBAtlasCRUD of a collection name.
+            Defaults to MongoDBAtlasCRUD itself.
+
+    Returns:
+        Dict[str, Any]: Statistics by collection, total records, seconds,
+        records per second and peak RSS in bytes.
+    """
+    stats: Dict[str, SourceStats] = {}
+    # The files are chained so every collection is written once
+    records = itertools.chain.from_iterable(
+        read_records(Path(path), collections) for path in paths
+    )
+    started = time.perf_counter()
+    if target == "snapshot":
+        if not snapshot:
+            raise ValueError("The snapshot target needs a snapshot file")
+        await ingest_to_snapshot(records, stats, snapshot, batch_size)
+    elif target == "mongo":
+        await ingest_to_mongo(records, stats, batch_size, max_in_flight, crud_factory)
+    else:
+        raise ValueError(f"Unknown target {target}")
+    seconds = time.perf_counter() - started
+
+    records_count = sum(collection.parsed for collection in stats.values())
+    return {
+        "collections": {
+            name: collection.report() for name, collection in stats.items()
+        },
+        "records": records_count,
+        "seconds": round(seconds, 3),
+        "records_per_second": round(records_count / seconds, 1) if seconds else 0.0,
+        "peak_rss": peak_rss(),
+    }
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Ingest local JSON, NDJSON or Python data files."
+    )
+    parser.add_argument("paths", nargs="+", help="files to ingest")
+    parser.add_argument(
+        "--to", dest="target", choices=("mongo", "snapshot"), default="mongo"
+    )
+    parser.add_argument(
+        "--snapshot",
+        default=config("CACHE_SNAPSHOT_PATH", default="", cast=str),
+        help="snapshot file written by --to snapshot (CACHE_SNAPSHOT_PATH)",
+    )
+    parser.add_argument(
+        "--collection",
+        dest="collections",
+        action="append",
+        help="collection to read, can be repeated; NDJSON files need one",
+    )
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--max-in-flight", type=int, default=INGEST_MAX_IN_FLIGHT)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    summary = asyncio.run(
+        ingest(
+            args.paths,
+            target=args.target,
+            snapshot=args.snapshot,
+            collections=args.collections,
+            batch_size=args.batch_size,
+            max_in_flight=args.max_in_flight,
+        )
+    )
+
+    for name, collection in summary["collections"].items():
+        print(
+            f"{name}: {collection['parsed']} records, {collection['written']} "
+            f"written, {collection['invalid']} invalid, {collection['failed']} "
+            f"failed"
+        )
+        for error in collection["errors"]:
+            print(f"  {error}")
+    rss = summary["peak_rss"]
+    print(
+        f"Ingested {summary['records']} records in {summary['seconds']:.3f}s "
+        f"({summary['records_per_second']:.1f} records/s), peak RSS "
+        + (f"{rss / 2**20:.1f} MiB" if rss is not None else "unknown")
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    main()
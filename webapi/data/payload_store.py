@@ -0,0 +1,228 @@
+"""
+webapi/data/payload_store.py
+
+This module contains the local store of upstream payloads. The last payload
+fetched from each URL is kept on disk with its `ETag` and `Last-Modified`
+validators, so the next fetch can be a conditional GET: when the upstream
+answers 304 Not Modified, the stored payload is still current and neither the
+download nor the work depending on it has to be repeated.
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict
+from typing import Optional
+from typing import Union
+
+from decouple import config
+
+from webapi.logs.logger import app_logger
+
+UPSTREAM_PAYLOAD_DIR = config("UPSTREAM_PAYLOAD_DIR", default="", cast=str)
+
+
+def _temporary_path(path: Path) -> Path:
+    return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+
+def _write_atomically(path: Path, data: bytes) -> None:
+    temporary = _temporary_path(path)
+    with open(temporary, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+class PayloadWriter:
+    """
+    Temporary file a payload is written to chunk by chunk, so it is stored
+    without being held in memory. It replaces the stored payload of its URL
+    only once committed.
+    """
+
+    def __init__(self, store: "PayloadStore", url: str, metadata: dict):
+        """
+        Initialize the PayloadWriter object.
+
+        Args:
+            store (PayloadStore): Store of the payload.
+            url (str): Upstream URL.
+            metadata (dict): Validators of the payload.
+
+        Raises:
+            OSError: If the temporary file cannot be created.
+        """
+        self.url = url
+        self.metadata = metadata
+        self.size = 0
+        self.payload_path, self.metadata_path = store._paths(url)
+        store.directory.mkdir(parents=True, exist_ok=True)
+        self.temporary = _temporary_path(self.payload_path)
+        self.file = open(self.temporary, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        """
+        Append a chunk of the payload.
+
+        Args:
+            chunk (bytes): Next bytes of the payload.
+        """
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> None:
+        """
+        Store the written payload and its validators in place of the previous
+        ones. The metadata is written last, so it never describes a partial
+        payload.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temporary, self.payload_path)
+        metadata = {**self.metadata, "size": self.size, "saved_at": time.time()}
+        _write_atomically(self.metadata_path, json.dumps(metadata).encode())
+
+    def discard(self) -> None:
+        """
+        Drop the written payload, keeping the stored one.
+        """
+        self.file.close()
+        self.temporary.unlink(missing_ok=True)
+
+
+class PayloadStore:
+    """
+    Directory holding the last payload of each upstream URL and its
+    validators.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        """
+        Initialize the PayloadStore object.
+
+        Args:
+            directory (Union[str, Path]): Directory of the stored payloads.
+        """
+        self.directory = Path(directory)
+
+    def _paths(self, url: str):
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return (
+            self.directory / f"{name}.payload",
+            self.directory / f"{name}.meta.json",
+        )
+
+    def _metadata(self, url: str) -> Optional[dict]:
+        payload_path, metadata_path = self._paths(url)
+        try:
+            metadata = json.loads(metadata_path.read_text())
+            if metadata["url"] != url or metadata["size"] != os.path.getsize(
+                payload_path
+            ):
+                return None
+            return metadata
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def validators(self, url: str) -> Dict[str, str]:
+        """
+        Get the conditional request headers for a URL.
+
+        Args:
+            url (str): Upstream URL.
+
+        Returns:
+            Dict[str, str]: `If-None-Match` and `If-Modified-Since` headers
+            from the validators of the stored payload, empty if there is none.
+        """
+        metadata = self._metadata(url)
+        if metadata is None:
+            return {}
+        headers = {}
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+        return headers
+
+    def load(self, url: str) -> Optional[bytes]:
+        """
+        Read the stored payload of a URL.
+
+        Args:
+            url (str): Upstream URL.
+
+        Returns:
+            Optional[bytes]: The payload, or None if there is none.
+        """
+        if self._metadata(url) is None:
+            return None
+        payload_path, _ = self._paths(url)
+        try:
+            return payload_path.read_bytes()
+        except OSError:
+            return None
+
+    def writer(
+        self,
+        url: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> Optional[PayloadWriter]:
+        """
+        Start storing the payload of a URL, to be written chunk by chunk.
+        Payloads without any validator cannot be revalidated and are not
+        stored.
+
+        Args:
+            url (str): Upstream URL.
+            etag (Optional[str]): `ETag` response header.
+            last_modified (Optional[str]): `Last-Modified` response header.
+
+        Returns:
+            Optional[PayloadWriter]: The writer, or None if the payload is
+            not stored.
+        """
+        if not (etag or last_modified):
+            return None
+        metadata = {"url": url, "etag": etag, "last_modified": last_modified}
+        try:
+            return PayloadWriter(self, url, metadata)
+        except OSError as e:
+            app_logger.error(f"Error storing upstream payload of {url}: {e}")
+            return None
+
+    def save(
+        self,
+        url: str,
+        payload: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        """
+        Store the payload of a URL with its validators. Payloads without any
+        validator cannot be revalidated and are not stored.
+
+        Args:
+            url (str): Upstream URL.
+            payload (bytes): Response body.
+            etag (Optional[str]): `ETag` response header.
+            last_modified (Optional[str]): `Last-Modified` response header.
+        """
+        writer = self.writer(url, etag=etag, last_modified=last_modified)
+        if writer is None:
+            return
+        try:
+            writer.write(payload)
+            writer.commit()
+        except OSError as e:
+            writer.discard()
+            app_logger.error(f"Error storing upstream payload of {url}: {e}")
+
+
+# Shared by every JSONData instance, None when conditional fetches are disabled
+payload_store = PayloadStore(UPSTREAM_PAYLOAD_DIR) if UPSTREAM_PAYLOAD_DIR else None
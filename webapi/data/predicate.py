@@ -0,0 +1,199 @@
+"""
+webapi/data/predicate.py
+
+This module compiles search parameters into a single predicate that is run
+synchronously over cached rows.
+
+Search parameters map a field to either a value (equality) or a dictionary
+of operators:
+
+    {"role": "admin", "amountInsured": {"$gte": 100, "$lt": 1000}}
+    {"clientId": {"$in": ["a0ece5db", "e8fd159b"]}}
+
+Values are converted once, at compile time, to the type the field has in the
+data, so ``{"userId": "1"}`` matches rows where ``userId`` is the integer 1
+without converting every row value to a string.
+"""
+import operator
+from itertools import islice
+from operator import itemgetter
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+RANGE_OPERATORS = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+SUPPORTED_OPERATORS = {"$eq", "$in", *RANGE_OPERATORS}
+
+# Number of rows inspected to find the type of a field
+SAMPLE_SIZE = 100
+
+
+def _field_type(field: str, sample: List[dict]) -> Optional[type]:
+    for row in sample:
+        if field in row and row[field] is not None:
+            return type(row[field])
+    return None
+
+
+def _coerce(value: Any, field_type: Optional[type]) -> Any:
+    """
+    Convert a search value to the type of the field it is compared with.
+    Values that cannot be converted are returned unchanged.
+    """
+    if field_type is None or isinstance(value, field_type):
+        return value
+    if not isinstance(value, str):
+        return value
+    try:
+        if field_type is bool:
+            lowered = value.lower()
+            if lowered in ("true", "1"):
+                return True
+            if lowered in ("false", "0"):
+                return False
+            return value
+        if field_type in (int, float):
+            return field_type(value)
+    except ValueError:
+        return value
+    return value
+
+
+class CompiledPredicate:
+    """
+    Predicate compiled from search parameters. Calling it with a row returns
+    whether the row matches.
+    """
+
+    def __init__(self, equalities: Dict[str, Any], conditions: List[tuple]):
+        """
+        Initialize the CompiledPredicate object.
+
+        Args:
+            equalities (Dict[str, Any]): Fields that must equal a value.
+            conditions (List[tuple]): (field, test) pairs for the other
+                operators, where test takes the row value.
+        """
+        self.equalities = equalities
+        self.conditions = conditions
+        self._match = self._build()
+
+    def _build(self) -> Callable[[dict], bool]:
+        conditions = self.conditions
+        if self.equalities:
+            getter = itemgetter(*self.equalities)
+            expected = tuple(self.equalities.values())
+            if len(expected) == 1:
+                expected = expected[0]
+        else:
+            getter = None
+
+        if getter is None and not conditions:
+            return lambda row: True
+
+        def match(row: dict) -> bool:
+            try:
+                if getter is not None and getter(row) != expected:
+                    return False
+                for field, test in conditions:
+                    if not test(row[field]):
+                        return False
+            except (KeyError, TypeError):
+                # Missing field, or a value that cannot be compared
+                return False
+            return True
+
+        return match
+
+    def __call__(self, row: dict) -> bool:
+        return self._match(row)
+
+    def filter(self, rows: Iterable[dict]) -> List[dict]:
+        """
+        Get the matching rows. When the rows are an indexed cache table and
+        an equality is on an indexed field, only the rows found through the
+        index are tested.
+
+        Args:
+            rows: List of rows, or an IndexedCache.
+
+        Returns:
+            List[dict]: The matching rows, in their original order.
+        """
+        if hasattr(rows, "is_indexed"):
+            indexed = [field for field in self.equalities if rows.is_indexed(field)]
+            if indexed:
+                try:
+                    candidates = min(
+                        (
+                            rows.ids_for(field, self.equalities[field])
+                            for field in indexed
+                        ),
+                        key=len,
+                    )
+                except TypeError:
+                    # Unhashable value, it cannot be in the index
+                    return []
+                return [rows[key] for key in candidates if self._match(rows[key])]
+            rows = rows.values()
+
+        return list(filter(self._match, rows))
+
+
+def compile_predicate(
+    search_params: Dict[str, Any], rows: Optional[Iterable[dict]] = None
+) -> CompiledPredicate:
+    """
+    Compile search parameters into a predicate.
+
+    Args:
+        search_params (Dict[str, Any]): Field values or operator dictionaries.
+        rows (Optional[Iterable[dict]]): Rows used to find the type of each
+            field. When None, values are compared as given.
+
+    Returns:
+        CompiledPredicate: The predicate.
+
+    Raises:
+        ValueError: If an operator is not supported.
+    """
+    sample = None
+    if rows is not None:
+        values = rows.values() if hasattr(rows, "is_indexed") else rows
+        sample = list(islice(values, SAMPLE_SIZE))
+
+    equalities = {}
+    conditions = []
+    for field, value in search_params.items():
+        field_type = _field_type(field, sample) if sample is not None else None
+
+        if not isinstance(value, dict):
+            equalities[field] = _coerce(value, field_type)
+            continue
+
+        for name, operand in value.items():
+            if name not in SUPPORTED_OPERATORS:
+                raise ValueError(f"Unsupported search operator: {name}")
+            if name == "$eq":
+                equalities[field] = _coerce(operand, field_type)
+            elif name == "$in":
+                options = [_coerce(option, field_type) for option in operand]
+                try:
+                    options = frozenset(options)
+                except TypeError:
+                    pass
+                conditions.append((field, options.__contains__))
+            else:
+                bound = _coerce(operand, field_type)
+                compare = RANGE_OPERATORS[name]
+                conditions.append((field, lambda item, c=compare, b=bound: c(item, b)))
+
+    return CompiledPredicate(equalities, conditions)
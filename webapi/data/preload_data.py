@@ -4,16 +4,24 @@ webapi/data/preload_data.py
 This script is used to fill up the database with the given data from the problem
 statement.
 
-There will be two calls, one for each data source.
+The two data sources, and any other source declared in the INGEST_SOURCES file,
+are ingested concurrently, see `webapi.data.ingest`.
 
 """
 # from decouple import config
 import asyncio
 
 from decouple import config
+from motor.motor_asyncio import AsyncIOMotorClient
 
-from webapi.data.database import MongoDBAtlasCRUD
-from webapi.data.store_json import JSONDataToMongoDB
+from webapi.data.http_session import http_sessions
+from webapi.data.ingest import INGEST_FETCH_CONCURRENCY
+from webapi.data.ingest import INGEST_SOURCES
+from webapi.data.ingest import IngestPipeline
+from webapi.data.ingest import IngestSource
+from webapi.data.ingest import load_sources
+from webapi.data.store_json import INGEST_BATCH_SIZE
+from webapi.data.store_json import INGEST_MAX_IN_FLIGHT
 
 # read the connection string from the environment variables
 mongodb_connection_string = config("DB_URL")
@@ -29,33 +37,26 @@ datasource2 = "https://www.mocky.io/v2/580891a4100000e8242b75c5"
 
 
 async def main():
-    # Create a MongoDBAtlasCRUD instance
-    crud_instance_clients = await MongoDBAtlasCRUD.create_instance(
-        collection_name=db_collection_clients
+    sources = [
+        IngestSource(datasource1, db_collection_clients, root_key="clients"),
+        IngestSource(datasource2, db_collection_policies, root_key="policies"),
+    ]
+    if INGEST_SOURCES:
+        sources.extend(load_sources(INGEST_SOURCES))
+
+    client = AsyncIOMotorClient(mongodb_connection_string)
+    pipeline = IngestPipeline(
+        client[db_name],
+        batch_size=INGEST_BATCH_SIZE,
+        fetch_concurrency=INGEST_FETCH_CONCURRENCY,
+        write_concurrency=INGEST_MAX_IN_FLIGHT,
     )
-    crud_instance_policies = await MongoDBAtlasCRUD.create_instance(
-        collection_name=db_collection_policies
-    )
-
-    # Create a JSONDataToMongoDB instance
-    json_data_to_mongodb_clients = JSONDataToMongoDB(crud_instance_clients)
-    json_data_to_mongodb_policies = JSONDataToMongoDB(crud_instance_policies)
-
-    # Fetch JSON data from a URL
-    json_data1 = await json_data_to_mongodb_clients.fetch_data_from_json_url(
-        datasource1
-    )
-    json_data2 = await json_data_to_mongodb_policies.fetch_data_from_json_url(
-        datasource2
-    )
-
-    # Extract the data from the dictionary
-    json_post1 = json_data1["clients"]
-    json_post2 = json_data2["policies"]
-
-    # Store JSON data into the MongoDB Atlas database
-    await json_data_to_mongodb_clients.store_json_data(json_post1)
-    await json_data_to_mongodb_policies.store_json_data(json_post2)
+    try:
+        # Store the JSON data of every source into the MongoDB Atlas database
+        await pipeline.run(sources)
+    finally:
+        client.close()
+        await http_sessions.close()
 
 
 if __name__ == "__main__":
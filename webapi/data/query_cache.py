@@ -0,0 +1,167 @@
+"""
+webapi/data/query_cache.py
+
+This module contains the cache of MongoDB query results used by the read path.
+Results are stored in an aiocache memory backend keyed on the collection and
+the normalized query, expire after a per-route TTL and are evicted in LRU
+order once the cache holds too many entries.
+"""
+import json
+from collections import OrderedDict
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from aiocache import SimpleMemoryCache
+
+from webapi.logs.logger import app_logger
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query results with a TTL per entry.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30, backend=None):
+        """
+        Initialize the QueryCache object.
+
+        Args:
+            max_size (int): Maximum number of cached results.
+            ttl (float): Default time to live of a result, in seconds.
+            backend: aiocache backend storing the results. Defaults to a
+                SimpleMemoryCache.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend or SimpleMemoryCache(namespace="query:")
+        # Cached keys in LRU order, with the collections each result depends on
+        self._keys: "OrderedDict[str, Tuple[str, ...]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(collection: str, query: Any) -> str:
+        """
+        Build the cache key of a query, independent of the order of its fields.
+
+        Args:
+            collection (str): Name of the queried collection.
+            query: MongoDB filter or aggregation pipeline.
+
+        Returns:
+            str: The cache key.
+        """
+        normalized = json.dumps(
+            query, sort_keys=True, separators=(",", ":"), default=str
+        )
+        return f"{collection}:{normalized}"
+
+    async def get(self, key: str) -> Any:
+        """
+        Get a cached result and mark it as recently used.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            The cached result, or None if missing or expired.
+        """
+        value = await self.backend.get(key)
+        if value is None:
+            self._keys.pop(key, None)
+            self.misses += 1
+            return None
+        if key in self._keys:
+            self._keys.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        ttl: Optional[float] = None,
+        collections: Sequence[str] = (),
+    ) -> None:
+        """
+        Cache a result, evicting the least recently used ones if needed.
+
+        Args:
+            key (str): Cache key.
+            value: Result to cache.
+            ttl (Optional[float]): Time to live in seconds. Defaults to the
+                cache TTL.
+            collections (Sequence[str]): Collections whose changes invalidate
+                the result.
+        """
+        await self.backend.set(key, value, ttl=ttl or self.ttl)
+        self._keys[key] = tuple(collections)
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            evicted, _ = self._keys.popitem(last=False)
+            await self.backend.delete(evicted)
+
+    async def get_or_fetch(
+        self,
+        collection: str,
+        query: Any,
+        fetch: Callable[[], Awaitable[Any]],
+        ttl: Optional[float] = None,
+        depends_on: Sequence[str] = (),
+    ) -> Any:
+        """
+        Get the result of a query from the cache, or run it and cache it.
+        None results are not cached.
+
+        Args:
+            collection (str): Name of the queried collection.
+            query: MongoDB filter or aggregation pipeline.
+            fetch: Coroutine function running the query.
+            ttl (Optional[float]): Time to live of the result in seconds.
+            depends_on (Sequence[str]): Other collections read by the query,
+                such as the target of a `$lookup`.
+
+        Returns:
+            The query result.
+        """
+        key = self.make_key(collection, query)
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        value = await fetch()
+        if value is not None:
+            await self.set(key, value, ttl=ttl, collections=(collection, *depends_on))
+        return value
+
+    async def invalidate(self, collection: str) -> int:
+        """
+        Drop every cached result that depends on a collection.
+
+        Args:
+            collection (str): Name of the collection that changed.
+
+        Returns:
+            int: Number of results dropped.
+        """
+        keys = [key for key, tags in self._keys.items() if collection in tags]
+        for key in keys:
+            del self._keys[key]
+            await self.backend.delete(key)
+        if keys:
+            app_logger.info(f"Invalidated {len(keys)} cached {collection} queries")
+        return len(keys)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of cached results, hits and misses.
+
+        Returns:
+            Dict[str, int]: The counters.
+        """
+        return {"size": len(self._keys), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,392 @@
+"""
+webapi/data/reader.py
+
+This module contains the read path used by the routers. Depending on the
+configured read mode, queries are answered by MongoDB, by the in-memory cache
+loaded at startup, or by the cache with MongoDB as a fallback.
+"""
+import time
+from enum import Enum
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from webapi.data.cache_index import IndexedCache
+from webapi.data.columnar import PolicyColumns
+from webapi.data.generation import current_generation
+from webapi.data.join_index import JoinIndex
+from webapi.data.negative_cache import NegativeCache
+from webapi.data.query_cache import QueryCache
+from webapi.data.single_flight import SingleFlight
+from webapi.logs.logger import app_logger
+
+
+class ReadMode(str, Enum):
+    """
+    Where the routers read their data from.
+
+    - mongo: every query goes to MongoDB.
+    - cache: queries are answered by the cache, MongoDB is only used when the
+      cache is not loaded or is stale.
+    - cache-with-mongo-fallback: as cache, and queries with no result in the
+      cache are retried against MongoDB.
+    """
+
+    mongo = "mongo"
+    cache = "cache"
+    cache_with_mongo_fallback = "cache-with-mongo-fallback"
+
+
+class DataReader:
+    """
+    Class to answer the router queries from MongoDB or from the cache.
+    """
+
+    def __init__(
+        self,
+        app,
+        mode: ReadMode = ReadMode.mongo,
+        max_age: float = 0,
+        query_cache: Optional[QueryCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        negative_cache: Optional[NegativeCache] = None,
+    ):
+        """
+        Initialize the DataReader object.
+
+        Args:
+            app: FastAPI application holding the ``mongodb`` and ``cache``
+                attributes.
+            mode (ReadMode): Where to read the data from.
+            max_age (float): Seconds after which a cached table is considered
+                stale. 0 disables the check.
+            query_cache (Optional[QueryCache]): Cache for the results of the
+                MongoDB queries run with a TTL.
+            single_flight (Optional[SingleFlight]): Coalesces concurrent
+                identical MongoDB queries. Defaults to a new SingleFlight.
+            negative_cache (Optional[NegativeCache]): Remembers the MongoDB
+                queries without result. None disables it.
+        """
+        self.app = app
+        self.mode = ReadMode(mode)
+        self.max_age = max_age
+        self.query_cache = query_cache
+        self.single_flight = single_flight or SingleFlight()
+        self.negative_cache = negative_cache
+        self._join: Optional[JoinIndex] = None
+
+    def cached_table(
+        self, db_name: str, partial_ok: bool = False
+    ) -> Optional[IndexedCache]:
+        """
+        Get the cached table of a collection if it can be used for reads.
+
+        Args:
+            db_name (str): Name of the collection.
+            partial_ok (bool): Accept a table missing documents evicted to
+                respect its memory budget. Only lookups falling back to
+                MongoDB on a miss can use such a table.
+
+        Returns:
+            Optional[IndexedCache]: The table, or None when reading from the
+            cache is disabled, the table is not loaded, incomplete or stale.
+        """
+        if self.mode is ReadMode.mongo:
+            return None
+
+        table = self.cache_tables().get(db_name)
+        if not isinstance(table, IndexedCache):
+            return None
+
+        if not (partial_ok or table.complete):
+            return None
+
+        if self.max_age and time.monotonic() - table.refreshed_at > self.max_age:
+            app_logger.warning(f"Cache for {db_name} is stale, reading from MongoDB")
+            return None
+
+        return table
+
+    def cache_tables(self) -> Dict[str, Any]:
+        """
+        Get the cached tables of the generation the current request is pinned
+        to, or of the current generation outside of a request.
+
+        Returns:
+            Dict[str, Any]: Cached tables by name.
+        """
+        generation = current_generation.get()
+        if generation is not None:
+            return generation.tables
+        return getattr(self.app, "cache", None) or {}
+
+    def join_index(self, clients: IndexedCache, policies: IndexedCache) -> JoinIndex:
+        """
+        Get the client/policy join of the cached tables. The join prepared
+        with their generation is used when there is one; otherwise it is built
+        when the tables are first joined or replaced, and then follows their
+        changes.
+
+        Args:
+            clients (IndexedCache): Cached clients.
+            policies (IndexedCache): Cached policies.
+
+        Returns:
+            JoinIndex: The join.
+        """
+        generation = current_generation.get() or getattr(
+            self.app, "cache_generation", None
+        )
+        if generation is not None and generation.join is not None:
+            if generation.join.covers(clients, policies):
+                return generation.join
+        if self._join is None or not self._join.covers(clients, policies):
+            self._join = JoinIndex(clients, policies)
+        return self._join
+
+    @staticmethod
+    def _match_cached(
+        db_name: str, table: IndexedCache, query: Dict[str, Any]
+    ) -> List[dict]:
+        """
+        Run an equality query on a cached table. Policy queries are narrowed
+        by their most selective indexed equality, and the rest of the query
+        is answered by the vectorized policy columns.
+        """
+        if db_name != "policies" or not PolicyColumns.supports(query):
+            return table.find(query)
+        columns = PolicyColumns.for_table(table)
+        indexed = [field for field in query if table.is_indexed(field)]
+        if not indexed:
+            return columns.filter(query)
+        try:
+            field, keys = min(
+                ((field, table.ids_for(field, query[field])) for field in indexed),
+                key=lambda candidates: len(candidates[1]),
+            )
+        except TypeError:
+            # Unhashable value, it cannot be in the index
+            return []
+        rest = {name: value for name, value in query.items() if name != field}
+        return columns.filter(rest, keys=keys)
+
+    def _use_fallback(self, result) -> bool:
+        return not result and self.mode is ReadMode.cache_with_mongo_fallback
+
+    async def _query_mongo(
+        self,
+        db_name: str,
+        query: Any,
+        fetch,
+        ttl: Optional[float] = None,
+        depends_on=(),
+        operation: str = "find",
+        empty: Callable[[], Any] = lambda: None,
+    ):
+        """
+        Run a MongoDB query through the query cache when a TTL is given.
+        Concurrent identical queries missing the query cache share a single
+        execution, and queries recently found to have no result return
+        `empty()` without reaching MongoDB.
+        """
+        key = SingleFlight.make_key(operation, db_name, query)
+        negative_cache = self.negative_cache
+        if negative_cache is not None and negative_cache.is_missing(key):
+            return empty()
+
+        async def coalesced():
+            return await self.single_flight.do(key, fetch)
+
+        if ttl is None or self.query_cache is None:
+            result = await coalesced()
+        else:
+            result = await self.query_cache.get_or_fetch(
+                db_name, query, coalesced, ttl=ttl, depends_on=depends_on
+            )
+
+        if not result and negative_cache is not None:
+            negative_cache.add(key, collections=(db_name, *depends_on))
+        return result
+
+    async def find(
+        self, db_name: str, query: Dict[str, Any], ttl: Optional[float] = None
+    ) -> List[dict]:
+        """
+        Find the documents of a collection matching an equality query.
+
+        Args:
+            db_name (str): Name of the collection.
+            query (Dict[str, Any]): Query to filter documents.
+            ttl (Optional[float]): Seconds to keep the MongoDB result in the
+                query cache. None skips the query cache.
+
+        Returns:
+            List[dict]: The matching documents.
+        """
+        query = self._normalize(query)
+        table = self.cached_table(db_name)
+        if table is not None:
+            result = self._match_cached(db_name, table, query)
+            if not self._use_fallback(result):
+                return result
+
+        async def fetch():
+            cursor = self.app.mongodb[db_name].find(query).sort("_id", 1)
+            return [document async for document in cursor]
+
+        return await self._query_mongo(db_name, query, fetch, ttl, empty=list)
+
+    async def find_one(self, db_name: str, query: Dict[str, Any]) -> Optional[dict]:
+        """
+        Find a single document of a collection matching an equality query.
+
+        Args:
+            db_name (str): Name of the collection.
+            query (Dict[str, Any]): Query to filter documents.
+
+        Returns:
+            Optional[dict]: The found document, if any.
+        """
+        query = self._normalize(query)
+        table = self.cached_table(db_name, partial_ok=True)
+        if table is not None:
+            result = next(iter(table.find(query)), None)
+            # A miss in a table with evicted documents is not authoritative
+            if not self._use_fallback(result) and (result or table.complete):
+                return result
+
+        async def fetch():
+            return await self.app.mongodb[db_name].find_one(query)
+
+        return await self._query_mongo(db_name, query, fetch, operation="find_one")
+
+    async def policies_by_client_name(
+        self, client_name: str, ttl: Optional[float] = None
+    ) -> Optional[List[dict]]:
+        """
+        Get the policies of the clients with the given name.
+
+        Args:
+            client_name (str): Client name.
+            ttl (Optional[float]): Seconds to keep the MongoDB result in the
+                query cache. None skips the query cache.
+
+        Returns:
+            Optional[List[dict]]: The policies, or None if no client has that
+            name.
+        """
+        clients = self.cached_table("clients")
+        policies = self.cached_table("policies")
+        if clients is not None and policies is not None:
+            join = self.join_index(clients, policies)
+            client_ids = join.client_ids_for_name(client_name)
+            if not self._use_fallback(client_ids):
+                if not client_ids:
+                    return None
+                return [
+                    policies[policy_id]
+                    for client_id in client_ids
+                    for policy_id in join.policy_ids_for_client(client_id)
+                ]
+
+        pipeline = [
+            {"$match": {"name": client_name}},
+            {
+                "$lookup": {
+                    "from": "policies",
+                    "localField": "id",
+                    "foreignField": "clientId",
+                    "as": "policies_info",
+                }
+            },
+        ]
+
+        async def fetch():
+            result = await self.app.mongodb["clients"].aggregate(pipeline).to_list(None)
+            if not result:
+                return None
+            return [
+                policy
+                for client in result
+                for policy in client.get("policies_info", [])
+            ]
+
+        return await self._query_mongo(
+            "clients",
+            pipeline,
+            fetch,
+            ttl,
+            depends_on=("policies",),
+            operation="aggregate",
+        )
+
+    async def clients_by_policy(
+        self, policy_id: str, ttl: Optional[float] = None
+    ) -> Optional[List[dict]]:
+        """
+        Get the client associated with the given policy.
+
+        Args:
+            policy_id (str): Policy ID.
+            ttl (Optional[float]): Seconds to keep the MongoDB result in the
+                query cache. None skips the query cache.
+
+        Returns:
+            Optional[List[dict]]: The clients of the policy, or None if the
+            policy does not exist.
+        """
+        clients = self.cached_table("clients")
+        policies = self.cached_table("policies")
+        if clients is not None and policies is not None:
+            exists = policy_id in policies
+            if not self._use_fallback(exists):
+                if not exists:
+                    return None
+                client_id = self.join_index(clients, policies).client_id_for_policy(
+                    policy_id
+                )
+                return [clients[client_id]] if client_id in clients else []
+
+        pipeline = [
+            {"$match": {"id": policy_id}},
+            {
+                "$lookup": {
+                    "from": "clients",
+                    "localField": "clientId",
+                    "foreignField": "id",
+                    "as": "client_info",
+                }
+            },
+        ]
+
+        async def fetch():
+            result = (
+                await self.app.mongodb["policies"].aggregate(pipeline).to_list(None)
+            )
+            if not result:
+                return None
+            return [
+                client for policy in result for client in policy.get("client_info", [])
+            ]
+
+        return await self._query_mongo(
+            "policies",
+            pipeline,
+            fetch,
+            ttl,
+            depends_on=("clients",),
+            operation="aggregate",
+        )
+
+    @staticmethod
+    def _normalize(query: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Replace enum members in a query by their values so the query compares
+        the same way against MongoDB and against the cache.
+        """
+        return {
+            field: value.value if isinstance(value, Enum) else value
+            for field, value in query.items()
+        }
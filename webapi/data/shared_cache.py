@@ -0,0 +1,743 @@
+"""
+webapi/data/shared_cache.py
+
+This module shares the cached tables between the worker processes of a node
+through `multiprocessing.shared_memory`, so the reference data is held once
+per node instead of once per worker.
+
+One worker wins the loader election (an exclusive lock on a file). It loads
+the cache as usual and publishes it as an immutable generation: a shared
+memory segment holding, for each table, an offsets array and the
+concatenated JSON encoding of its documents, with its primary keys and
+secondary indexes as sorted NumPy arrays, and the policy columns. A small
+control segment names the current generation and the loader process, and
+carries the time the loader last refreshed its tables. The other workers
+attach to the current generation read-only, look keys up in the segment,
+decode documents on access, and swap to a new generation with a single
+reference assignment when the loader publishes one. When the loader exits,
+one of them wins the election and takes over, continuing the generation
+numbering.
+
+Only string primary keys and index values are shared: a table with other
+keys is not published, and other index values are left out of the shared
+indexes.
+"""
+import asyncio
+import inspect
+import json
+import os
+import struct
+import tempfile
+import time
+import weakref
+from collections.abc import Mapping
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from webapi.data.cache_index import IndexedCache
+from webapi.data.columnar import PolicyColumns
+from webapi.logs.logger import app_logger
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+SEGMENT_MAGIC = b"WAPISHM1"
+
+# magic, generation, directory offset, directory length
+SEGMENT_HEADER = struct.Struct("<8sQQQ")
+
+# sequence (odd while being written), generation, loader pid (0 once it
+# closed), refresh time of the tables (seconds since the epoch), data segment
+# name
+CONTROL = struct.Struct("<QQQd48s")
+
+# Seconds a reader waits for the loader to finish writing the control segment
+CONTROL_WAIT = 1.0
+
+
+def _untrack(segment: shared_memory.SharedMemory) -> None:
+    """
+    Stop the resource tracker from unlinking a segment when this process
+    exits. Segment lifetimes are managed explicitly by the loader.
+    """
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    segment = shared_memory.SharedMemory(name=name)
+    _untrack(segment)
+    return segment
+
+
+def _alive(pid: int) -> bool:
+    """
+    Check whether a process is still running.
+    """
+    if not pid:
+        return False
+    if fcntl is None:
+        # No election without fcntl, and os.kill would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Running under another user
+        pass
+    return True
+
+
+def _array(buffer: memoryview, entry: Dict[str, Any]) -> np.ndarray:
+    """
+    Map an array written by `SharedCache.publish` without copying it.
+    """
+    return np.frombuffer(
+        buffer, dtype=np.dtype(entry["dtype"]), count=entry["count"], offset=entry["at"]
+    )
+
+
+class SharedTable(Mapping):
+    """
+    Read-only ``{key: document}`` mapping over a table of a shared segment.
+    Keys are looked up in the segment and documents are decoded from it when
+    they are accessed, so attaching does not build anything per document.
+    """
+
+    def __init__(self, buffer: memoryview, entry: Dict[str, Any]):
+        """
+        Initialize the SharedTable object.
+
+        Args:
+            buffer (memoryview): Buffer of the shared segment.
+            entry (Dict[str, Any]): Directory entry of the table.
+        """
+        self._buffer = buffer
+        self._data_at = entry["data_at"]
+        # Keys in insertion order, and the order that sorts them
+        self._keys = _array(buffer, entry["keys"])
+        self._order = _array(buffer, entry["key_order"])
+        self._offsets = np.frombuffer(
+            buffer,
+            dtype=np.uint64,
+            count=len(self._keys) + 1,
+            offset=entry["offsets_at"],
+        )
+
+    def position(self, key: Any) -> int:
+        """
+        Get the position of a document in the table, or -1 if it is missing.
+        """
+        if not isinstance(key, str):
+            return -1
+        index = int(np.searchsorted(self._keys, key, sorter=self._order))
+        if index < len(self._keys):
+            position = int(self._order[index])
+            if self._keys[position] == key:
+                return position
+        return -1
+
+    def key_at(self, position: int) -> str:
+        """
+        Get the key of the document at a position.
+        """
+        return str(self._keys[position])
+
+    def __getitem__(self, key: Any) -> dict:
+        position = self.position(key)
+        if position < 0:
+            raise KeyError(key)
+        start = self._data_at + int(self._offsets[position])
+        end = self._data_at + int(self._offsets[position + 1])
+        return json.loads(bytes(self._buffer[start:end]))
+
+    def __iter__(self) -> Iterator[Any]:
+        return (str(key) for key in self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: Any) -> bool:
+        return self.position(key) >= 0
+
+
+class SharedPositions(Mapping):
+    """
+    Read-only ``{key: position}`` mapping of a `SharedTable`.
+    """
+
+    def __init__(self, table: SharedTable):
+        self._table = table
+
+    def __getitem__(self, key: Any) -> int:
+        position = self._table.position(key)
+        if position < 0:
+            raise KeyError(key)
+        return position
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._table)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+
+def _refreshed_at(tables: Dict[str, Any]) -> float:
+    """
+    Get the time the least recently refreshed table was refreshed, in
+    seconds since the epoch, since `time.monotonic` is per process.
+    """
+    refreshed = [
+        table.refreshed_at
+        for table in tables.values()
+        if isinstance(table, IndexedCache)
+    ]
+    if not refreshed:
+        return 0.0
+    return time.time() - (time.monotonic() - min(refreshed))
+
+
+class SharedIndex(Mapping):
+    """
+    Read-only ``{value: keys}`` secondary index of a `SharedTable`, looked up
+    in the shared segment.
+    """
+
+    def __init__(self, table: SharedTable, buffer: memoryview, entry: Dict[str, Any]):
+        """
+        Initialize the SharedIndex object.
+
+        Args:
+            table (SharedTable): Table of the indexed documents.
+            buffer (memoryview): Buffer of the shared segment.
+            entry (Dict[str, Any]): Directory entry of the index.
+        """
+        self._table = table
+        # Sorted distinct values, and for each the positions of its documents
+        self._values = _array(buffer, entry["values"])
+        self._offsets = _array(buffer, entry["offsets"])
+        self._positions = _array(buffer, entry["positions"])
+
+    def __getitem__(self, value: Any) -> List[str]:
+        if isinstance(value, str):
+            index = int(np.searchsorted(self._values, value))
+            if index < len(self._values) and self._values[index] == value:
+                start, end = self._offsets[index], self._offsets[index + 1]
+                return [
+                    self._table.key_at(position)
+                    for position in self._positions[start:end]
+                ]
+        raise KeyError(value)
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(value) for value in self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+
+class SharedCache:
+    """
+    Publisher and reader of the cache generations shared by the workers.
+    """
+
+    def __init__(self, prefix: str = "webapi-cache"):
+        """
+        Initialize the SharedCache object.
+
+        Args:
+            prefix (str): Prefix of the shared memory segment names. Use a
+                different prefix per application on the same node.
+        """
+        self.prefix = prefix
+        self.generation = 0
+        self.is_loader = False
+        self._lock_file = None
+        self._control: Optional[shared_memory.SharedMemory] = None
+        # Segments kept alive while their generation may still be read
+        self._segments: Dict[int, shared_memory.SharedMemory] = {}
+        self._published_versions: Dict[str, int] = {}
+        # Refresh time written to the control segment by the loader, and the
+        # tables of the attached generation a follower carries it over to,
+        # weakly referenced so they do not keep the segment mapped
+        self._published_refresh = 0.0
+        self._tables: Mapping[str, IndexedCache] = weakref.WeakValueDictionary()
+
+    @property
+    def control_name(self) -> str:
+        return f"{self.prefix}-control"
+
+    def acquire_loader(self) -> bool:
+        """
+        Try to become the loader process of the node. The lock is held until
+        the process exits. A new loader continues the generation numbering
+        of the previous ones, which it reads from the lock file.
+
+        Returns:
+            bool: True if this process is the loader.
+        """
+        if fcntl is None:
+            self.is_loader = True
+            return True
+
+        path = os.path.join(tempfile.gettempdir(), f"{self.prefix}.lock")
+        self._lock_file = open(path, "a+")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+
+        # Continue the numbering of the previous loaders so workers swap, even
+        # if the control segment was removed with the last one
+        self._lock_file.seek(0)
+        recorded = self._lock_file.read().strip()
+        self.generation = max(
+            self.current()[0], int(recorded) if recorded.isdigit() else 0
+        )
+        self.is_loader = True
+        app_logger.info(f"Process {os.getpid()} is the shared cache loader")
+        return True
+
+    def publish(self, tables: Dict[str, Any]) -> int:
+        """
+        Write the tables to a new generation and make it the current one.
+        The previous generation is unlinked; workers still reading it keep
+        their mapping until they swap. Every document is encoded, so call it
+        from a thread.
+
+        Args:
+            tables (Dict[str, Any]): Cached tables by name.
+
+        Returns:
+            int: The published generation.
+        """
+        generation = self.generation + 1
+        directory, blobs = {}, []
+        position = SEGMENT_HEADER.size
+
+        def append(data: bytes) -> int:
+            nonlocal position
+            # Keep every array 8-byte aligned
+            padding = -position % 8
+            blobs.append(b"\0" * padding)
+            blobs.append(data)
+            position += padding + len(data)
+            return position - len(data)
+
+        def append_array(array: np.ndarray) -> Dict[str, Any]:
+            return {
+                "at": append(array.tobytes()),
+                "dtype": array.dtype.str,
+                "count": len(array),
+            }
+
+        for name, table in tables.items():
+            if not isinstance(table, IndexedCache):
+                continue
+            keys = list(table)
+            if not all(isinstance(key, str) for key in keys):
+                app_logger.warning(f"Table {name} has non-string keys, not sharing it")
+                continue
+            encoded = [
+                json.dumps(table[key], separators=(",", ":"), default=str).encode()
+                for key in keys
+            ]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+            np.cumsum([len(blob) for blob in encoded], out=offsets[1:])
+            key_array = np.array(keys, dtype=str)
+            positions = {key: index for index, key in enumerate(keys)}
+
+            indexes = {}
+            for field in table.indexed_fields:
+                values = sorted(
+                    value for value in table.values_for(field) if isinstance(value, str)
+                )
+                buckets = [
+                    [positions[key] for key in table.ids_for(field, value)]
+                    for value in values
+                ]
+                bucket_offsets = np.zeros(len(buckets) + 1, dtype=np.int64)
+                np.cumsum([len(bucket) for bucket in buckets], out=bucket_offsets[1:])
+                indexes[field] = {
+                    "values": append_array(np.array(values, dtype=str)),
+                    "offsets": append_array(bucket_offsets),
+                    "positions": append_array(
+                        np.array(
+                            [index for bucket in buckets for index in bucket],
+                            dtype=np.int64,
+                        )
+                    ),
+                }
+
+            directory[name] = {
+                "key": table.key,
+                "indexed_fields": list(table.indexed_fields),
+                "keys": append_array(key_array),
+                "key_order": append_array(np.argsort(key_array, kind="stable")),
+                "indexes": indexes,
+                "offsets_at": append(offsets.tobytes()),
+                "data_at": append(b"".join(encoded)),
+            }
+            if name == "policies":
+                # Shared so the workers do not decode every policy to build them
+                columns = PolicyColumns.for_table(table)
+                if columns.keys != keys:
+                    columns = PolicyColumns(table)
+                state = columns.to_state()
+                directory[name]["columns"] = {
+                    "amount": append_array(state["amount"]),
+                    "inception": append_array(state["inception"]),
+                    "installment": append_array(state["installment"]),
+                    "client": [append_array(state["client"][0]), state["client"][1]],
+                    "email": [append_array(state["email"][0]), state["email"][1]],
+                }
+
+        encoded_directory = json.dumps(directory, default=str).encode()
+        blobs.append(encoded_directory)
+        size = position + len(encoded_directory)
+
+        segment = shared_memory.SharedMemory(
+            name=f"{self.prefix}-{os.getpid()}-{generation}", create=True, size=size
+        )
+        _untrack(segment)
+        SEGMENT_HEADER.pack_into(
+            segment.buf, 0, SEGMENT_MAGIC, generation, position, len(encoded_directory)
+        )
+        segment.buf[SEGMENT_HEADER.size : size] = b"".join(blobs)
+
+        refreshed = _refreshed_at(tables)
+        self._write_control(generation, segment.name, refreshed)
+        self._record_generation(generation)
+        self._release_previous(generation)
+        self._segments[generation] = segment
+        self.generation = generation
+        self._published_versions = {
+            name: table.version
+            for name, table in tables.items()
+            if isinstance(table, IndexedCache)
+        }
+        self._published_refresh = refreshed
+        app_logger.info(
+            f"Published shared cache generation {generation} ({size} bytes)"
+        )
+        return generation
+
+    def current(self) -> Tuple[int, str]:
+        """
+        Read the current generation from the control segment.
+
+        Returns:
+            Tuple[int, str]: The generation and its segment name, or (0, "")
+            if nothing was published yet or the control segment cannot be
+            read.
+        """
+        generation, _, name = self._read_control()
+        return generation, name
+
+    def _read_control(self) -> Tuple[int, float, str]:
+        if not self._open_control():
+            return 0, 0.0, ""
+
+        buffer = self._control.buf
+        deadline = time.monotonic() + CONTROL_WAIT
+        while True:
+            before = CONTROL.unpack_from(buffer)[0]
+            if not before % 2:
+                sequence, generation, _, refreshed, name = CONTROL.unpack_from(buffer)
+                if sequence == before:
+                    return generation, refreshed, name.rstrip(b"\0").decode()
+            if time.monotonic() > deadline:
+                # The loader died halfway through a write
+                app_logger.warning("Shared cache control segment left half written")
+                return 0, 0.0, ""
+            time.sleep(0)
+
+    def _open_control(self) -> bool:
+        """
+        Map the control segment. A follower maps it again once the loader
+        that wrote it is gone, since the next loader may create a new one.
+
+        Returns:
+            bool: True if the control segment is mapped.
+        """
+        if self._control is not None and not self.is_loader:
+            pid = CONTROL.unpack_from(self._control.buf)[2]
+            if not _alive(pid):
+                self._close_segment(self._control, unlink=False)
+                self._control = None
+        if self._control is None:
+            try:
+                self._control = _attach(self.control_name)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def attach(self) -> Optional[Dict[str, IndexedCache]]:
+        """
+        Attach to the current generation if it is newer than the attached one.
+        The refresh time published by the loader is carried over to the
+        attached tables, including when the generation did not change.
+
+        Returns:
+            Optional[Dict[str, IndexedCache]]: The tables of the generation,
+            or None if there is no newer generation.
+        """
+        generation, refreshed, name = self._read_control()
+        if generation <= self.generation:
+            if generation == self.generation:
+                self._mark_refreshed(self._tables, refreshed)
+            return None
+        try:
+            segment = _attach(name)
+        except FileNotFoundError:
+            # Replaced while we were reading the control segment
+            return None
+
+        magic, segment_generation, start, length = SEGMENT_HEADER.unpack_from(
+            segment.buf
+        )
+        if magic != SEGMENT_MAGIC or segment_generation != generation:
+            segment.close()
+            return None
+        directory = json.loads(bytes(segment.buf[start : start + length]))
+
+        tables = {}
+        for table_name, entry in directory.items():
+            documents = SharedTable(segment.buf, entry)
+            table = IndexedCache.from_state(
+                {
+                    "key": entry["key"],
+                    "indexed_fields": entry["indexed_fields"],
+                    "documents": documents,
+                    "indexes": {
+                        field: SharedIndex(documents, segment.buf, index)
+                        for field, index in entry["indexes"].items()
+                    },
+                }
+            )
+            columns = entry.get("columns")
+            if columns is not None:
+                state = {
+                    "amount": _array(segment.buf, columns["amount"]),
+                    "inception": _array(segment.buf, columns["inception"]),
+                    "installment": _array(segment.buf, columns["installment"]),
+                    "client": (
+                        _array(segment.buf, columns["client"][0]),
+                        columns["client"][1],
+                    ),
+                    "email": (
+                        _array(segment.buf, columns["email"][0]),
+                        columns["email"][1],
+                    ),
+                }
+                # Over the documents rather than the table, which holds the
+                # columns, so no reference cycle keeps the segment mapped
+                table.set_derived(
+                    "policy_columns",
+                    PolicyColumns.from_state(
+                        documents,
+                        state,
+                        keys=documents,
+                        positions=SharedPositions(documents),
+                    ),
+                )
+            tables[table_name] = table
+
+        self._mark_refreshed(tables, refreshed)
+        self._tables = weakref.WeakValueDictionary(tables)
+        self._release_previous(generation)
+        self._segments[generation] = segment
+        self.generation = generation
+        app_logger.info(f"Attached to shared cache generation {generation}")
+        return tables
+
+    async def wait_for_generation(
+        self, timeout: float = 60, interval: float = 0.5
+    ) -> Dict[str, IndexedCache]:
+        """
+        Wait until the loader publishes a generation and attach to it.
+
+        Args:
+            timeout (float): Seconds to wait.
+            interval (float): Seconds between checks.
+
+        Returns:
+            Dict[str, IndexedCache]: The tables of the generation.
+
+        Raises:
+            TimeoutError: If nothing is published in time.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            tables = self.attach()
+            if tables is not None:
+                return tables
+            await asyncio.sleep(interval)
+        raise TimeoutError(f"No shared cache generation published in {timeout}s")
+
+    async def follow(
+        self,
+        on_swap: Callable[[Dict[str, IndexedCache]], Any],
+        interval: float = 5,
+        on_elected: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        """
+        Attach to every new generation until cancelled, or until this
+        process becomes the loader.
+
+        Args:
+            on_swap: Called with the tables of each new generation. It may be
+                a coroutine function, which is awaited.
+            interval (float): Seconds between checks.
+            on_elected: Called once this process won the election after the
+                loader exited, to load and publish the cache in its place.
+                It may be a coroutine function, which is awaited. Without
+                it, the process keeps following.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if on_elected is not None and fcntl is not None and self.acquire_loader():
+                break
+            try:
+                tables = self.attach()
+                if tables is not None:
+                    result = on_swap(tables)
+                    if inspect.isawaitable(result):
+                        await result
+            except Exception as e:
+                app_logger.error(f"Error attaching to shared cache: {e}")
+
+        app_logger.info("The shared cache loader exited, taking over")
+        result = on_elected()
+        if inspect.isawaitable(result):
+            await result
+
+    @staticmethod
+    def _mark_refreshed(tables: Mapping[str, IndexedCache], refreshed: float) -> None:
+        if not refreshed:
+            return
+        # The loader's refresh time, on the monotonic clock of this process
+        refreshed_at = time.monotonic() - (time.time() - refreshed)
+        for table in tables.values():
+            table.refreshed_at = refreshed_at
+
+    async def publish_changes(
+        self, get_tables: Callable[[], Dict[str, Any]], interval: float = 5
+    ) -> None:
+        """
+        Publish a new generation whenever a table changed, until cancelled.
+        When only the refresh time of the tables advanced, it is written to
+        the control segment without a new generation.
+
+        Args:
+            get_tables: Returns the current tables of the loader.
+            interval (float): Seconds between checks.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                tables = get_tables()
+                versions = {
+                    name: table.version
+                    for name, table in tables.items()
+                    if isinstance(table, IndexedCache)
+                }
+                if versions != self._published_versions:
+                    await asyncio.to_thread(self.publish, tables)
+                elif self.generation in self._segments:
+                    refreshed = _refreshed_at(tables)
+                    # Converted from the monotonic clock, ignore the jitter
+                    if refreshed > self._published_refresh + 0.5:
+                        self._write_control(
+                            self.generation,
+                            self._segments[self.generation].name,
+                            refreshed,
+                        )
+                        self._published_refresh = refreshed
+            except Exception as e:
+                app_logger.error(f"Error publishing shared cache: {e}")
+
+    def close(self) -> None:
+        """
+        Detach from every segment. The loader also unlinks its segments,
+        after marking the control segment as left by its loader.
+        """
+        if self.is_loader and self._control is not None:
+            self._write_control(self.generation, "", self._published_refresh, pid=0)
+        self._tables = weakref.WeakValueDictionary()
+        for segment in self._segments.values():
+            self._close_segment(segment)
+        self._segments.clear()
+        if self._control is not None:
+            self._close_segment(self._control, unlink=self.is_loader)
+            self._control = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _write_control(
+        self, generation: int, name: str, refreshed: float, pid: Optional[int] = None
+    ) -> None:
+        if self._control is None:
+            try:
+                self._control = shared_memory.SharedMemory(
+                    name=self.control_name, create=True, size=CONTROL.size
+                )
+            except FileExistsError:
+                self._control = shared_memory.SharedMemory(name=self.control_name)
+            _untrack(self._control)
+
+        buffer = self._control.buf
+        sequence = CONTROL.unpack_from(buffer)[0]
+        # Even again if a previous loader died halfway through a write
+        sequence += sequence % 2
+        pid = os.getpid() if pid is None else pid
+        struct.pack_into("<Q", buffer, 0, sequence + 1)
+        CONTROL.pack_into(
+            buffer, 0, sequence + 1, generation, pid, refreshed, name.encode()
+        )
+        struct.pack_into("<Q", buffer, 0, sequence + 2)
+
+    def _record_generation(self, generation: int) -> None:
+        if self._lock_file is not None:
+            self._lock_file.truncate(0)
+            self._lock_file.write(str(generation))
+            self._lock_file.flush()
+
+    def _release_previous(self, generation: int) -> None:
+        for old in [number for number in self._segments if number < generation]:
+            self._close_segment(self._segments.pop(old))
+
+    def _close_segment(
+        self, segment: shared_memory.SharedMemory, unlink: Optional[bool] = None
+    ) -> None:
+        try:
+            segment.close()
+        except BufferError:
+            # Documents of the generation are still referenced, the mapping
+            # is released when they are garbage collected
+            pass
+        if self.is_loader if unlink is None else unlink:
+            # unlink() unregisters the segment from the resource tracker, it
+            # must be registered again after `_untrack`
+            resource_tracker.register(segment._name, "shared_memory")
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                resource_tracker.unregister(segment._name, "shared_memory")
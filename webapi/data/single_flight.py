@@ -0,0 +1,89 @@
+"""
+webapi/data/single_flight.py
+
+This module contains the single-flight primitive used to coalesce concurrent
+identical MongoDB queries. The first caller for a key runs the query, callers
+arriving while it is in flight await the same result instead of issuing their
+own query.
+"""
+import asyncio
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+
+from webapi.data.query_cache import QueryCache
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing a key into a single execution.
+    """
+
+    def __init__(self):
+        """
+        Initialize the SingleFlight object.
+        """
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(operation: str, collection: str, query: Any) -> str:
+        """
+        Build the key of a query, independent of the order of its fields.
+
+        Args:
+            operation (str): Kind of query, e.g. "find" or "aggregate".
+            collection (str): Name of the queried collection.
+            query: MongoDB filter or aggregation pipeline.
+
+        Returns:
+            str: The key.
+        """
+        return f"{operation}:{QueryCache.make_key(collection, query)}"
+
+    async def do(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run `fetch`, or wait for the call with the same key already running.
+
+        The call runs in its own task, so a caller being cancelled does not
+        cancel it for the other callers. Errors are raised to every caller.
+
+        Args:
+            key (str): Key identifying identical calls.
+            fetch: Coroutine function producing the result.
+
+        Returns:
+            The result of the call.
+        """
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.calls += 1
+        future = asyncio.ensure_future(fetch())
+        self._in_flight[key] = future
+        future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Number of calls currently running.
+        """
+        return len(self._in_flight)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of executed and coalesced calls.
+
+        Returns:
+            Dict[str, int]: Call counters.
+        """
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": self.in_flight,
+        }
@@ -0,0 +1,193 @@
+"""
+webapi/data/snapshot.py
+
+This module contains the on-disk snapshots of the cache. A snapshot holds the
+documents and indexes of every cached table so a worker can start serving
+from the cache without fetching the upstream data first.
+
+The file is a fixed-size header followed by a `marshal` payload. The header
+records when the snapshot was taken and a SHA-256 digest of the payload, so
+stale or corrupt files are refused. Snapshots are read through `mmap`.
+"""
+import datetime
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from bson import ObjectId
+
+from webapi.data.cache_index import IndexedCache
+from webapi.logs.logger import app_logger
+
+SNAPSHOT_MAGIC = b"WAPICSNP"
+SNAPSHOT_FORMAT_VERSION = 1
+
+# magic, format version, marshal version, created at (unix time),
+# payload length, payload SHA-256
+HEADER = struct.Struct("<8sHHdQ32s")
+
+
+class SnapshotError(Exception):
+    """
+    Raised when a snapshot file cannot be used.
+    """
+
+
+def _plain(value: Any) -> Any:
+    """
+    Convert the BSON values MongoDB documents may hold into types `marshal`
+    can serialize.
+    """
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+class CacheSnapshot:
+    """
+    Class to save and load snapshots of the cached tables.
+    """
+
+    def __init__(self, path: Union[str, Path], max_age: float = 3600):
+        """
+        Initialize the CacheSnapshot object.
+
+        Args:
+            path (Union[str, Path]): Snapshot file.
+            max_age (float): Seconds after which a snapshot is stale.
+        """
+        self.path = Path(path)
+        self.max_age = max_age
+
+    def dump(self, tables: Dict[str, IndexedCache]) -> int:
+        """
+        Write the tables to the snapshot file. The file is replaced atomically
+        so readers never see a partial snapshot.
+
+        Args:
+            tables (Dict[str, IndexedCache]): Cached tables by name.
+
+        Returns:
+            int: Size of the snapshot in bytes.
+        """
+        payload = marshal.dumps(
+            {
+                name: _plain(table.to_state())
+                for name, table in tables.items()
+                if isinstance(table, IndexedCache)
+            }
+        )
+        header = HEADER.pack(
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_FORMAT_VERSION,
+            marshal.version,
+            time.time(),
+            len(payload),
+            hashlib.sha256(payload).digest(),
+        )
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(temporary, "wb") as file:
+            file.write(header)
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+        size = HEADER.size + len(payload)
+        app_logger.info(f"Saved cache snapshot to {self.path} ({size} bytes)")
+        return size
+
+    def read(self) -> Dict[str, IndexedCache]:
+        """
+        Read the tables from the snapshot file.
+
+        Returns:
+            Dict[str, IndexedCache]: Cached tables by name.
+
+        Raises:
+            SnapshotError: If the snapshot is missing, stale or corrupt.
+        """
+        try:
+            with open(self.path, "rb") as file, mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped:
+                created_at, digest = self._check_header(mapped)
+                with memoryview(mapped) as view:
+                    payload = view[HEADER.size :]
+                    try:
+                        if hashlib.sha256(payload).digest() != digest:
+                            raise SnapshotError("checksum mismatch")
+                        states = marshal.loads(payload)
+                    finally:
+                        payload.release()
+        except (OSError, ValueError, EOFError, TypeError) as e:
+            raise SnapshotError(str(e)) from e
+
+        age = time.time() - created_at
+        refreshed_at = time.monotonic() - age
+        tables = {}
+        for name, state in states.items():
+            table = IndexedCache.from_state(state)
+            table.refreshed_at = refreshed_at
+            tables[name] = table
+        return tables
+
+    def load(self) -> Optional[Dict[str, IndexedCache]]:
+        """
+        Read the tables from the snapshot file if it is usable.
+
+        Returns:
+            Optional[Dict[str, IndexedCache]]: Cached tables by name, or None
+            if the snapshot is missing, stale or corrupt.
+        """
+        try:
+            tables = self.read()
+        except SnapshotError as e:
+            app_logger.warning(f"Ignoring cache snapshot {self.path}: {e}")
+            return None
+
+        app_logger.info(
+            f"Loaded cache snapshot {self.path}: "
+            + ", ".join(f"{name}={len(table)}" for name, table in tables.items())
+        )
+        return tables
+
+    def _check_header(self, mapped: mmap.mmap) -> Tuple[float, bytes]:
+        if len(mapped) < HEADER.size:
+            raise SnapshotError("truncated header")
+
+        (
+            magic,
+            version,
+            marshal_version,
+            created_at,
+            length,
+            digest,
+        ) = HEADER.unpack_from(mapped)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("not a cache snapshot")
+        if version != SNAPSHOT_FORMAT_VERSION or marshal_version != marshal.version:
+            raise SnapshotError(f"unsupported snapshot format {version}")
+        if len(mapped) != HEADER.size + length:
+            raise SnapshotError("truncated payload")
+        if self.max_age and time.time() - created_at > self.max_age:
+            raise SnapshotError(f"stale, taken {time.time() - created_at:.0f}s ago")
+
+        return created_at, digest
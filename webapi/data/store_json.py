@@ -1,13 +1,54 @@
+import asyncio
 from typing import Any
+from typing import AsyncIterable
+from typing import AsyncIterator
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Union
 
+from decouple import config
+
 from webapi.data.database import MongoDBAtlasCRUD
 from webapi.data.json_handler import JSONData
+from webapi.data.negative_cache import negative_cache
+from webapi.data.predicate import compile_predicate
 from webapi.logs.logger import app_logger
 
+INGEST_BATCH_SIZE = config("INGEST_BATCH_SIZE", default=1000, cast=int)
+INGEST_MAX_IN_FLIGHT = config("INGEST_MAX_IN_FLIGHT", default=4, cast=int)
+
+
+async def _enumerate(items: AsyncIterable[Any]) -> AsyncIterator[Tuple[int, Any]]:
+    position = 0
+    async for item in items:
+        yield position, item
+        position += 1
+
+
+class IngestReport:
+    """
+    Outcome of a bulk ingest: how many documents were inserted and why the
+    others were not.
+    """
+
+    def __init__(self):
+        self.inserted = 0
+        self.batches = 0
+        # (position in the ingested list, error message)
+        self.errors: List[Tuple[int, str]] = []
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(inserted={self.inserted}, "
+            f"failed={self.failed}, batches={self.batches})"
+        )
+
 
 class JSONDataToMongoDB(JSONData):
     """
@@ -18,28 +59,148 @@ class JSONDataToMongoDB(JSONData):
         super().__init__(url)
         self.mongo_crud = mongo_crud
 
-    async def store_json_data(self, data: Union[Dict, List]) -> None:
+    async def store_json_data(
+        self,
+        data: Union[Dict, List],
+        batch_size: int = INGEST_BATCH_SIZE,
+        max_in_flight: int = INGEST_MAX_IN_FLIGHT,
+    ) -> Optional[IngestReport]:
         """
         Store JSON data into the MongoDB database.
 
+        A list is inserted in unordered `insert_many` batches, with at most
+        `max_in_flight` batches sent at a time. Documents that cannot be
+        inserted are reported without stopping the rest of the load.
+
         Args:
             data: The JSON data to store in the database.
-            database: The database to store the JSON data in.
+            batch_size (int): Maximum number of documents per batch.
+            max_in_flight (int): Maximum number of batches sent concurrently.
+
+        Returns:
+            Optional[IngestReport]: Outcome of the ingest of a list.
         """
         if data is None:
             app_logger.error("No data to store")
-            return
+            return None
 
+        report = None
         if isinstance(data, dict):
             await self.mongo_crud.insert_one(data)
         elif isinstance(data, list):
-            for item in data:
-                if isinstance(item, dict):
-                    await self.mongo_crud.insert_one(item)
-                else:
-                    app_logger.error(f"Invalid data format: {item}")
+            report = await self._insert_batches(data, batch_size, max_in_flight)
         else:
             app_logger.error(f"Invalid data format: {data}")
+            return None
+
+        # Queries that found nothing may match the new documents
+        negative_cache.invalidate(self.mongo_crud.collection.name)
+        return report
+
+    async def store_json_stream(
+        self,
+        items: AsyncIterable[Any],
+        batch_size: int = INGEST_BATCH_SIZE,
+        max_in_flight: int = INGEST_MAX_IN_FLIGHT,
+    ) -> IngestReport:
+        """
+        Store the documents of an asynchronous stream into the MongoDB
+        database, such as the items yielded by `stream_json_items`.
+
+        The documents are inserted in unordered `insert_many` batches as they
+        arrive. Reading the stream waits while `max_in_flight` batches are
+        being sent, so at most that many batches are held in memory.
+
+        Args:
+            items: The documents to store.
+            batch_size (int): Maximum number of documents per batch.
+            max_in_flight (int): Maximum number of batches sent concurrently.
+
+        Returns:
+            IngestReport: Outcome of the ingest.
+        """
+        report = IngestReport()
+        in_flight = set()
+        positions = []
+        batch = []
+
+        async def send():
+            nonlocal positions, batch
+            if len(in_flight) >= max(1, max_in_flight):
+                _, pending = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                in_flight.intersection_update(pending)
+            in_flight.add(
+                asyncio.ensure_future(self._insert_batch(report, positions, batch))
+            )
+            positions, batch = [], []
+
+        try:
+            async for position, item in _enumerate(items):
+                if not isinstance(item, dict):
+                    report.errors.append((position, "Invalid data format"))
+                    continue
+                positions.append(position)
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    await send()
+            if batch:
+                await send()
+        finally:
+            await asyncio.gather(*in_flight)
+
+        negative_cache.invalidate(self.mongo_crud.collection.name)
+        return self._finish(report)
+
+    async def _insert_batches(
+        self, data: List, batch_size: int, max_in_flight: int
+    ) -> IngestReport:
+        report = IngestReport()
+        starts = iter(range(0, len(data), batch_size))
+
+        async def insert_batches():
+            # Each worker keeps one batch in flight
+            for start in starts:
+                positions = []
+                batch = []
+                for position in range(start, min(start + batch_size, len(data))):
+                    if isinstance(data[position], dict):
+                        positions.append(position)
+                        batch.append(data[position])
+                    else:
+                        report.errors.append((position, "Invalid data format"))
+                if batch:
+                    await self._insert_batch(report, positions, batch)
+
+        await asyncio.gather(*(insert_batches() for _ in range(max(1, max_in_flight))))
+        return self._finish(report)
+
+    async def _insert_batch(
+        self, report: IngestReport, positions: List[int], batch: List[dict]
+    ) -> None:
+        report.batches += 1
+        try:
+            inserted, errors = await self.mongo_crud.insert_many(batch)
+        except Exception as e:
+            inserted, errors = 0, [(index, str(e)) for index in range(len(batch))]
+        report.inserted += inserted
+        report.errors.extend((positions[index], message) for index, message in errors)
+
+    def _finish(self, report: IngestReport) -> IngestReport:
+        report.errors.sort()
+        collection = self.mongo_crud.collection.name
+        app_logger.info(
+            f"Inserted {report.inserted} {collection} documents "
+            f"in {report.batches} batches"
+        )
+        if report.errors:
+            position, message = report.errors[0]
+            app_logger.error(
+                f"Error inserting {report.failed} {collection} documents, "
+                f"first at position {position}: {message}"
+            )
+        return report
 
 
 class JSONDataToCache(JSONData):
@@ -67,52 +228,31 @@ class JSONDataToCache(JSONData):
         return data[name]
 
     async def search_cached_data(
-        self, name: str, search_params: Dict[str, str]
+        self, name: str, search_params: Dict[str, Any]
     ) -> Union[List, None]:
         """
         Search for data in the cached JSON data.
 
+        The search parameters are compiled once into a predicate, see
+        `webapi.data.predicate`, which is then run over the cached rows.
+
         Args:
             name: The name of the data in the cache.
             search_params: A dictionary containing the search parameters.
+                Values are either the value a field must equal or a dictionary
+                of `$eq`, `$in`, `$gt`, `$gte`, `$lt` and `$lte` operators.
 
         Returns:
             A list of matching data if found, otherwise None.
         """
-        if self.cache.get(name):
-            return [
-                await self._search_dict(data, search_params)
-                for data in self.cache[name]
-                if await self._search_dict(data, search_params)
-            ]
+        rows = self.cache.get(name)
+        if rows:
+            return compile_predicate(search_params, rows).filter(rows)
         app_logger.error(
             f"Error searching cached data: URL not found in cache: {self.url}"
         )
         return None
 
-    @staticmethod
-    async def _search_dict(
-        data: Dict, search_params: Dict[str, str]
-    ) -> Union[Dict, None]:
-        """
-        Search for data in a dictionary based on search parameters.
-
-        Args:
-            data: The data dictionary to search in.
-            search_params: A dictionary containing the search parameters.
-
-        Returns:
-            A dictionary containing the matching data if found, otherwise None.
-        """
-        return next(
-            (
-                None
-                for key, value in search_params.items()
-                if key not in data or str(data[key]) != value
-            ),
-            data,
-        )
-
     async def get_cache(self) -> dict:
         """
         Get the current cache.
@@ -0,0 +1,290 @@
+"""
+webapi/data/write_behind.py
+
+This module contains the write-behind buffer used to persist cache updates.
+Updated documents are kept as dirty entries and written to MongoDB in batched
+``bulk_write`` upserts, either periodically or when too many are pending.
+"""
+import asyncio
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from pymongo.errors import PyMongoError
+
+from webapi.data.content_sync import content_hash
+from webapi.data.content_sync import CONTENT_HASH_FIELD
+from webapi.logs.logger import app_logger
+
+# Write error codes worth retrying: the server was interrupted, stepping down
+# or out of time. Any other error of a single document, such as a duplicate
+# key (11000) or a failed validation (121), fails the same way every time.
+TRANSIENT_ERROR_CODES = {
+    6,  # HostUnreachable
+    7,  # HostNotFound
+    50,  # MaxTimeMSExpired
+    89,  # NetworkTimeout
+    91,  # ShutdownInProgress
+    112,  # WriteConflict
+    189,  # PrimarySteppedDown
+    262,  # ExceededTimeLimit
+    9001,  # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    13436,  # NotPrimaryOrSecondary
+}
+
+
+class WriteBehindBuffer:
+    """
+    Buffer of dirty cache entries waiting to be written to MongoDB.
+    """
+
+    def __init__(
+        self,
+        database,
+        batch_size: int = 500,
+        max_pending: int = 1000,
+        key: str = "id",
+        on_flush: Optional[Callable[[str], Awaitable[Any]]] = None,
+        max_retries: int = 5,
+    ):
+        """
+        Initialize the WriteBehindBuffer object.
+
+        Args:
+            database: Asynchronous MongoDB database to write to.
+            batch_size (int): Maximum number of upserts per `bulk_write`.
+            max_pending (int): Number of dirty entries that triggers a flush
+                without waiting for the timer.
+            key (str): Field identifying a document in every collection.
+            on_flush: Coroutine function called with the name of each
+                collection written by a flush.
+            max_retries (int): Number of flushes a document failing with a
+                transient error is retried in before it is dropped.
+        """
+        self.database = database
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.key = key
+        self.on_flush = on_flush
+        self.max_retries = max_retries
+        # Documents given up on, see `_dead_letter`
+        self.dropped = 0
+        self._pending: Dict[str, Dict[Any, dict]] = {}
+        # Entries taken by the running flush and not acknowledged yet
+        self._in_flight: Dict[str, Dict[Any, dict]] = {}
+        # Failed flushes of each queued document, reset by a newer version
+        self._attempts: Dict[Tuple[str, Any], int] = {}
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._stopped = asyncio.Event()
+
+    @property
+    def pending_count(self) -> int:
+        """
+        Number of dirty entries not yet written.
+        """
+        return sum(len(entries) for entries in self._pending.values())
+
+    def is_dirty(self, db_name: str, primary_key: Any) -> bool:
+        """
+        Check whether a cache entry has changes not yet written to MongoDB.
+
+        Args:
+            db_name (str): Name of the collection.
+            primary_key: Key of the document.
+
+        Returns:
+            bool: True if the entry is waiting to be flushed or is being
+                written.
+        """
+        return primary_key in self._pending.get(
+            db_name, {}
+        ) or primary_key in self._in_flight.get(db_name, {})
+
+    def mark_dirty(self, db_name: str, document: dict) -> None:
+        """
+        Queue a document to be upserted. A later update of the same document
+        replaces the queued one, so only the last version is written.
+
+        Args:
+            db_name (str): Name of the collection.
+            document (dict): Current version of the document.
+        """
+        self._pending.setdefault(db_name, {})[document[self.key]] = document
+        self._attempts.pop((db_name, document[self.key]), None)
+
+        if self.pending_count >= self.max_pending and (
+            self._flush_task is None or self._flush_task.done()
+        ):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> int:
+        """
+        Write every dirty entry to MongoDB in batched unordered upserts.
+        Entries that could not be written, including those of a flush that
+        was interrupted, are queued again unless they were updated in the
+        meantime. Entries rejected by MongoDB, or still failing after
+        `max_retries` flushes, are dropped and logged instead.
+
+        Returns:
+            int: Number of documents written.
+        """
+        async with self._lock:
+            self._in_flight, self._pending = self._pending, {}
+            written = 0
+            failed: Set[Tuple[str, Any]] = set()
+            try:
+                for db_name, entries in self._in_flight.items():
+                    documents = list(entries.values())
+                    for start in range(0, len(documents), self.batch_size):
+                        batch = documents[start : start + self.batch_size]
+                        acknowledged, rejected = await self._write_batch(db_name, batch)
+                        for document in acknowledged + rejected:
+                            del entries[document[self.key]]
+                            self._attempts.pop((db_name, document[self.key]), None)
+                        written += len(acknowledged)
+                        self._dead_letter(db_name, rejected, "rejected by MongoDB")
+                        failed.update(
+                            (db_name, document[self.key])
+                            for document in batch
+                            if document[self.key] in entries
+                        )
+                    if self.on_flush is not None:
+                        await self.on_flush(db_name)
+            finally:
+                for db_name, entries in self._in_flight.items():
+                    self._requeue(db_name, entries.values(), failed)
+                self._in_flight = {}
+
+            if written:
+                app_logger.info(f"Flushed {written} cached documents to MongoDB")
+            return written
+
+    async def run(self, interval: float) -> None:
+        """
+        Flush the buffer every `interval` seconds until `stop` is called.
+
+        Args:
+            interval (float): Seconds between flushes.
+        """
+        stopped = False
+        while not stopped:
+            try:
+                await asyncio.wait_for(self._stopped.wait(), interval)
+                stopped = True
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                app_logger.error(f"Error flushing write-behind buffer: {e}")
+
+    def stop(self) -> None:
+        """
+        Make `run` return after its current flush.
+        """
+        self._stopped.set()
+
+    async def drain(self) -> int:
+        """
+        Wait for a running flush and write everything still pending.
+
+        Returns:
+            int: Number of documents written by the final flush.
+        """
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        return await self.flush()
+
+    async def _write_batch(
+        self, db_name: str, batch: list
+    ) -> Tuple[List[dict], List[dict]]:
+        """
+        Upsert a batch of documents, keeping their content hash so the
+        content sync does not see them as changed.
+
+        Returns:
+            Tuple[List[dict], List[dict]]: The documents written and the
+                documents rejected with a permanent error. The others failed
+                with a transient error.
+        """
+        operations = []
+        for document in batch:
+            replacement = {
+                field: value for field, value in document.items() if field != "_id"
+            }
+            replacement[CONTENT_HASH_FIELD] = content_hash(document)
+            operations.append(
+                ReplaceOne({self.key: document[self.key]}, replacement, upsert=True)
+            )
+        try:
+            await self.database[db_name].bulk_write(operations, ordered=False)
+            return batch, []
+        except BulkWriteError as e:
+            errors = {
+                error["index"]: error for error in e.details.get("writeErrors", [])
+            }
+            app_logger.error(
+                f"Error flushing {len(errors)} {db_name} documents: "
+                f"{list(errors.values())[:1]}"
+            )
+            acknowledged, rejected = [], []
+            for index, document in enumerate(batch):
+                if index not in errors:
+                    acknowledged.append(document)
+                elif errors[index].get("code") not in TRANSIENT_ERROR_CODES:
+                    rejected.append(document)
+            return acknowledged, rejected
+        except PyMongoError as e:
+            app_logger.error(f"Error flushing {db_name} documents: {e}")
+            return [], []
+
+    def _requeue(
+        self, db_name: str, documents: Iterable[dict], failed: Set[Tuple[str, Any]]
+    ) -> None:
+        entries = self._pending.setdefault(db_name, {})
+        exhausted = []
+        for document in documents:
+            primary_key = document[self.key]
+            # A newer version queued meanwhile replaces this one
+            if primary_key in entries:
+                continue
+            if (db_name, primary_key) in failed:
+                attempts = self._attempts.get((db_name, primary_key), 0) + 1
+                if attempts > self.max_retries:
+                    self._attempts.pop((db_name, primary_key), None)
+                    exhausted.append(document)
+                    continue
+                self._attempts[(db_name, primary_key)] = attempts
+            entries[primary_key] = document
+        if not entries:
+            del self._pending[db_name]
+        self._dead_letter(
+            db_name, exhausted, f"still failing after {self.max_retries} retries"
+        )
+
+    def _dead_letter(self, db_name: str, documents: List[dict], reason: str) -> None:
+        """
+        Give up on documents that cannot be written. They stop being dirty,
+        so the next refresh of the cache replaces them with the stored
+        version.
+        """
+        if not documents:
+            return
+        self.dropped += len(documents)
+        app_logger.error(
+            f"Dropped {len(documents)} {db_name} documents {reason}: "
+            f"{[document[self.key] for document in documents]}"
+        )
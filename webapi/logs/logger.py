@@ -8,6 +8,9 @@ be imported and used in other modules to log messages with different levels of s
 """
 import logging
 import pathlib
+import time
+from contextlib import contextmanager
+from typing import Iterator
 
 import colorlog
 
@@ -82,3 +85,19 @@ def setup_logger(
 
 # Set up loggers for different modules
 app_logger = setup_logger("webapi", "webapi.log", logging.INFO)
+
+
+@contextmanager
+def log_duration(stage: str, logger: logging.Logger = app_logger) -> Iterator[None]:
+    """
+    Log how long the enclosed block took.
+
+    Args:
+        stage (str): Name of the timed stage.
+        logger (logging.Logger, optional): Logger to write to.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info(f"{stage} took {time.perf_counter() - start:.3f}s")
@@ -6,6 +6,7 @@ This module contains the router for handling /clients API calls.
 from typing import List
 from typing import Optional
 
+from decouple import config
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import HTTPException
@@ -19,6 +20,9 @@ from webapi.backend.classes import Role
 router = APIRouter()
 auth_handler = Authorization()
 
+# Seconds the MongoDB results of each route are kept in the query cache
+FILTER_QUERY_TTL = config("QUERY_CACHE_TTL_CLIENTS_FILTER", default=30, cast=float)
+
 
 @router.get("/", response_description="List clients")
 async def list_clients(
@@ -43,7 +47,7 @@ async def list_clients(
     Returns:
         List[ClientDB]: A list of filtered client objects.
     """
-    user = await request.app.mongodb["clients"].find_one({"id": userId})
+    user = await request.app.reader.find_one("clients", {"id": userId})
     print(user)
     if user["role"] not in ["admin", "user"]:
         raise HTTPException(status_code=401, detail="Content restricted to admins")
@@ -59,8 +63,8 @@ async def list_clients(
     if email:
         query["email"] = email
 
-    full_query = request.app.mongodb["clients"].find(query).sort("_id", 1)
-    return [ClientDB(**raw_customers) async for raw_customers in full_query]
+    raw_clients = await request.app.reader.find("clients", query)
+    return [ClientDB(**raw_customers) for raw_customers in raw_clients]
 
 
 @router.get("/name/{name}", response_description="List clients by name")
@@ -82,15 +86,15 @@ async def list_clients_by_name(
     """
     query = {"name": name}
 
-    user = await request.app.mongodb["clients"].find_one({"id": userId})
+    user = await request.app.reader.find_one("clients", {"id": userId})
 
     if user["role"] not in ["admin", "user"]:
         raise HTTPException(status_code=401, detail="Content restricted to admins")
 
     query = {"name": name}
 
-    full_query = request.app.mongodb["clients"].find(query).sort("_id", 1)
-    return [ClientDB(**raw_customers) async for raw_customers in full_query]
+    raw_clients = await request.app.reader.find("clients", query)
+    return [ClientDB(**raw_customers) for raw_customers in raw_clients]
 
 
 @router.get("/{filter}/{value}", response_description="List clients by filter")
@@ -114,12 +118,12 @@ async def list_clients_by_filter(
     """
     query = {filter: value}
 
-    user = await request.app.mongodb["clients"].find_one({"id": userId})
+    user = await request.app.reader.find_one("clients", {"id": userId})
     print(user)
     if user["role"] not in ["admin", "user"]:
         raise HTTPException(status_code=401, detail="Content restricted to admins")
 
     query = {filter: value}
 
-    full_query = request.app.mongodb["clients"].find(query).sort("_id", 1)
-    return [ClientDB(**raw_customers) async for raw_customers in full_query]
+    raw_clients = await request.app.reader.find("clients", query, ttl=FILTER_QUERY_TTL)
+    return [ClientDB(**raw_customers) for raw_customers in raw_clients]
@@ -8,6 +8,7 @@ from typing import List
 from typing import Optional
 from typing import Union
 
+from decouple import config
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import HTTPException
@@ -16,11 +17,19 @@ from pydantic import EmailStr
 
 from webapi.backend.authentication import Authorization
 from webapi.backend.classes import ClientDB
+from webapi.backend.classes import ClientPortfolio
+from webapi.backend.classes import InceptionYearSummary
+from webapi.backend.classes import InstallmentSummary
 from webapi.backend.classes import PoliciesDB
+from webapi.data.cache_index import IndexedCache
+from webapi.data.columnar import PolicyColumns
 
 router = APIRouter()
 auth_handler = Authorization()
 
+# Seconds the MongoDB results of each route are kept in the query cache
+LOOKUP_QUERY_TTL = config("QUERY_CACHE_TTL_POLICIES_LOOKUP", default=60, cast=float)
+
 
 @router.get("/", response_description="List policies")
 async def list_policies(
@@ -56,7 +65,7 @@ async def list_policies(
     Returns:
         List[PoliciesDB]: A list of filtered policy objects.
     """
-    user = await request.app.mongodb["clients"].find_one({"id": userId})
+    user = await request.app.reader.find_one("clients", {"id": userId})
     print(user)
     if user is None or user["role"] != "admin":
         raise HTTPException(status_code=401, detail="Content restricted to admins")
@@ -76,8 +85,8 @@ async def list_policies(
     if installmentPayment:
         query["installmentPayment"] = installmentPayment
     print(f"Query is {query}")
-    full_query = request.app.mongodb["policies"].find(query).sort("_id", 1)
-    return [PoliciesDB(**raw_customers) async for raw_customers in full_query]
+    raw_policies = await request.app.reader.find("policies", query)
+    return [PoliciesDB(**raw_customers) for raw_customers in raw_policies]
 
 
 @router.get(
@@ -100,30 +109,16 @@ async def list_policies_by_client_name(
     """
 
     # Authentication
-    user = await request.app.mongodb["clients"].find_one({"id": userId})
+    user = await request.app.reader.find_one("clients", {"id": userId})
     if user is None or user["role"] != "admin":
         raise HTTPException(status_code=401, detail="Content restricted to admins")
 
-    pipeline = [
-        {"$match": {"name": client_name}},
-        {
-            "$lookup": {
-                "from": "policies",
-                "localField": "id",
-                "foreignField": "clientId",
-                "as": "policies_info",
-            }
-        },
-    ]
-
-    result = await request.app.mongodb["clients"].aggregate(pipeline).to_list(None)
+    result = await request.app.reader.policies_by_client_name(
+        client_name, ttl=LOOKUP_QUERY_TTL
+    )
 
     if result:
-        return [
-            PoliciesDB(**policy)
-            for client in result
-            for policy in client.get("policies_info", [])
-        ]
+        return [PoliciesDB(**policy) for policy in result]
     else:
         return None
 
@@ -145,28 +140,108 @@ async def list_client_by_policy(
     """
 
     # Authentication
-    user = await request.app.mongodb["clients"].find_one({"id": userId})
+    user = await request.app.reader.find_one("clients", {"id": userId})
     if user is None or user["role"] != "admin":
         raise HTTPException(status_code=401, detail="Content restricted to admins")
 
-    pipeline = [
-        {"$match": {"id": policy_id}},
-        {
-            "$lookup": {
-                "from": "clients",
-                "localField": "clientId",
-                "foreignField": "id",
-                "as": "client_info",
-            }
-        },
-    ]
-    result = await request.app.mongodb["policies"].aggregate(pipeline).to_list(None)
+    result = await request.app.reader.clients_by_policy(policy_id, ttl=LOOKUP_QUERY_TTL)
 
     if result:
-        return [
-            ClientDB(**client)
-            for policy in result
-            for client in policy.get("client_info", [])
-        ]
+        return [ClientDB(**client) for client in result]
     else:
         return None
+
+
+async def _portfolio_table(request: Request, userId: str) -> IndexedCache:
+    """
+    Check the user is an admin and get the cached policies to aggregate.
+
+    Args:
+        request (Request): FastAPI request object.
+        userId (str): User ID from the authorization wrapper.
+
+    Returns:
+        IndexedCache: The cached policies.
+
+    Raises:
+        HTTPException: 503 if the cache is not loaded, or no longer holds
+            every policy, since the totals would then be wrong.
+    """
+    user = await request.app.reader.find_one("clients", {"id": userId})
+    if user is None or user["role"] != "admin":
+        raise HTTPException(status_code=401, detail="Content restricted to admins")
+
+    table = request.app.reader.cache_tables().get("policies")
+    if not isinstance(table, IndexedCache):
+        raise HTTPException(status_code=503, detail="Policies cache not loaded")
+    if not table.complete:
+        # Policies were evicted to keep the cache within its memory budget
+        raise HTTPException(status_code=503, detail="Policies cache incomplete")
+    return table
+
+
+@router.get("/stats/by_client", response_description="Amount insured per client")
+async def policies_stats_by_client(
+    request: Request, userId: str = Depends(auth_handler.auth_wrapper)
+) -> List[ClientPortfolio]:
+    """
+    Count the policies and sum and average the amount insured of each client.
+
+    Args:
+        request (Request): FastAPI request object.
+        userId (str, optional): User ID from the authorization wrapper.
+
+    Returns:
+        List[ClientPortfolio]: One entry per client with policies.
+    """
+    table = await _portfolio_table(request, userId)
+    totals = table.derive(
+        "totals_by_client", lambda t: PolicyColumns.for_table(t).totals_by_client()
+    )
+    return [ClientPortfolio(**entry) for entry in totals]
+
+
+@router.get(
+    "/stats/by_installment", response_description="Amount insured per installment"
+)
+async def policies_stats_by_installment(
+    request: Request, userId: str = Depends(auth_handler.auth_wrapper)
+) -> List[InstallmentSummary]:
+    """
+    Count the policies and sum the amount insured by installment payment.
+
+    Args:
+        request (Request): FastAPI request object.
+        userId (str, optional): User ID from the authorization wrapper.
+
+    Returns:
+        List[InstallmentSummary]: One entry per installment flag.
+    """
+    table = await _portfolio_table(request, userId)
+    totals = table.derive(
+        "totals_by_installment",
+        lambda t: PolicyColumns.for_table(t).totals_by_installment(),
+    )
+    return [InstallmentSummary(**entry) for entry in totals]
+
+
+@router.get("/stats/by_inception_year", response_description="Amount insured per year")
+async def policies_stats_by_inception_year(
+    request: Request, userId: str = Depends(auth_handler.auth_wrapper)
+) -> List[InceptionYearSummary]:
+    """
+    Count the policies and sum the amount insured by inception year.
+
+    Args:
+        request (Request): FastAPI request object.
+        userId (str, optional): User ID from the authorization wrapper.
+
+    Returns:
+        List[InceptionYearSummary]: One entry per year, in ascending order.
+    """
+    table = await _portfolio_table(request, userId)
+    totals = table.derive(
+        "totals_by_inception_year",
+        lambda t: PolicyColumns.for_table(t).totals_by_inception_year(),
+    )
+    return [InceptionYearSummary(**entry) for entry in totals]
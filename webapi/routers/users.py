@@ -50,6 +50,8 @@ async def register(request: Request, newUser: UserBase = Body(...)) -> JSONRespo
         )
 
     user = await request.app.mongodb["users"].insert_one(newUser)
+    if request.app.reader.negative_cache is not None:
+        request.app.reader.negative_cache.invalidate("users")
     created_user = await request.app.mongodb["users"].find_one(
         {"_id": user.inserted_id}
     )
@@ -97,6 +99,6 @@ async def me(
     Returns:
         JSONResponse: JSON response with the logged in user data.
     """
-    currentUser = await request.app.mongodb["users"].find_one({"id": userId})
+    currentUser = await request.app.reader.find_one("users", {"id": userId})
     result = CurrentUser(**currentUser).dict()
     return JSONResponse(status_code=status.HTTP_200_OK, content=result)